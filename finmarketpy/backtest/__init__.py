@@ -3,4 +3,12 @@ __author__ = 'saeedamen'
 from finmarketpy.backtest.backtestengine import Backtest
 from finmarketpy.backtest.backtestrequest import BacktestRequest
 from finmarketpy.backtest.backtestengine import TradingModel
-from finmarketpy.backtest.tradeanalysis import TradeAnalysis
\ No newline at end of file
+from finmarketpy.backtest.batchbacktest import BatchBacktest
+from finmarketpy.backtest.covarianceestimator import CovarianceEstimator
+from finmarketpy.backtest.executionrules import ExecutionRules
+from finmarketpy.backtest.onlineleverage import OnlineLeverage
+from finmarketpy.backtest.pnlkernel import PnLKernel
+from finmarketpy.backtest.returnsbootstrap import ReturnsBootstrap
+from finmarketpy.backtest.streamingbacktest import StreamingBacktest
+from finmarketpy.backtest.tradeanalysis import TradeAnalysis
+from finmarketpy.backtest.walkforward import WalkForward
\ No newline at end of file
@@ -26,10 +26,26 @@ from findatapy.util import LoggerManager
 
 class Backtest:
 
+    # outputs which can be calculated lazily (and the methods which calculate them)
+    LAZY_RESULTS = {'_portfolio_signal' : '_calculate_portfolio_signal',
+                    '_cumpnl' : '_calculate_cumpnl',
+                    '_cumportfolio' : '_calculate_cumportfolio',
+                    '_ret_stats_pnl' : '_calculate_ret_stats_pnl',
+                    '_ret_stats_portfolio' : '_calculate_ret_stats_portfolio'}
+
+    # outputs which are stored as float32 (sharing one index) in lean memory mode
+    LEAN_RESULTS = ['_signal', '_portfolio_signal', '_individual_leverage', '_portfolio_leverage', '_portfolio_weights',
+                    '_pnl', '_portfolio', '_cumpnl', '_cumportfolio', '_pnl_trades']
+
     def __init__(self):
         self.logger = LoggerManager().getLogger(__name__)
         self._pnl = None
         self._portfolio = None
+        self._lazy = set()
+        self._lean = False
+        self._profiler = None
+        self._portfolio_weights = None
+        self._tc = 0.0
         return
 
     def calculate_trading_PnL(self, br, asset_a_df, signal_df):
@@ -49,861 +65,2432 @@ class Backtest:
         """
 
         calculations = Calculations()
+
+        # record time/memory of each stage (if we have a StageProfiler)
+        profiler = getattr(br, 'profiler', None)
+
+        self._profiler = profiler
+
         # signal_df.to_csv('e:/temp0.csv')
         # make sure the dates of both traded asset and signal are aligned properly
-        asset_df, signal_df = asset_a_df.align(signal_df, join='left', axis = 'index')
+        with profile_stage(profiler, 'align') as record:
+            asset_df, signal_df = asset_a_df.align(signal_df, join='left', axis = 'index')
 
-        # only allow signals to change on the days when we can trade assets
-        signal_df = signal_df.mask(numpy.isnan(asset_df.values))    # fill asset holidays with NaN signals
-        signal_df = signal_df.fillna(method='ffill')                # fill these down
-        asset_df = asset_df.fillna(method='ffill')                  # fill down asset holidays
+            set_stage_shape(record, asset_df)
 
-        returns_df = calculations.calculate_returns(asset_df)
-        tc = br.spot_tc_bp
+        pnl_cols = []
 
-        signal_cols = signal_df.columns.values
-        returns_cols = returns_df.columns.values
+        for i in range(0, len(asset_df.columns)):
+            pnl_cols.append(asset_df.columns[i] + " / " + signal_df.columns[i])
 
-        pnl_cols = []
+        # use the compiled P&L kernel (rather than pandas) for the signal P&L?
+        use_kernel = hasattr(br, 'pnl_kernel') and br.pnl_kernel is True
 
-        for i in range(0, len(returns_cols)):
-            pnl_cols.append(returns_cols[i] + " / " + signal_cols[i])
+        tc = self._get_tc(br, asset_df)
 
-        # do we have a vol target for individual signals?
-        if hasattr(br, 'signal_vol_adjust'):
-            if br.signal_vol_adjust is True:
-                risk_engine = RiskEngine()
+        self._tc = tc                                       # for the cost of entering each trade
 
-                if not(hasattr(br, 'signal_vol_resample_type')):
-                    br.signal_vol_resample_type = 'mean'
+        # path dependent execution rules (eg. stop losses) adjust the signals after leverage
+        execution_state = None
 
-                if not(hasattr(br, 'signal_vol_resample_freq')):
-                    br.signal_vol_resample_freq = None
+        if use_kernel:
+            raw_signal_df = signal_df                                   # unfilled (only tail is filled for extending)
 
-                leverage_df = risk_engine.calculate_leverage_factor(returns_df, br.signal_vol_target, br.signal_vol_max_leverage,
-                                               br.signal_vol_periods, br.signal_vol_obs_in_year,
-                                               br.signal_vol_rebalance_freq, br.signal_vol_resample_freq,
-                                               br.signal_vol_resample_type)
+            signal_df, _pnl, cumpnl, portfolio, execution_state = \
+                self._calculate_kernel_PnL(br, asset_df, signal_df, pnl_cols, tc)
+        else:
+            asset_values = asset_df.values                              # before filling (for execution rules)
 
-                signal_df = pandas.DataFrame(
-                    signal_df.values * leverage_df.values, index = signal_df.index, columns = signal_df.columns)
+            with profile_stage(profiler, 'fill') as record:
+                # only allow signals to change on the days when we can trade assets
+                signal_df = signal_df.mask(numpy.isnan(asset_df.values))    # fill asset holidays with NaN signals
+                signal_df = signal_df.fillna(method='ffill')                # fill these down
+                asset_df = asset_df.fillna(method='ffill')                  # fill down asset holidays
 
-                self._individual_leverage = leverage_df     # contains leverage of individual signal (before portfolio vol target)
+                raw_signal_df = signal_df                                   # before any leverage (for extending backtest)
 
-        _pnl = calculations.calculate_signal_returns_with_tc_matrix(signal_df, returns_df, tc = tc)
-        _pnl.columns = pnl_cols
-
-        # portfolio is average of the underlying signals: should we sum them or average them?
-        if hasattr(br, 'portfolio_combination'):
-            if br.portfolio_combination == 'sum':
-                 portfolio = pandas.DataFrame(data = _pnl.sum(axis = 1), index = _pnl.index, columns = ['Portfolio'])
-            elif br.portfolio_combination == 'mean':
-                 portfolio = pandas.DataFrame(data = _pnl.mean(axis = 1), index = _pnl.index, columns = ['Portfolio'])
-        else:
-            portfolio = pandas.DataFrame(data = _pnl.mean(axis = 1), index = _pnl.index, columns = ['Portfolio'])
+                returns_df = calculations.calculate_returns(asset_df)
+
+                set_stage_shape(record, returns_df)
+
+            # do we have a vol target for individual signals?
+            if hasattr(br, 'signal_vol_adjust'):
+                if br.signal_vol_adjust is True:
+                    with profile_stage(profiler, 'leverage') as record:
+                        risk_engine = RiskEngine()
+
+                        if not(hasattr(br, 'signal_vol_resample_type')):
+                            br.signal_vol_resample_type = 'mean'
+
+                        if not(hasattr(br, 'signal_vol_resample_freq')):
+                            br.signal_vol_resample_freq = None
+
+                        leverage_df = risk_engine.calculate_leverage_factor(returns_df, br.signal_vol_target, br.signal_vol_max_leverage,
+                                                       br.signal_vol_periods, br.signal_vol_obs_in_year,
+                                                       br.signal_vol_rebalance_freq, br.signal_vol_resample_freq,
+                                                       br.signal_vol_resample_type)
+
+                        signal_df = pandas.DataFrame(
+                            signal_df.values * leverage_df.values, index = signal_df.index, columns = signal_df.columns)
+
+                        self._individual_leverage = leverage_df     # contains leverage of individual signal (before portfolio vol target)
+
+                        set_stage_shape(record, leverage_df)
+
+            signal_df, execution_state = self._apply_execution_rules(br, asset_values, signal_df)
+
+            with profile_stage(profiler, 'pnl') as record:
+                _pnl = calculations.calculate_signal_returns_with_tc_matrix(signal_df, returns_df, tc = tc)
+                _pnl.columns = pnl_cols
+
+                # portfolio is average of the underlying signals: should we sum them or average them? (risk weighted
+                # portfolios are combined later, from the covariance of signal returns)
+                if hasattr(br, 'portfolio_combination'):
+                    if br.portfolio_combination == 'sum':
+                         portfolio = pandas.DataFrame(data = _pnl.sum(axis = 1), index = _pnl.index, columns = ['Portfolio'])
+                    else:
+                         portfolio = pandas.DataFrame(data = _pnl.mean(axis = 1), index = _pnl.index, columns = ['Portfolio'])
+                else:
+                    portfolio = pandas.DataFrame(data = _pnl.mean(axis = 1), index = _pnl.index, columns = ['Portfolio'])
+
+                set_stage_shape(record, _pnl)
+
+        raw_portfolio = portfolio                                   # before any portfolio leverage
 
         portfolio_leverage_df = pandas.DataFrame(data = numpy.ones(len(_pnl.index)), index = _pnl.index, columns = ['Portfolio'])
 
+        portfolio_weights_df = None
+        ex_ante_state = None
 
-        # should we apply vol target on a portfolio level basis?
-        if hasattr(br, 'portfolio_vol_adjust'):
+        # should we apply vol target on a portfolio level basis? (from the covariance of signal returns, or risk weights)
+        if RiskEngine().is_ex_ante_portfolio(br):
+            with profile_stage(profiler, 'portfolio_leverage') as record:
+                portfolio, portfolio_leverage_df, portfolio_weights_df, ex_ante_state = \
+                    RiskEngine().calculate_ex_ante_portfolio(_pnl, br, tc = tc)
+
+                set_stage_shape(record, portfolio_weights_df)
+        elif hasattr(br, 'portfolio_vol_adjust'):
             if br.portfolio_vol_adjust is True:
-                risk_engine = RiskEngine()
+                with profile_stage(profiler, 'portfolio_leverage') as record:
+                    risk_engine = RiskEngine()
 
-                portfolio, portfolio_leverage_df = risk_engine.calculate_vol_adjusted_returns(portfolio, br = br)
+                    portfolio, portfolio_leverage_df = risk_engine.calculate_vol_adjusted_returns(
+                        portfolio, br = br, tc = self._get_portfolio_tc(tc, _pnl.shape))
+
+                    set_stage_shape(record, portfolio)
 
         self._portfolio = portfolio
         self._signal = signal_df                            # individual signals (before portfolio leverage)
         self._portfolio_leverage = portfolio_leverage_df    # leverage on portfolio
+        self._portfolio_weights = portfolio_weights_df      # exposure to each signal (only for ex-ante portfolios)
 
-        # multiply portfolio leverage * individual signals to get final position signals
-        length_cols = len(signal_df.columns)
-        leverage_matrix = numpy.repeat(portfolio_leverage_df.values.flatten()[numpy.newaxis,:], length_cols, 0)
+        self._pnl = _pnl                                                            # individual signals P&L
+        self._portfolio.columns = ['Port']
 
-        # final portfolio signals (including signal & portfolio leverage)
-        self._portfolio_signal = pandas.DataFrame(
-            data = numpy.multiply(numpy.transpose(leverage_matrix), signal_df.values),
-            index = signal_df.index, columns = signal_df.columns)
-
-        if hasattr(br, 'portfolio_combination'):
-            if br.portfolio_combination == 'sum':
-                pass
-            elif br.portfolio_combination == 'mean':
-                self._portfolio_signal = self._portfolio_signal / float(length_cols)
-        else:
-            self._portfolio_signal = self._portfolio_signal / float(length_cols)
+        # trades are only calculated on demand
+        self._pnl_trades = None
+        self._trades = None
 
-        self._pnl = _pnl                                                            # individual signals P&L
+        self._ann_factor = br.ann_factor
+        self._portfolio_combination = 'mean'
+        self._use_kernel = use_kernel
+        self._lean = hasattr(br, 'lean_memory') and br.lean_memory is True
 
-        # TODO FIX very slow - hence only calculate on demand
-        _pnl_trades = None
-        # _pnl_trades = calculations.calculate_individual_trade_gains(signal_df, _pnl)
-        self._pnl_trades = _pnl_trades
+        if hasattr(br, 'portfolio_combination'): self._portfolio_combination = br.portfolio_combination
 
-        self._ret_stats_pnl = RetStats()
-        self._ret_stats_pnl.calculate_ret_stats(self._pnl, br.ann_factor)
+        # other outputs are calculated from the P&L and signals when first needed
+        self._lazy = set(self.LAZY_RESULTS.keys())
 
-        self._portfolio.columns = ['Port']
-        self._ret_stats_portfolio = RetStats()
-        self._ret_stats_portfolio.calculate_ret_stats(self._portfolio, br.ann_factor)
+        if use_kernel:
+            self._cumpnl = cumpnl                                                   # individual signals cumulative P&L
+            self._lazy.discard('_cumpnl')
 
-        self._cumpnl = calculations.create_mult_index(self._pnl)                             # individual signals cumulative P&L
-        self._cumpnl.columns = pnl_cols
+        # unless we want lazy results (default in lean memory mode), calculate them all now
+        if hasattr(br, 'lazy_results'):
+            lazy_results = br.lazy_results is True
+        else:
+            lazy_results = self._lean
 
-        self._cumportfolio = calculations.create_mult_index(self._portfolio)                 # portfolio cumulative P&L
-        self._cumportfolio.columns = ['Port']
+        if not(lazy_results):
+            self._calculate_lazy_results()
 
-    def get_backtest_output(self):
-        return
+        self._lean_results()
 
-    def get_pnl(self):
-        """
-        get_pnl - Gets P&L returns
+        # keep the terminal state needed to extend the backtest with new bars later
+        length = self._get_extend_tail_length(br, asset_df.index)
 
-        Returns
-        -------
-        pandas.Dataframe
-        """
-        return self._pnl
+        if use_kernel:
+            asset_tail, signal_tail = self._get_filled_tail(asset_df, raw_signal_df, length)
+        else:
+            asset_tail, signal_tail = asset_df.iloc[-length:].copy(), raw_signal_df.iloc[-length:].copy()
 
-    def get_pnl_trades(self):
+        self._extend_state = {'asset' : asset_tail, 'signal' : signal_tail,
+                              'portfolio' : raw_portfolio.iloc[-length:].copy(), 'rows' : len(asset_df.index)}
+
+        if execution_state is not None: self._extend_state['execution'] = execution_state
+        if ex_ante_state is not None: self._extend_state['ex_ante'] = ex_ante_state
+
+    def _get_tc(self, br, asset_df):
         """
-        get_pnl_trades - Gets P&L of each individual trade per signal
+        _get_tc - Gets transaction costs, as a scalar, one per asset or an array aligned with the assets. These can be
+        given in BacktestRequest.spot_tc_bp as a scalar, list/array per asset, Series/DataFrame with a column for each
+        asset (a DataFrame is reindexed onto the asset dates and filled down), array the same shape as the asset prices
+        (which can't be used to extend a backtest) or a function of the filled down asset prices which gives one of these
+        for each date (when extending a backtest, it is only given the most recent prices)
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest
+
+        asset_df : pandas.DataFrame
+            Asset prices to be traded
 
         Returns
         -------
-        pandas.Dataframe
+        float or numpy.ndarray
         """
 
-        if self._pnl_trades is None:
-            calculations = Calculations()
-            self._pnl_trades = calculations.calculate_individual_trade_gains(self._signal, self._pnl)
+        tc = br.spot_tc_bp
 
-        return self._pnl_trades
+        # same prices when calculating and extending a backtest (where they are already filled down)
+        if callable(tc): tc = tc(asset_df.fillna(method='ffill'))
 
-    def get_pnl_desc(self):
-        """
-        get_pnl_desc - Gets P&L return statistics in a string format
+        if isinstance(tc, (pandas.DataFrame, pandas.Series)):
+            # aligned by asset name (rather than position)
+            labels = tc.columns if isinstance(tc, pandas.DataFrame) else tc.index
+            missing = [x for x in asset_df.columns if x not in labels]
 
-        Returns
-        -------
-        str
-        """
-        return self._ret_stats_signals.summary()
+            if len(missing) > 0:
+                raise Exception("Transaction costs are missing assets " + str(missing))
 
-    def get_pnl_ret_stats(self):
-        """
-        get_pnl_ret_stats - Gets P&L return statistics of individual strategies as class to be queried
+            if isinstance(tc, pandas.DataFrame):
+                tc = tc[asset_df.columns].reindex(asset_df.index, method='ffill').values
+            else:
+                tc = tc[asset_df.columns].values
 
-        Returns
-        -------
-        TimeSeriesDesc
-        """
+        tc = numpy.asarray(tc, dtype=numpy.float64)
 
-        return self._ret_stats_pnl
+        if tc.ndim == 2 and tc.shape != asset_df.shape:
+            raise Exception("Transaction costs must be the same shape as the asset prices (use a DataFrame indexed by "
+                            "date, to extend a backtest)")
 
-    def get_cumpnl(self):
+        return tc
+
+    def _get_portfolio_tc(self, tc, shape):
         """
-        get_cumpnl - Gets P&L as a cumulative time series of individual assets
+        _get_portfolio_tc - Gets transaction costs for changes in portfolio leverage, the average transaction costs of
+        the assets at each date
 
         Returns
         -------
-        pandas.DataFrame
+        float or numpy.ndarray
         """
 
-        return self._cumpnl
+        if tc.ndim == 0: return tc
 
-    def get_cumportfolio(self):
+        with numpy.errstate(invalid='ignore'):
+            tc = numpy.broadcast_to(tc, shape)
+
+            return numpy.nanmean(tc, axis=1)[:, numpy.newaxis]
+
+    def _calculate_kernel_PnL(self, br, asset_df, signal_df, pnl_cols, tc):
         """
-        get_cumportfolio - Gets P&L as a cumulative time series of portfolio
+        _calculate_kernel_PnL - Calculates P&L of signals with PnLKernel, which fills down signals over asset holidays,
+        applies leverage and transaction costs, and combines the portfolio in one pass (rather than building
+        intermediate DataFrames)
 
         Returns
         -------
-        pandas.DataFrame
+        pandas.DataFrame (signals after leverage), pandas.DataFrame (P&L), pandas.DataFrame (cumulative P&L),
+        pandas.DataFrame (portfolio), numpy.ndarray (state of execution rules, None if there are none)
         """
 
-        return self._cumportfolio
+        leverage = None
+        profiler = getattr(br, 'profiler', None)
 
-    def get_portfolio_pnl(self):
-        """
-        get_portfolio_pnl - Gets portfolio returns in raw form (ie. not indexed into cumulative form)
+        # leverage still needs returns in pandas (for rolling vol and resampling to rebalance dates)
+        if hasattr(br, 'signal_vol_adjust'):
+            if br.signal_vol_adjust is True:
+                risk_engine = RiskEngine()
 
-        Returns
-        -------
-        pandas.DataFrame
-        """
+                if not(hasattr(br, 'signal_vol_resample_type')):
+                    br.signal_vol_resample_type = 'mean'
 
-        return self._portfolio
+                if not(hasattr(br, 'signal_vol_resample_freq')):
+                    br.signal_vol_resample_freq = None
 
-    def get_portfolio_pnl_desc(self):
-        """
-        get_portfolio_pnl_desc - Gets P&L return statistics of portfolio as string
+                with profile_stage(profiler, 'leverage') as record:
+                    returns_df = Calculations().calculate_returns(asset_df.fillna(method='ffill'))
 
-        Returns
-        -------
-        pandas.DataFrame
-        """
+                    leverage_df = risk_engine.calculate_leverage_factor(returns_df, br.signal_vol_target, br.signal_vol_max_leverage,
+                                                   br.signal_vol_periods, br.signal_vol_obs_in_year,
+                                                   br.signal_vol_rebalance_freq, br.signal_vol_resample_freq,
+                                                   br.signal_vol_resample_type)
 
-        return self._ret_stats_portfolio.summary()
+                    set_stage_shape(record, leverage_df)
 
-    def get_portfolio_pnl_ret_stats(self):
-        """
-        get_portfolio_pnl_ret_stats - Gets P&L return statistics of portfolio as class to be queried
+                leverage = leverage_df.values
 
-        Returns
-        -------
-        RetStats
-        """
+                self._individual_leverage = leverage_df     # contains leverage of individual signal (before portfolio vol target)
 
-        return self._ret_stats_portfolio
+        execution_state = None
 
-    def get_individual_leverage(self):
-        """
-        get_individual_leverage - Gets leverage for each asset historically
+        # execution rules need the positions after leverage, so these are filled and levered before the kernel
+        if ExecutionRules().has_rules(br):
+            array_calculations = ArrayCalculations()
 
-        Returns
-        -------
-        pandas.DataFrame
-        """
+            signal = array_calculations.ffill(numpy.where(numpy.isnan(asset_df.values), numpy.nan, signal_df.values))
 
-        return self._individual_leverage
+            if leverage is not None: signal = signal * leverage
 
-    def get_porfolio_leverage(self):
-        """
-        get_portfolio_leverage - Gets the leverage for the portfolio
+            signal_df, execution_state = self._apply_execution_rules(
+                br, asset_df.values, pandas.DataFrame(data = signal, index = signal_df.index, columns = signal_df.columns))
 
-        Returns
-        -------
-        pandas.DataFrame
-        """
+            leverage = None
 
-        return self._portfolio_leverage
+        portfolio_combination = 'mean'
 
-    def get_porfolio_signal(self):
-        """
-        get_portfolio_signal - Gets the signals (with individual leverage & portfolio leverage) for each asset, which
-        equates to what we would trade in practice
+        if hasattr(br, 'portfolio_combination'): portfolio_combination = br.portfolio_combination
 
-        Returns
-        -------
-        DataFrame
-        """
+        with profile_stage(profiler, 'pnl') as record:
+            signal, pnl, cumpnl, portfolio = PnLKernel().calculate_signal_pnl(asset_df.values, signal_df.values,
+                                                                              leverage = leverage, tc = tc,
+                                                                              portfolio_combination = portfolio_combination)
 
-        return self._portfolio_signal
+            set_stage_shape(record, pnl)
 
-    def get_signal(self):
+        index = asset_df.index
+
+        return pandas.DataFrame(data = signal, index = index, columns = signal_df.columns), \
+               pandas.DataFrame(data = pnl, index = index, columns = pnl_cols), \
+               pandas.DataFrame(data = cumpnl, index = index, columns = pnl_cols), \
+               pandas.DataFrame(data = portfolio, index = index, columns = ['Portfolio']), execution_state
+
+    def _apply_execution_rules(self, br, asset, signal_df):
         """
-        get_signal - Gets the signals (with individual leverage, but excluding portfolio leverage) for each asset
+        _apply_execution_rules - Adjusts signals after the leverage of individual signals (but before any portfolio
+        leverage) for execution rules, so the no-trade band also skips small changes from vol targeting
 
         Returns
         -------
-        pandas.DataFrame
+        pandas.DataFrame (positions), numpy.ndarray (state of execution rules, None if there are none)
         """
 
-        return self._signal
+        execution_rules = ExecutionRules()
 
+        if not(execution_rules.has_rules(br)): return signal_df, None
 
-########################################################################################################################
+        with profile_stage(getattr(br, 'profiler', None), 'execution_rules') as record:
+            position, state = execution_rules.apply_rules(br, asset, signal_df.values)
 
-"""
-TradingModel
+            signal_df = pandas.DataFrame(data = position, index = signal_df.index, columns = signal_df.columns)
 
-Abstract class which wraps around Backtest, providing conveninent functions for analaysis. Implement your own
-subclasses of this for your own strategy. See strategyfxcta_example.py for a simple implementation of a FX trend following
-strategy.
+            set_stage_shape(record, signal_df)
 
-"""
+        return signal_df, state
 
-import abc
-import pandas
-import datetime
+    def _get_filled_tail(self, asset_df, signal_df, length):
+        """
+        _get_filled_tail - Gets the most recent bars of assets and signals, with signals masked over asset holidays and
+        both filled down (as in calculate_trading_PnL), without filling the whole history
 
-from chartpy import Chart, Style, ChartConstants
+        Returns
+        -------
+        pandas.DataFrame (assets), pandas.DataFrame (signals)
+        """
 
-from finmarketpy.economics import TechParams
-from findatapy.timeseries import Calculations, RetStats, Filter
+        asset = asset_df.values
+        signal = numpy.where(numpy.isnan(asset), numpy.nan, signal_df.values)
 
-class TradingModel(object):
+        start = len(asset_df.index) - length
 
-    #### Default parameters for outputting of results from trading model
-    SAVE_FIGURES = True
-    DEFAULT_PLOT_ENGINE = ChartConstants().chartfactory_default_engine
-    SCALE_FACTOR = ChartConstants().chartfactory_scale_factor
+        # seed the tail with the last observation before it
+        seed = []
 
-    DUMP_CSV = ''
-    DUMP_PATH = datetime.date.today().strftime("%Y%m%d") + ' '
-    chart = Chart(engine=DEFAULT_PLOT_ENGINE)
+        for values in [asset, signal]:
+            if start == 0:
+                seed.append(numpy.full(values.shape[1], numpy.nan))
+            else:
+                valid = ~numpy.isnan(values[:start])[::-1]
 
-    logger = LoggerManager().getLogger(__name__)
+                last = start - 1 - numpy.argmax(valid, axis=0)
+                seed.append(numpy.where(valid.any(axis=0), values[last, numpy.arange(values.shape[1])], numpy.nan))
 
-    def __init__(self):
-        pass
+        array_calculations = ArrayCalculations()
 
-    # to be implemented by every trading strategy
-    @abc.abstractmethod
-    def load_parameters(self):
-        """
-        load_parameters - Fills parameters for the backtest, such as start-end dates, transaction costs etc. To
-        be implemented by subclass.
-        """
-        return
+        asset = array_calculations.ffill(numpy.vstack([seed[0], asset[start:]]))[1:]
+        signal = array_calculations.ffill(numpy.vstack([seed[1], signal[start:]]))[1:]
 
-    @abc.abstractmethod
-    def load_assets(self):
-        """
-        load_assets - Loads time series for the assets to be traded and also for data for generating signals.
-        """
-        return
+        return pandas.DataFrame(data = asset, index = asset_df.index[start:], columns = asset_df.columns), \
+               pandas.DataFrame(data = signal, index = signal_df.index[start:], columns = signal_df.columns)
 
-    @abc.abstractmethod
-    def construct_signal(self, spot_df, spot_df2, tech_params):
+    def extend_trading_PnL(self, br, asset_a_df, signal_df):
         """
-        construct_signal - Constructs signal from pre-loaded time series
+        extend_trading_PnL - Extends a backtest (already calculated by calculate_trading_PnL) with new bars, giving the
+        same output as calculating the backtest again over the whole history. Only the terminal state of the backtest
+        is used: the most recent prices and signals (covering the vol window and rebalancing periods), leverage,
+        cumulative index levels and running return statistics, so the time taken is O(new bars). The Backtest can be
+        pickled to keep this state between runs.
 
         Parameters
         ----------
-        spot_df : pandas.DataFrame
-            Market time series for generating signals
+        br : BacktestRequest
+            Parameters for the backtest (should be the same as when the backtest was calculated)
 
-        spot_df2 : pandas.DataFrame
-            Market time series for generated signals (can be of different frequency)
+        asset_a_df : pandas.DataFrame
+            Asset prices to be traded (only dates after the end of the backtest are used)
 
-        tech_params : TechParams
-            Parameters for generating signals
+        signal_df : pandas.DataFrame
+            Signals for the trading strategy (only dates after the end of the backtest are used)
         """
-        return
 
-    ####### Generic functions for every backtest
-    def construct_strategy(self, br = None):
-        """
-        construct_strategy - Constructs the returns for all the strategies which have been specified.
+        calculations = Calculations()
+        state = self._extend_state
 
-        - gets parameters form fill_backtest_request
-        - market data from fill_assets
+        self._calculate_lazy_results()      # extended outputs carry on from the existing ones
 
-        """
+        asset_a_df = asset_a_df[asset_a_df.index > self._pnl.index[-1]]
+        new = len(asset_a_df.index)
 
-        calculations = Calculations()
+        if new == 0: return
 
-        # get the parameters for backtesting
-        if hasattr(self, 'br'):
-            br = self.br
-        elif br is None:
-            br = self.load_parameters()
+        # same alignment, masking and filling as calculate_trading_PnL, but carrying on from the last bars
+        asset_df, signal_df = asset_a_df.align(signal_df, join='left', axis = 'index')
 
-        # get market data for backtest
-        asset_df, spot_df, spot_df2, basket_dict = self.load_assets()
+        signal_df = signal_df.mask(numpy.isnan(asset_df.values))
+        signal_df.columns = state['signal'].columns
 
-        if hasattr(br, 'tech_params'):
-            tech_params = br.tech_params
-        else:
-            tech_params = TechParams()
+        asset_values = asset_df.values                              # before filling (for execution rules)
 
-        cumresults = pandas.DataFrame(index = asset_df.index)
-        portleverage = pandas.DataFrame(index = asset_df.index)
+        signal_df = pandas.concat([state['signal'], signal_df]).fillna(method='ffill')
+        asset_df = pandas.concat([state['asset'], asset_df]).fillna(method='ffill')
 
-        from collections import OrderedDict
-        ret_statsresults = OrderedDict()
+        returns_df = calculations.calculate_returns(asset_df)
+        tc = self._get_tc(br, asset_df)
 
-        # each portfolio key calculate returns - can put parts of the portfolio in the key
-        for key in basket_dict.keys():
-            asset_cut_df = asset_df[[x +'.close' for x in basket_dict[key]]]
-            spot_cut_df = spot_df[[x +'.close' for x in basket_dict[key]]]
+        raw_signal_df = signal_df
 
-            self.logger.info("Calculating " + key)
+        # leverage is recalculated over the recent bars only, which cover the vol window for every rebalancing date
+        # that affects the new bars
+        if hasattr(br, 'signal_vol_adjust'):
+            if br.signal_vol_adjust is True:
+                risk_engine = RiskEngine()
 
-            results, backtest = self.construct_individual_strategy(br, spot_cut_df, spot_df2, asset_cut_df, tech_params, key)
+                if not(hasattr(br, 'signal_vol_resample_type')):
+                    br.signal_vol_resample_type = 'mean'
 
-            cumresults[results.columns[0]] = results
-            portleverage[results.columns[0]] = backtest.get_porfolio_leverage()
-            ret_statsresults[key] = backtest.get_portfolio_pnl_ret_stats()
+                if not(hasattr(br, 'signal_vol_resample_freq')):
+                    br.signal_vol_resample_freq = None
 
-            # for a key, designated as the final strategy save that as the "strategy"
-            if key == self.FINAL_STRATEGY:
-                self._strategy_pnl = results
-                self._strategy_pnl_ret_stats = backtest.get_portfolio_pnl_ret_stats()
-                self._strategy_leverage = backtest.get_porfolio_leverage()
-                self._strategy_signal = backtest.get_porfolio_signal()
-                self._strategy_pnl_trades = backtest.get_pnl_trades()
+                leverage_df = risk_engine.calculate_leverage_factor(returns_df, br.signal_vol_target, br.signal_vol_max_leverage,
+                                               br.signal_vol_periods, br.signal_vol_obs_in_year,
+                                               br.signal_vol_rebalance_freq, br.signal_vol_resample_freq,
+                                               br.signal_vol_resample_type)
 
-        # get benchmark for comparison
-        benchmark = self.construct_strategy_benchmark()
+                signal_df = pandas.DataFrame(
+                    signal_df.values * leverage_df.values, index = signal_df.index, columns = signal_df.columns)
 
-        cumresults_benchmark = self.compare_strategy_vs_benchmark(br, cumresults, benchmark)
+                self._individual_leverage = pandas.concat([self._individual_leverage, leverage_df.iloc[-new:]])
 
-        self._strategy_group_benchmark_ret_stats = ret_statsresults
+        # execution rules carry on from where they were, trading from the last position they gave
+        if 'execution' in state:
+            position = signal_df.values.copy()
+            position[-new - 1] = ExecutionRules().get_position(state['execution'])
 
-        if hasattr(self, '_benchmark_ret_stats'):
+            position[-new:], state['execution'] = ExecutionRules().apply_rules(br, asset_values, position[-new:],
+                                                                               state = state['execution'])
+
+            signal_df = pandas.DataFrame(data = position, index = signal_df.index, columns = signal_df.columns)
+
+        _pnl = calculations.calculate_signal_returns_with_tc_matrix(signal_df, returns_df, tc = tc)
+        _pnl.columns = self._pnl.columns
+        _pnl = _pnl.iloc[-new:]
+
+        if hasattr(br, 'portfolio_combination') and br.portfolio_combination == 'sum':
+            portfolio = pandas.DataFrame(data = _pnl.sum(axis = 1), index = _pnl.index, columns = ['Port'])
+        else:
+            portfolio = pandas.DataFrame(data = _pnl.mean(axis = 1), index = _pnl.index, columns = ['Port'])
+
+        portfolio.columns = state['portfolio'].columns
+        raw_portfolio = pandas.concat([state['portfolio'], portfolio])
+
+        portfolio_leverage_df = pandas.DataFrame(data = numpy.ones(new), index = _pnl.index, columns = ['Port'])
+        portfolio_weights_df = None
+
+        if 'ex_ante' in state:
+            # covariance carries on from where it was
+            portfolio, portfolio_leverage_df, portfolio_weights_df, state['ex_ante'] = \
+                RiskEngine().calculate_ex_ante_portfolio(_pnl, br, tc = tc[-new:] if numpy.ndim(tc) == 2 else tc,
+                                                         state = state['ex_ante'])
+        elif hasattr(br, 'portfolio_vol_adjust'):
+            if br.portfolio_vol_adjust is True:
+                risk_engine = RiskEngine()
+
+                portfolio, portfolio_leverage_df = risk_engine.calculate_vol_adjusted_returns(
+                    raw_portfolio, br = br, tc = self._get_portfolio_tc(tc, asset_df.shape))
+
+                portfolio = portfolio.iloc[-new:]
+                portfolio_leverage_df = portfolio_leverage_df.iloc[-new:]
+
+        portfolio.columns = ['Port']
+
+        portfolio_leverage_df.columns = self._portfolio_leverage.columns
+
+        signal_df = signal_df.iloc[-new:]
+
+        length_cols = len(signal_df.columns)
+
+        if portfolio_weights_df is not None:
+            portfolio_signal = pandas.DataFrame(
+                data = signal_df.values * portfolio_weights_df.values, index = signal_df.index, columns = signal_df.columns)
+        else:
+            portfolio_signal = pandas.DataFrame(
+                data = signal_df.values * portfolio_leverage_df.values, index = signal_df.index, columns = signal_df.columns)
+
+            if not(hasattr(br, 'portfolio_combination')) or br.portfolio_combination == 'mean':
+                portfolio_signal = portfolio_signal / float(length_cols)
+
+        # return statistics and cumulative indices carry on from running accumulators
+        if 'ret_stats_pnl' not in state:
+            state['ret_stats_pnl'] = IncrementalRetStats()
+            state['ret_stats_pnl'].calculate_ret_stats(self._pnl, br.ann_factor)
+
+            state['ret_stats_portfolio'] = IncrementalRetStats()
+            state['ret_stats_portfolio'].calculate_ret_stats(self._portfolio, br.ann_factor)
+
+        cumpnl = self._extend_mult_index(self._cumpnl, state['ret_stats_pnl'], _pnl)
+        cumportfolio = self._extend_mult_index(self._cumportfolio, state['ret_stats_portfolio'], portfolio)
+
+        self._pnl = pandas.concat([self._pnl, _pnl])
+        self._portfolio = pandas.concat([self._portfolio, portfolio])
+        self._portfolio_leverage = pandas.concat([self._portfolio_leverage, portfolio_leverage_df])
+
+        if portfolio_weights_df is not None:
+            self._portfolio_weights = pandas.concat([self._portfolio_weights, portfolio_weights_df])
+        self._signal = pandas.concat([self._signal, signal_df])
+        self._portfolio_signal = pandas.concat([self._portfolio_signal, portfolio_signal])
+        self._cumpnl = cumpnl
+        self._cumportfolio = cumportfolio
+
+        self._pnl_trades = None
+        self._trades = None
+
+        if tc.ndim == 2: self._tc = numpy.vstack([self._tc, tc[-new:]])
+
+        self._ret_stats_pnl = state['ret_stats_pnl']
+        self._ret_stats_portfolio = state['ret_stats_portfolio']
+
+        # only keep the bars needed for the next extension
+        length = self._get_extend_tail_length(br, asset_df.index)
+
+        state['asset'] = asset_df.iloc[-length:].copy()
+        state['signal'] = raw_signal_df.iloc[-length:].copy()
+        state['portfolio'] = raw_portfolio.iloc[-length:].copy()
+        state['rows'] = state['rows'] + new
+
+        self._lean_results()
+
+    def _get_lazy_result(self, name):
+        """
+        _get_lazy_result - Gets an output of the backtest, calculating it first if it hasn't been needed yet
+
+        Parameters
+        ----------
+        name : str
+            Attribute of output (eg. '_cumpnl')
+        """
+
+        if name in self._lazy:
+            with profile_stage(getattr(self, '_profiler', None), name.strip('_')) as record:
+                setattr(self, name, getattr(self, self.LAZY_RESULTS[name])())
+
+                set_stage_shape(record, self._pnl)
+
+            self._lazy.discard(name)
+            self._lean_results()
+
+        return getattr(self, name)
+
+    def _lean_results(self):
+        """
+        _lean_results - In lean memory mode, stores outputs as float32 DataFrames which all share the index of the P&L
+        (rather than float64 DataFrames, each with their own index)
+        """
+
+        if not(self._lean): return
+
+        index = self._pnl.index
+
+        for name in self.LEAN_RESULTS:
+            data_frame = getattr(self, name, None)
+
+            if data_frame is None or name in self._lazy: continue
+
+            if data_frame.values.dtype != numpy.float32 or data_frame.index is not index:
+                setattr(self, name, pandas.DataFrame(data = data_frame.values.astype(numpy.float32, copy = False),
+                                                     index = index, columns = data_frame.columns, copy = False))
+
+    def _calculate_lazy_results(self):
+        for name in list(self._lazy):
+            self._get_lazy_result(name)
+
+    def _calculate_portfolio_signal(self):
+        # ex-ante portfolios have their own exposure to each signal (weight x leverage)
+        if self._portfolio_weights is not None:
+            return pandas.DataFrame(data = self._signal.values * self._portfolio_weights.values,
+                                    index = self._signal.index, columns = self._signal.columns)
+
+        # multiply portfolio leverage * individual signals to get final position signals (broadcast the leverage,
+        # rather than repeating it for every asset)
+        length_cols = len(self._signal.columns)
+        leverage = self._portfolio_leverage.values.flatten()[:, numpy.newaxis]
+
+        # final portfolio signals (including signal & portfolio leverage)
+        portfolio_signal = pandas.DataFrame(
+            data = numpy.multiply(leverage, self._signal.values),
+            index = self._signal.index, columns = self._signal.columns)
+
+        if self._portfolio_combination == 'mean':
+            portfolio_signal = portfolio_signal / float(length_cols)
+
+        return portfolio_signal
+
+    def _calculate_cumpnl(self):
+        cumpnl = Calculations().create_mult_index(self._pnl.astype(numpy.float64, copy = False))  # individual signals cumulative P&L
+        cumpnl.columns = self._pnl.columns
+
+        return cumpnl
+
+    def _calculate_cumportfolio(self):
+        if self._use_kernel:
+            return pandas.DataFrame(data = PnLKernel().create_mult_index(self._portfolio.values.astype(numpy.float64)),
+                                    index = self._portfolio.index, columns = ['Port'])
+
+        cumportfolio = Calculations().create_mult_index(self._portfolio.astype(numpy.float64, copy = False))
+        cumportfolio.columns = ['Port']
+
+        return cumportfolio
+
+    def _calculate_ret_stats_pnl(self):
+        ret_stats = RetStats()
+        ret_stats.calculate_ret_stats(self._pnl.astype(numpy.float64, copy = False), self._ann_factor)
+
+        return ret_stats
+
+    def _calculate_ret_stats_portfolio(self):
+        ret_stats = RetStats()
+        ret_stats.calculate_ret_stats(self._portfolio.astype(numpy.float64, copy = False), self._ann_factor)
+
+        return ret_stats
+
+    def _extend_mult_index(self, cum_df, ret_stats, returns_df):
+        cum_new = ret_stats.update(returns_df)
+        cum_new.columns = cum_df.columns
+
+        cum_df = pandas.concat([cum_df, cum_new])
+
+        # where first valid return is in new bars, cumulative index starts at 100 on last of the old bars
+        started = ret_stats.get_started_on_first_row()
+
+        if started.any():
+            cum_df.iloc[-len(cum_new.index) - 1, numpy.where(started)[0]] = 100.0
+
+        return cum_df
+
+    def _get_extend_tail_length(self, br, index):
+        """
+        _get_extend_tail_length - Gets the number of most recent bars needed to extend a backtest: the last bar (for
+        returns and transaction costs) and if we are vol targeting, the last complete rebalancing period (and the vol
+        window before it) and the current one
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest
+
+        index : pandas.DatetimeIndex
+            Dates of the backtest
+
+        Returns
+        -------
+        int
+        """
+
+        length = 2
+
+        # ex-ante portfolios keep the state of their covariance, rather than recalculating from recent bars
+        vols = ['signal'] if RiskEngine().is_ex_ante_portfolio(br) else ['signal', 'portfolio']
+
+        for vol in vols:
+            if getattr(br, vol + '_vol_adjust', False) is True:
+                length = max(length, self._get_rebalance_tail_length(index, getattr(br, vol + '_vol_periods'),
+                                                                     getattr(br, vol + '_vol_rebalance_freq'),
+                                                                     getattr(br, vol + '_vol_resample_freq', None)))
+
+        return min(length, len(index))
+
+    def _get_rebalance_tail_length(self, index, vol_periods, vol_rebalance_freq, vol_resample_freq=None):
+        from pandas.tseries.frequencies import to_offset
+
+        # when returns are resampled for vol, the vol window (and an extra period, which can be partial) is counted in
+        # resampled periods, and we need every bar in those periods
+        if vol_resample_freq is not None:
+            periods = pandas.Series(index, index=index).resample(vol_resample_freq).min().dropna()
+            length = min(self._get_rebalance_tail_length(pandas.DatetimeIndex(periods.index), vol_periods,
+                                                         vol_rebalance_freq) + 1, len(periods.index))
+
+            return len(index) - index.searchsorted(periods.values[-length])
+
+        offset = to_offset(vol_rebalance_freq)
+
+        # rebalancing period of each bar, from its date (so intraday bars are in the period of their day, as when
+        # resampling) by rolling back and then forward, which is the same as rollforward but for the whole index
+        dates = pandas.DatetimeIndex(index).normalize()
+        periods = (dates - offset) + offset
+
+        # find the last rebalance date (the leverage calculated there is carried forward)
+        rebalance = numpy.where(periods == dates)[0]
+
+        if len(rebalance) == 0: return len(index)
+
+        # find the start of its rebalancing period
+        start = periods.searchsorted(periods[rebalance[-1]])
+
+        # also need the vol window before, and the bar before that (which has no returns)
+        return len(index) - max(start - vol_periods - 1, 0)
+
+    def get_backtest_output(self):
+        return
+
+    def get_pnl(self):
+        """
+        get_pnl - Gets P&L returns
+
+        Returns
+        -------
+        pandas.Dataframe
+        """
+        return self._pnl
+
+    def get_pnl_trades(self):
+        """
+        get_pnl_trades - Gets P&L of each individual trade per signal, recorded on the date each trade is exited (NaN
+        elsewhere)
+
+        Returns
+        -------
+        pandas.Dataframe
+        """
+
+        if self._pnl_trades is None:
+            trades = self.get_trades()
+
+            pnl_trades = numpy.empty(self._pnl.shape)
+            pnl_trades.fill(numpy.nan)
+            pnl_trades[self._pnl.index.get_indexer(trades['exit']), trades['asset']] = trades['pnl']
+
+            self._pnl_trades = pandas.DataFrame(data = pnl_trades, index = self._pnl.index, columns = self._pnl.columns)
+            self._lean_results()
+
+        return self._pnl_trades
+
+    def get_trades(self):
+        """
+        get_trades - Gets every individual trade as a structured array with fields asset (column number of the asset in
+        get_pnl), entry date, exit date, side (1 for long, -1 for short) and pnl (compounded return of the trade, including
+        transaction costs of entering and exiting it). A new trade starts whenever a signal changes side, trades which are still open are exited on
+        the last date.
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        if self._trades is None:
+            array_calculations = ArrayCalculations()
+
+            asset, entry, exit_row, side, pnl = array_calculations.calculate_trades(self._signal.values, self._pnl.values,
+                                                                                    tc = self._tc)
+
+            dates = self._pnl.index.values
+
+            trades = numpy.empty(len(asset), dtype=[('asset', numpy.int32), ('entry', dates.dtype),
+                                                    ('exit', dates.dtype), ('side', numpy.int8),
+                                                    ('pnl', numpy.float64)])
+
+            trades['asset'] = asset
+            trades['entry'] = dates[entry]
+            trades['exit'] = dates[exit_row]
+            trades['side'] = side
+            trades['pnl'] = pnl
+
+            self._trades = trades
+
+        return self._trades
+
+    def get_pnl_desc(self):
+        """
+        get_pnl_desc - Gets P&L return statistics in a string format
+
+        Returns
+        -------
+        str
+        """
+        return self._get_lazy_result('_ret_stats_pnl').summary()
+
+    def get_pnl_ret_stats(self):
+        """
+        get_pnl_ret_stats - Gets P&L return statistics of individual strategies as class to be queried
+
+        Returns
+        -------
+        TimeSeriesDesc
+        """
+
+        return self._get_lazy_result('_ret_stats_pnl')
+
+    def get_cumpnl(self):
+        """
+        get_cumpnl - Gets P&L as a cumulative time series of individual assets
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        return self._get_lazy_result('_cumpnl')
+
+    def get_cumportfolio(self):
+        """
+        get_cumportfolio - Gets P&L as a cumulative time series of portfolio
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        return self._get_lazy_result('_cumportfolio')
+
+    def get_portfolio_pnl(self):
+        """
+        get_portfolio_pnl - Gets portfolio returns in raw form (ie. not indexed into cumulative form)
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        return self._portfolio
+
+    def get_portfolio_pnl_desc(self):
+        """
+        get_portfolio_pnl_desc - Gets P&L return statistics of portfolio as string
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        return self._get_lazy_result('_ret_stats_portfolio').summary()
+
+    def get_portfolio_pnl_ret_stats(self):
+        """
+        get_portfolio_pnl_ret_stats - Gets P&L return statistics of portfolio as class to be queried
+
+        Returns
+        -------
+        RetStats
+        """
+
+        return self._get_lazy_result('_ret_stats_portfolio')
+
+    def get_individual_leverage(self):
+        """
+        get_individual_leverage - Gets leverage for each asset historically
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        return self._individual_leverage
+
+    def get_porfolio_leverage(self):
+        """
+        get_portfolio_leverage - Gets the leverage for the portfolio
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        return self._portfolio_leverage
+
+    def get_portfolio_weights(self):
+        """
+        get_portfolio_weights - Gets the exposure to each signal in the portfolio (weight x portfolio leverage), when the
+        portfolio is combined from covariance (see RiskEngine.calculate_ex_ante_portfolio)
+
+        Returns
+        -------
+        pandas.DataFrame (None for other portfolios)
+        """
+
+        return self._portfolio_weights
+
+    def get_porfolio_signal(self):
+        """
+        get_portfolio_signal - Gets the signals (with individual leverage & portfolio leverage) for each asset, which
+        equates to what we would trade in practice
+
+        Returns
+        -------
+        DataFrame
+        """
+
+        return self._get_lazy_result('_portfolio_signal')
+
+    def get_signal(self):
+        """
+        get_signal - Gets the signals (with individual leverage, but excluding portfolio leverage) for each asset
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        return self._signal
+
+
+########################################################################################################################
+
+"""
+TradingModel
+
+Abstract class which wraps around Backtest, providing conveninent functions for analaysis. Implement your own
+subclasses of this for your own strategy. See strategyfxcta_example.py for a simple implementation of a FX trend following
+strategy.
+
+"""
+
+import abc
+import pandas
+import datetime
+import math
+
+from chartpy import Chart, Style, ChartConstants
+
+from finmarketpy.economics import TechParams
+from findatapy.timeseries import Calculations, RetStats, Filter
+from finmarketpy.backtest.executionrules import ExecutionRules
+from finmarketpy.backtest.incrementalretstats import IncrementalRetStats
+from finmarketpy.backtest.pnlkernel import PnLKernel
+from finmarketpy.util.arraycalculations import ArrayCalculations
+from finmarketpy.util.stageprofiler import profile_stage, set_stage_shape
+
+class TradingModel(object):
+
+    #### Default parameters for outputting of results from trading model
+    SAVE_FIGURES = True
+    DEFAULT_PLOT_ENGINE = ChartConstants().chartfactory_default_engine
+    SCALE_FACTOR = ChartConstants().chartfactory_scale_factor
+
+    DUMP_CSV = ''
+    DUMP_PATH = datetime.date.today().strftime("%Y%m%d") + ' '
+    chart = Chart(engine=DEFAULT_PLOT_ENGINE)
+
+    # cache for signals (eg. SignalCache()), None to always calculate signals
+    SIGNAL_CACHE = None
+
+    # records time/memory of each stage of constructing strategies (eg. StageProfiler()), None to not record
+    PROFILER = None
+
+    # BacktestRequest fields which only affect the P&L (not the signal), so are ignored when caching signals
+    PNL_ONLY_FIELDS = ['spot_tc_bp', 'ann_factor', 'portfolio_combination', 'calc_stats', 'write_csv',
+                       'pnl_kernel', 'lazy_results', 'lean_memory', 'profiler',
+                       'stop_loss', 'take_profit', 'trailing_stop', 'no_trade_band',
+                       'signal_vol_adjust', 'signal_vol_target', 'signal_vol_max_leverage', 'signal_vol_periods',
+                       'signal_vol_obs_in_year', 'signal_vol_rebalance_freq', 'signal_vol_resample_freq',
+                       'signal_vol_resample_type',
+                       'portfolio_vol_adjust', 'portfolio_vol_target', 'portfolio_vol_max_leverage',
+                       'portfolio_vol_periods', 'portfolio_vol_obs_in_year', 'portfolio_vol_rebalance_freq',
+                       'portfolio_vol_resample_freq', 'portfolio_vol_resample_type', 'portfolio_vol_ex_ante',
+                       'portfolio_vol_covariance', 'portfolio_vol_ewma_decay']
+
+    logger = LoggerManager().getLogger(__name__)
+
+    def __init__(self):
+        pass
+
+    # to be implemented by every trading strategy
+    @abc.abstractmethod
+    def load_parameters(self):
+        """
+        load_parameters - Fills parameters for the backtest, such as start-end dates, transaction costs etc. To
+        be implemented by subclass.
+        """
+        return
+
+    @abc.abstractmethod
+    def load_assets(self):
+        """
+        load_assets - Loads time series for the assets to be traded and also for data for generating signals.
+        """
+        return
+
+    @abc.abstractmethod
+    def construct_signal(self, spot_df, spot_df2, tech_params):
+        """
+        construct_signal - Constructs signal from pre-loaded time series
+
+        Parameters
+        ----------
+        spot_df : pandas.DataFrame
+            Market time series for generating signals
+
+        spot_df2 : pandas.DataFrame
+            Market time series for generated signals (can be of different frequency)
+
+        tech_params : TechParams
+            Parameters for generating signals
+        """
+        return
+
+    def construct_signal_cached(self, spot_df, spot_df2, tech_params, br):
+        """
+        construct_signal_cached - Constructs signal (see construct_signal), reusing signals in SIGNAL_CACHE which were
+        calculated from the same market data and parameters. Changes in BacktestRequest fields which only affect P&L
+        (such as transaction costs) don't cause signals to be recalculated.
+
+        Parameters
+        ----------
+        spot_df : pandas.DataFrame
+            Market time series for generating signals
+
+        spot_df2 : pandas.DataFrame
+            Market time series for generated signals (can be of different frequency)
+
+        tech_params : TechParams
+            Parameters for generating signals
+
+        br : BacktestRequest
+            Parameters for backtest
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        if self.SIGNAL_CACHE is None:
+            return self.construct_signal(spot_df, spot_df2, tech_params, br)
+
+        br_fields = {}
+
+        # strip name mangling of properties (eg. _BacktestRequest__spot_tc_bp)
+        for k, v in vars(br).items():
+            k = k.split('__')[-1] if k.startswith('_') else k
+
+            if k != 'logger' and k not in self.PNL_ONLY_FIELDS: br_fields[k] = v
+
+        key = self.SIGNAL_CACHE.get_key(type(self).__module__, type(self).__name__, spot_df, spot_df2, tech_params,
+                                        br_fields)
+
+        cached = self.SIGNAL_CACHE.get(key)
+
+        if cached is not None: return cached[0]
+
+        signal_df = self.construct_signal(spot_df, spot_df2, tech_params, br)
+
+        self.SIGNAL_CACHE.put(key, [signal_df])
+
+        return signal_df
+
+    ####### Generic functions for every backtest
+    def construct_strategy(self, br = None, pool_size = None):
+        """
+        construct_strategy - Constructs the returns for all the strategies which have been specified.
+
+        - gets parameters form fill_backtest_request
+        - market data from fill_assets
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for backtest (if the model doesn't already have them)
+
+        pool_size : int
+            Number of worker processes to calculate the baskets in parallel (None to run serially)
+        """
+
+        calculations = Calculations()
+
+        # get the parameters for backtesting
+        if hasattr(self, 'br'):
+            br = self.br
+        elif br is None:
+            br = self.load_parameters()
+
+        # backtests record their stages with the same profiler
+        if self.PROFILER is not None and getattr(br, 'profiler', None) is None: br.profiler = self.PROFILER
+
+        profiler = getattr(br, 'profiler', None)
+
+        # get market data for backtest
+        with profile_stage(profiler, 'load_assets') as record:
+            asset_df, spot_df, spot_df2, basket_dict = self.load_assets()
+
+            set_stage_shape(record, asset_df)
+
+        if hasattr(br, 'tech_params'):
+            tech_params = br.tech_params
+        else:
+            tech_params = TechParams()
+
+        from collections import OrderedDict
+        ret_statsresults = OrderedDict()
+
+        # each portfolio key calculate returns - can put parts of the portfolio in the key
+        keys = list(basket_dict.keys())
+
+        if pool_size is not None and pool_size > 1 and len(keys) > 1:
+            self.logger.info("Calculating " + str(len(keys)) + " baskets on " + str(pool_size) + " processes...")
+
+            basket_list = self._run_basket_pool(br, asset_df, spot_df, spot_df2, tech_params, basket_dict, keys,
+                                                pool_size)
+
+            # stages recorded in the worker processes
+            if profiler is not None:
+                for basket in basket_list: profiler.add_records(basket['profile'])
+        else:
+            basket_list = []
+
+            for key in keys:
+                self.logger.info("Calculating " + key)
+
+                basket_list.append(_construct_basket(self, br, asset_df, spot_df, spot_df2, tech_params, basket_dict, key))
+
+        # assemble all the baskets in one go (rather than inserting one column at a time)
+        cumresults_list = []
+        portleverage_list = []
+
+        for key, basket in zip(keys, basket_list):
+            results = basket['results']
+
+            leverage = basket['leverage'].copy()
+            leverage.columns = results.columns
+
+            cumresults_list.append(results)
+            portleverage_list.append(leverage)
+            ret_statsresults[key] = basket['ret_stats']
+
+            # for a key, designated as the final strategy save that as the "strategy"
+            if key == self.FINAL_STRATEGY:
+                self._strategy_pnl = results
+                self._strategy_pnl_ret_stats = basket['ret_stats']
+                self._strategy_leverage = basket['leverage']
+                self._strategy_signal = basket['signal']
+                self._strategy_pnl_trades = basket['pnl_trades']
+                self._strategy_trades = basket['trades']
+
+        if len(keys) > 0:
+            cumresults = pandas.concat(cumresults_list, axis = 1).reindex(asset_df.index)
+            portleverage = pandas.concat(portleverage_list, axis = 1).reindex(asset_df.index)
+        else:
+            cumresults = pandas.DataFrame(index = asset_df.index)
+            portleverage = pandas.DataFrame(index = asset_df.index)
+
+        # get benchmark for comparison
+        with profile_stage(profiler, 'benchmark'):
+            benchmark = self.construct_strategy_benchmark()
+
+            cumresults_benchmark = self.compare_strategy_vs_benchmark(br, cumresults, benchmark)
+
+        self._strategy_group_benchmark_ret_stats = ret_statsresults
+
+        if hasattr(self, '_benchmark_ret_stats'):
             ret_statslist = ret_statsresults
             ret_statslist['Benchmark'] = (self._benchmark_ret_stats)
             self._strategy_group_benchmark_ret_stats = ret_statslist
 
-        # calculate annualised returns
-        years = calculations.average_by_annualised_year(calculations.calculate_returns(cumresults_benchmark))
+        # calculate annualised returns
+        years = calculations.average_by_annualised_year(calculations.calculate_returns(cumresults_benchmark))
+
+        self._strategy_group_pnl = cumresults
+        self._strategy_group_pnl_ret_stats = ret_statsresults
+        self._strategy_group_benchmark_pnl = cumresults_benchmark
+        self._strategy_group_leverage = portleverage
+        self._strategy_group_benchmark_annualised_pnl = years
+
+    def _run_basket_pool(self, br, asset_df, spot_df, spot_df2, tech_params, basket_dict, keys, pool_size):
+        """
+        _run_basket_pool - Calculates baskets in a process pool. The trading model and market data are sent to each
+        worker process once when it starts (market data through shared memory), rather than with every basket.
+
+        Returns
+        -------
+        list(dict) (outputs of each basket, in the same order as keys)
+        """
+
+        import multiprocessing
+
+        from finmarketpy.util.sharedframe import SharedFrame
+
+        shared_frames = [SharedFrame(x) for x in [asset_df, spot_df, spot_df2]]
+
+        try:
+            pool = multiprocessing.Pool(processes = pool_size, initializer = _init_basket_worker,
+                                        initargs = (self, br, shared_frames, tech_params, basket_dict))
+
+            try:
+                # map preserves the order of the baskets
+                basket_list = pool.map(_run_basket_worker, keys, chunksize = 1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            for x in shared_frames: x.close()
+
+        return basket_list
+
+    def construct_individual_strategy(self, br, spot_df, spot_df2, asset_df, tech_params, key):
+        """
+        construct_individual_strategy - Combines the signal with asset returns to find the returns of an individual
+        strategy
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for backtest such as start and finish dates
+
+        spot_df : pandas.DataFrame
+            Market time series for generating signals
+
+        spot_df2 : pandas.DataFrame
+            Secondary Market time series for generated signals (can be of different frequency)
+
+        tech_params : TechParams
+            Parameters for generating signals
+
+        Returns
+        -------
+        cumportfolio : pandas.DataFrame
+        backtest : Backtest
+        """
+        backtest = Backtest()
+        profiler = getattr(br, 'profiler', None)
+
+        with profile_stage(profiler, 'construct_signal') as record:
+            signal_df = self.construct_signal_cached(spot_df, spot_df2, tech_params, br)   # get trading signal
+
+            set_stage_shape(record, signal_df)
+
+        backtest.calculate_trading_PnL(br, asset_df, signal_df)            # calculate P&L
+
+        # only calculate cumulative P&L of individual assets when we need to write it
+        if br.write_csv: backtest.get_cumpnl().to_csv(self.DUMP_CSV + key + ".csv")
+
+        cumportfolio = backtest.get_cumportfolio()
+
+        if br.calc_stats:
+            cumportfolio.columns = [key + ' ' + str(backtest.get_portfolio_pnl_desc()[0])]
+        else:
+            cumportfolio.columns = [key]
+
+        return cumportfolio, backtest
+
+    def compare_strategy_vs_benchmark(self, br, strategy_df, benchmark_df):
+        """
+        compare_strategy_vs_benchmark - Compares the trading strategy we are backtesting against a benchmark
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for backtest such as start and finish dates
+
+        strategy_df : pandas.DataFrame
+            Strategy time series
+
+        benchmark_df : pandas.DataFrame
+            Benchmark time series
+        """
+
+        include_benchmark = False
+        calc_stats = False
+
+        if hasattr(br, 'include_benchmark'): include_benchmark = br.include_benchmark
+        if hasattr(br, 'calc_stats'): calc_stats = br.calc_stats
+
+        if include_benchmark:
+            ret_stats = RetStats()
+            risk_engine = RiskEngine()
+            filter = Filter()
+            calculations = Calculations()
+
+            # align strategy time series with that of benchmark
+            strategy_df, benchmark_df = strategy_df.align(benchmark_df, join='left', axis = 0)
+
+            # if necessary apply vol target to benchmark (to make it comparable with strategy)
+            if hasattr(br, 'portfolio_vol_adjust'):
+                if br.portfolio_vol_adjust is True:
+                    benchmark_df = risk_engine.calculate_vol_adjusted_index_from_prices(benchmark_df, br = br)
+
+            # only calculate return statistics if this has been specified (note when different frequencies of data
+            # might underrepresent vol
+            if calc_stats:
+                benchmark_df = benchmark_df.fillna(method='ffill')
+                ret_stats.calculate_ret_stats_from_prices(benchmark_df, br.ann_factor)
+                benchmark_df.columns = ret_stats.summary()
+
+            # realign strategy & benchmark
+            strategy_benchmark_df = strategy_df.join(benchmark_df, how='inner')
+            strategy_benchmark_df = strategy_benchmark_df.fillna(method='ffill')
+
+            strategy_benchmark_df = filter.filter_time_series_by_date(br.plot_start, br.finish_date, strategy_benchmark_df)
+            strategy_benchmark_df = calculations.create_mult_index_from_prices(strategy_benchmark_df)
+
+            self._benchmark_pnl = benchmark_df
+            self._benchmark_ret_stats = ret_stats
+
+            return strategy_benchmark_df
+
+        return strategy_df
+
+    def get_strategy_name(self):
+        return self.FINAL_STRATEGY
+
+    def get_individual_leverage(self):
+        return self._individual_leverage
+
+    def get_strategy_group_pnl_trades(self):
+        return self._strategy_pnl_trades
+
+    def get_strategy_trades(self):
+        return self._strategy_trades
+
+    def get_strategy_pnl(self):
+        return self._strategy_pnl
+
+    def get_strategy_pnl_ret_stats(self):
+        return self._strategy_pnl_ret_stats
+
+    def get_strategy_leverage(self):
+        return self._strategy_leverage
+
+    def get_strategy_group_benchmark_pnl(self):
+        return self._strategy_group_benchmark_pnl
+
+    def get_strategy_group_benchmark_ret_stats(self):
+        return self._strategy_group_benchmark_ret_stats
+
+    def get_strategy_leverage(self):
+        return self._strategy_group_leverage
+
+    def get_strategy_signal(self):
+        return self._strategy_signal
+
+    def get_benchmark(self):
+        return self._benchmark_pnl
+
+    def get_benchmark_ret_stats(self):
+        return self._benchmark_ret_stats
+
+    def get_strategy_group_benchmark_annualised_pnl(self):
+        return self._strategy_group_benchmark_annualised_pnl
+
+    #### Plotting
+
+    def reduce_plot(self, data_frame):
+        """
+        reduce_plot - Reduces the frequency of a time series to every business day so it can be plotted more easily
+
+        Parameters
+        ----------
+        data_frame: pandas.DataFrame
+            Strategy time series
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        try:
+            # make plots on every business day (will downsample intraday data)
+            data_frame = data_frame.resample('B')
+            data_frame = data_frame.fillna(method='pad')
+
+            return data_frame
+        except:
+            return data_frame
+
+    ##### Quick helper functions to plot aspects of the strategy such as P&L, leverage etc.
+    def plot_individual_leverage(self):
+
+        style = self.create_style("Leverage", "Individual Leverage")
+
+        try:
+            self._plot_chart(self.reduce_plot(self._individual_leverage), chart_type='line', style=style)
+        except: pass
+
+    def plot_strategy_group_pnl_trades(self):
+
+        style = self.create_style("(bp)", "Individual Trade PnL")
+
+        # zero when there isn't a trade exit
+        # strategy_pnl_trades = self._strategy_pnl_trades * 100 * 100
+        # strategy_pnl_trades = strategy_pnl_trades.dropna()
+
+        # note only works with single large basket trade
+        try:
+            strategy_pnl_trades = self._strategy_pnl_trades.fillna(0) * 100 * 100
+            self._plot_chart(self.reduce_plot(strategy_pnl_trades), chart_type='line', style=style)
+        except: pass
+
+    def plot_strategy_pnl(self):
+
+        style = self.create_style("", "Strategy PnL")
+
+        try:
+            self._plot_chart(self.reduce_plot(self._strategy_pnl), chart_type='line', style=style)
+        except: pass
+
+    def plot_strategy_signal_proportion(self, strip = None):
+
+        signal = self._strategy_signal
+
+        # count number of long, short and flat periods in our sample
+        long = signal[signal > 0].count()
+        short = signal[signal < 0].count()
+        flat = signal[signal == 0].count()
+
+        keys = long.index
+
+        # how many trades have there been (ignore size of the trades)
+        trades = abs(signal - signal.shift(-1))
+        trades = trades[trades > 0].count()
+
+        df_trades = pandas.DataFrame(index = keys, columns = ['Trades'], data = trades)
+
+        df = pandas.DataFrame(index = keys, columns = ['Long', 'Short', 'Flat'])
+
+        df['Long'] = long
+        df['Short']  = short
+        df['Flat'] = flat
+
+        if strip is not None: keys = [k.replace(strip, '') for k in keys]
+
+        df.index = keys
+        df_trades.index = keys
+        # df = df.sort_index()
+
+        style = self.create_style("", "")
+
+        try:
+            style.file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Strategy signal proportion).png'
+            style.html_file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Strategy signal proportion).html'
+            self._plot_chart(self.reduce_plot(df), chart_type='bar', style=style)
+
+            style.file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Strategy trade no).png'
+            style.html_file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Strategy trade no).html'
+            self._plot_chart(self.reduce_plot(df_trades), chart_type='bar', style=style)
+
+        except: pass
+
+    def plot_strategy_leverage(self):
+        style = self.create_style("Leverage", "Strategy Leverage")
+
+        try:
+            self._plot_chart(self.reduce_plot(self._strategy_leverage), chart_type='line', style=style)
+        except: pass
+
+    def plot_strategy_group_benchmark_pnl(self, strip = None):
+
+        style = self.create_style("", "Group Benchmark PnL - cumulative")
+
+        strat_list = self._strategy_group_benchmark_pnl.columns #.sort_values()
+
+        for line in strat_list:
+            self.logger.info(line)
+
+        # plot cumulative line of returns
+        self._plot_chart(self.reduce_plot(self._strategy_group_benchmark_pnl), style=style)
+
+        # needs write stats flag turned on
+        try:
+            keys = self._strategy_group_benchmark_ret_stats.keys()
+            ir = []
+
+            for key in keys: ir.append(self._strategy_group_benchmark_ret_stats[key].inforatio()[0])
+
+            if strip is not None: keys = [k.replace(strip, '') for k in keys]
+
+            ret_stats = pandas.DataFrame(index = keys, data = ir, columns = ['IR'])
+            # ret_stats = ret_stats.sort_index()
+            style.file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Group Benchmark PnL - IR) ' + style.SCALE_FACTOR + '.png'
+            style.html_file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Group Benchmark PnL - IR) ' + style.SCALE_FACTOR + '.html'
+            style.display_brand_label = False
+
+            self._plot_chart(ret_stats, chart_type='bar', style=style)
+
+        except: pass
+
+    def plot_strategy_group_benchmark_annualised_pnl(self, cols = None):
+        # TODO - unfinished, needs checking!
+
+        if cols is None: cols = self._strategy_group_benchmark_annualised_pnl.columns
+
+        style = self.create_style("", "Group Benchmark Annualised PnL")
+        style.color = ['red', 'blue', 'purple', 'gray', 'yellow', 'green', 'pink']
+
+        self._plot_chart(self.reduce_plot(self._strategy_group_benchmark_annualised_pnl[cols]), chart_type='line', style=style)
+
+
+    def plot_strategy_group_leverage(self):
+
+        style = self.create_style("Leverage", "Group Leverage")
+        self._plot_chart(self.reduce_plot(self._strategy_group_leverage), chart_type='line', style=style)
+
+    def plot_strategy_signals(self, date = None, strip = None):
+
+        ######## plot signals
+        strategy_signal = self._strategy_signal
+        strategy_signal = 100 * (strategy_signal)
+
+        if date is None:
+            last_day = strategy_signal.ix[-1].transpose().to_frame()
+        else:
+            last_day = strategy_signal.ix[date].transpose().to_frame()
+
+        if strip is not None:
+            last_day.index = [x.replace(strip, '') for x in last_day.index]
+
+        style = self.create_style("positions (% portfolio notional)", "Positions")
+        self._plot_chart(last_day, chart_type='bar', style=style)
+
+    def _plot_chart(self, data_frame, **kwargs):
+        # record plotting as a stage (if we have a profiler)
+        with profile_stage(self.PROFILER, 'chart') as record:
+            self.chart.plot(data_frame, **kwargs)
+
+            set_stage_shape(record, data_frame)
+
+    def create_style(self, title, file_add):
+        style = Style()
+
+        style.title = self.FINAL_STRATEGY + " " + title
+        style.display_legend = True
+        style.scale_factor = self.SCALE_FACTOR
+
+        if self.DEFAULT_PLOT_ENGINE not in ['plotly', 'cufflinks'] and self.SAVE_FIGURES:
+            style.file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (' + file_add + ') ' + str(style.scale_factor) + '.png'
+
+        style.html_file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (' + file_add + ') ' + str(style.scale_factor) + '.html'
+
+        try:
+            style.silent_display = self.SILENT_DISPLAY
+        except: pass
+
+        return style
+
+#######################################################################################################################
+
+"""
+RiskEngine
+
+Adjusts signal weighting according to risk constraints (volatility targeting)
+
+"""
+
+class RiskEngine(object):
+
+    # portfolio combinations which are weighted by risk (so need covariance)
+    RISK_WEIGHTS = ['inverse-vol', 'risk-parity']
+
+    def calculate_vol_adjusted_index_from_prices(self, prices_df, br):
+        """
+        calculate_vol_adjusted_index_from_price - Adjusts an index of prices for a vol target
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest specifying start date, finish data, transaction costs etc.
+
+        asset_a_df : pandas.DataFrame
+            Asset prices to be traded
 
-        self._strategy_group_pnl = cumresults
-        self._strategy_group_pnl_ret_stats = ret_statsresults
-        self._strategy_group_benchmark_pnl = cumresults_benchmark
-        self._strategy_group_leverage = portleverage
-        self._strategy_group_benchmark_annualised_pnl = years
+        Returns
+        -------
+        pandas.Dataframe containing vol adjusted index
+        """
 
-    def construct_individual_strategy(self, br, spot_df, spot_df2, asset_df, tech_params, key):
+        calculations = Calculations()
+
+        returns_df, leverage_df = self.calculate_vol_adjusted_returns(prices_df, br, returns=False)
+
+        return calculations.create_mult_index(returns_df)
+
+    def calculate_vol_adjusted_returns(self, returns_df, br, returns=True, tc=None):
         """
-        construct_individual_strategy - Combines the signal with asset returns to find the returns of an individual
-        strategy
+        calculate_vol_adjusted_returns - Adjusts returns for a vol target
 
         Parameters
         ----------
         br : BacktestRequest
-            Parameters for backtest such as start and finish dates
-
-        spot_df : pandas.DataFrame
-            Market time series for generating signals
+            Parameters for the backtest specifying start date, finish data, transaction costs etc.
 
-        spot_df2 : pandas.DataFrame
-            Secondary Market time series for generated signals (can be of different frequency)
+        returns_a_df : pandas.DataFrame
+            Asset returns to be traded
 
-        tech_params : TechParams
-            Parameters for generating signals
+        tc : float or numpy.ndarray
+            Transaction costs for changes in leverage, aligned with returns (by default br.spot_tc_bp)
 
         Returns
         -------
-        cumportfolio : pandas.DataFrame
-        backtest : Backtest
+        pandas.DataFrame
         """
-        backtest = Backtest()
 
-        signal_df = self.construct_signal(spot_df, spot_df2, tech_params, br)   # get trading signal
-        backtest.calculate_trading_PnL(br, asset_df, signal_df)            # calculate P&L
+        calculations = Calculations()
 
-        cumpnl = backtest.get_cumpnl()
+        if not returns: returns_df = calculations.calculate_returns(returns_df)
 
-        if br.write_csv: cumpnl.to_csv(self.DUMP_CSV + key + ".csv")
+        if not (hasattr(br, 'portfolio_vol_resample_type')):
+            br.portfolio_vol_resample_type = 'mean'
 
-        cumportfolio = backtest.get_cumportfolio()
+        if not (hasattr(br, 'portfolio_vol_resample_freq')):
+            br.portfolio_vol_resample_freq = None
 
-        if br.calc_stats:
-            cumportfolio.columns = [key + ' ' + str(backtest.get_portfolio_pnl_desc()[0])]
+        leverage_df = self.calculate_leverage_factor(returns_df,
+                                                     br.portfolio_vol_target, br.portfolio_vol_max_leverage,
+                                                     br.portfolio_vol_periods, br.portfolio_vol_obs_in_year,
+                                                     br.portfolio_vol_rebalance_freq, br.portfolio_vol_resample_freq,
+                                                     br.portfolio_vol_resample_type)
+
+        if tc is None: tc = br.spot_tc_bp
+
+        if hasattr(br, 'pnl_kernel') and br.pnl_kernel is True:
+            vol_returns_df = pandas.DataFrame(
+                data = PnLKernel().calculate_signal_returns_with_tc(leverage_df.values, returns_df.values, tc=tc),
+                index = returns_df.index, columns = returns_df.columns)
         else:
-            cumportfolio.columns = [key]
+            vol_returns_df = calculations.calculate_signal_returns_with_tc_matrix(leverage_df, returns_df, tc=tc)
+            vol_returns_df.columns = returns_df.columns
 
-        return cumportfolio, backtest
+        return vol_returns_df, leverage_df
 
-    def compare_strategy_vs_benchmark(self, br, strategy_df, benchmark_df):
+    def is_ex_ante_portfolio(self, br):
         """
-        compare_strategy_vs_benchmark - Compares the trading strategy we are backtesting against a benchmark
+        is_ex_ante_portfolio - Does a BacktestRequest need the portfolio combined from the covariance of signal returns
+        (ex-ante vol targeting with portfolio_vol_ex_ante, or 'inverse-vol'/'risk-parity' portfolio_combination)?
 
         Parameters
         ----------
         br : BacktestRequest
-            Parameters for backtest such as start and finish dates
+            Parameters for the backtest
 
-        strategy_df : pandas.DataFrame
-            Strategy time series
+        Returns
+        -------
+        bool
+        """
 
-        benchmark_df : pandas.DataFrame
-            Benchmark time series
+        if getattr(br, 'portfolio_combination', 'mean') in self.RISK_WEIGHTS: return True
+
+        return getattr(br, 'portfolio_vol_adjust', False) is True and getattr(br, 'portfolio_vol_ex_ante', False) is True
+
+    def calculate_ex_ante_portfolio(self, pnl_df, br, tc=0.0, state=None):
         """
+        calculate_ex_ante_portfolio - Combines the P&L of individual signals into a portfolio, using the covariance of
+        their returns up to each rebalance date (updated incrementally with CovarianceEstimator, 'rolling' over
+        portfolio_vol_periods or 'ewma' with portfolio_vol_ewma_decay, set by portfolio_vol_covariance). Weights are
+        equal ('mean' or 'sum'), inversely proportional to vol ('inverse-vol') or have equal risk contributions
+        ('risk-parity'). If portfolio_vol_adjust is set, the portfolio is levered so its ex-ante vol, sqrt(w' cov w), is
+        portfolio_vol_target (capped at portfolio_vol_max_leverage). Transaction costs are charged on changes in the
+        exposure to each signal.
 
-        include_benchmark = False
-        calc_stats = False
+        Parameters
+        ----------
+        pnl_df : pandas.DataFrame
+            P&L of individual signals
 
-        if hasattr(br, 'include_benchmark'): include_benchmark = br.include_benchmark
-        if hasattr(br, 'calc_stats'): calc_stats = br.calc_stats
+        br : BacktestRequest
+            Parameters for the backtest
 
-        if include_benchmark:
-            ret_stats = RetStats()
-            risk_engine = RiskEngine()
-            filter = Filter()
-            calculations = Calculations()
+        tc : float or numpy.ndarray
+            Transaction costs, which must broadcast against (time x signals)
 
-            # align strategy time series with that of benchmark
-            strategy_df, benchmark_df = strategy_df.align(benchmark_df, join='left', axis = 0)
+        state : dict
+            State at the end of earlier bars (None to start from scratch)
 
-            # if necessary apply vol target to benchmark (to make it comparable with strategy)
-            if hasattr(br, 'portfolio_vol_adjust'):
-                if br.portfolio_vol_adjust is True:
-                    benchmark_df = risk_engine.calculate_vol_adjusted_index_from_prices(benchmark_df, br = br)
+        Returns
+        -------
+        pandas.DataFrame (portfolio), pandas.DataFrame (portfolio leverage), pandas.DataFrame (exposure to each signal,
+        ie. weight x leverage), dict (state at the end)
+        """
 
-            # only calculate return statistics if this has been specified (note when different frequencies of data
-            # might underrepresent vol
-            if calc_stats:
-                benchmark_df = benchmark_df.fillna(method='ffill')
-                ret_stats.calculate_ret_stats_from_prices(benchmark_df, br.ann_factor)
-                benchmark_df.columns = ret_stats.summary()
+        from finmarketpy.backtest.covarianceestimator import CovarianceEstimator
 
-            # realign strategy & benchmark
-            strategy_benchmark_df = strategy_df.join(benchmark_df, how='inner')
-            strategy_benchmark_df = strategy_benchmark_df.fillna(method='ffill')
+        portfolio_combination = getattr(br, 'portfolio_combination', 'mean')
+        vol_adjust = getattr(br, 'portfolio_vol_adjust', False) is True
 
-            strategy_benchmark_df = filter.filter_time_series_by_date(br.plot_start, br.finish_date, strategy_benchmark_df)
-            strategy_benchmark_df = calculations.create_mult_index_from_prices(strategy_benchmark_df)
+        pnl = pnl_df.values.astype(numpy.float64)
+        rows, cols = pnl.shape
 
-            self._benchmark_pnl = benchmark_df
-            self._benchmark_ret_stats = ret_stats
+        if state is None:
+            estimator = CovarianceEstimator(method=getattr(br, 'portfolio_vol_covariance', 'rolling'),
+                                            periods=getattr(br, 'portfolio_vol_periods', 60),
+                                            ewma_decay=getattr(br, 'portfolio_vol_ewma_decay', 0.94),
+                                            obs_in_year=getattr(br, 'portfolio_vol_obs_in_year', 252))
 
-            return strategy_benchmark_df
+            state = {'estimator' : estimator, 'weights' : None, 'leverage' : numpy.nan,
+                     'exposure' : numpy.full(cols, numpy.nan), 'pnl' : numpy.full(cols, numpy.nan)}
 
-        return strategy_df
+        estimator = state['estimator']
 
-    def get_strategy_name(self):
-        return self.FINAL_STRATEGY
+        last_exposure = state['exposure']
+        last_leverage = state['leverage']
 
-    def get_individual_leverage(self):
-        return self._individual_leverage
+        rebalance_freq = getattr(br, 'portfolio_vol_rebalance_freq', 'BM')
 
-    def get_strategy_group_pnl_trades(self):
-        return self._strategy_pnl_trades
+        if rebalance_freq is None:
+            rebalance = numpy.arange(rows)
+        else:
+            rebalance = self._get_rebalance_rows(pnl_df.index, rebalance_freq)
 
-    def get_strategy_pnl(self):
-        return self._strategy_pnl
+        # without any rebalance dates (eg. less than one rebalancing period of data), there are never any weights
+        if rows > 0 and len(rebalance) == 0 and state['weights'] is None:
+            LoggerManager().getLogger(__name__).warning(
+                "No portfolio rebalance dates for frequency " + str(rebalance_freq) + ", so portfolio has no exposure")
 
-    def get_strategy_pnl_ret_stats(self):
-        return self._strategy_pnl_ret_stats
+        exposure = numpy.empty((len(rebalance), cols))
+        leverage = numpy.empty(len(rebalance))
 
-    def get_strategy_leverage(self):
-        return self._strategy_leverage
+        start = 0
+        singular = False
 
-    def get_strategy_group_benchmark_pnl(self):
-        return self._strategy_group_benchmark_pnl
+        # covariance is only needed on rebalance dates, so it is updated with every row since the last one in one go
+        for i in range(0, len(rebalance)):
+            estimator.update(pnl[start:rebalance[i] + 1])
+            start = rebalance[i] + 1
 
-    def get_strategy_group_benchmark_ret_stats(self):
-        return self._strategy_group_benchmark_ret_stats
+            if estimator.is_ready():
+                cov = estimator.get_covariance()
 
-    def get_strategy_leverage(self):
-        return self._strategy_group_leverage
+                combination = portfolio_combination
 
-    def get_strategy_signal(self):
-        return self._strategy_signal
+                # covariance from no more returns than assets is singular, so risk parity may have no solution
+                if combination == 'risk-parity' and estimator.get_observations() <= cols:
+                    if not(singular):
+                        LoggerManager().getLogger(__name__).warning(
+                            "Risk parity needs covariance from more returns than assets, using inverse vol weights")
+
+                        singular = True
+
+                    combination = 'inverse-vol'
+
+                weights = self.calculate_portfolio_weights(cov, combination, weights=state['weights'])
+
+                lev = 1.0
+
+                if vol_adjust:
+                    with numpy.errstate(divide='ignore', invalid='ignore'):
+                        lev = br.portfolio_vol_target / numpy.sqrt(max(numpy.dot(weights, numpy.dot(cov, weights)), 0.0))
+
+                    if not(lev <= br.portfolio_vol_max_leverage): lev = br.portfolio_vol_max_leverage
+
+                state['weights'] = weights
+                state['leverage'] = lev
+                state['exposure'] = weights * lev
+
+            exposure[i] = state['exposure']
+            leverage[i] = state['leverage']
+
+        estimator.update(pnl[start:])
+
+        # carry forward from each rebalance date to the next (and from the earlier bars before the first)
+        counts = numpy.diff(numpy.concatenate([[0], rebalance, [rows]]))
+
+        exposure = numpy.repeat(numpy.vstack([last_exposure, exposure]), counts, axis=0)
+        leverage = numpy.repeat(numpy.concatenate([[last_leverage], leverage]), counts)
+
+        # P&L of the exposure to each signal (carrying on from the last bar) summed into the portfolio
+        tc = numpy.broadcast_to(numpy.asarray(tc, dtype=numpy.float64), (rows, cols))
+
+        returns = PnLKernel().calculate_signal_returns_with_tc(numpy.vstack([last_exposure, exposure]),
+                                                               numpy.vstack([state['pnl'], pnl]),
+                                                               tc=numpy.vstack([tc[:1], tc]))[1:]
+
+        portfolio = ArrayCalculations().combine_portfolio(returns, 'sum', axis=1)
+
+        if rows > 0: state['pnl'] = pnl[-1]
+
+        return pandas.DataFrame(data=portfolio, index=pnl_df.index, columns=['Portfolio']), \
+               pandas.DataFrame(data=leverage, index=pnl_df.index, columns=['Portfolio']), \
+               pandas.DataFrame(data=exposure, index=pnl_df.index, columns=pnl_df.columns), state
+
+    def calculate_portfolio_weights(self, cov, portfolio_combination='mean', weights=None):
+        """
+        calculate_portfolio_weights - Calculates portfolio weights from a covariance matrix. Assets without any variance
+        (eg. signals which haven't started) get no weight in 'inverse-vol' and 'risk-parity' portfolios
+
+        Parameters
+        ----------
+        cov : numpy.ndarray
+            Covariance matrix of asset returns
+
+        portfolio_combination : str
+            'mean' (equal weights summing to one), 'sum' (weights of one), 'inverse-vol' (weights proportional to 1 /
+            vol) or 'risk-parity' (equal contributions to portfolio vol), all except 'sum' add up to one
+
+        weights : numpy.ndarray
+            Previous weights (starting point for 'risk-parity')
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        cols = cov.shape[0]
+
+        if portfolio_combination == 'sum':
+            return numpy.ones(cols)
+
+        if portfolio_combination not in self.RISK_WEIGHTS:
+            return numpy.full(cols, 1.0 / cols)
+
+        var = numpy.diag(cov).copy()
+        valid = var > 0
+
+        weights_out = numpy.zeros(cols)
+
+        if not(valid.any()): return weights_out
+
+        vol = numpy.sqrt(var[valid])
+
+        if portfolio_combination == 'inverse-vol':
+            weights_out[valid] = (1.0 / vol) / numpy.sum(1.0 / vol)
+        else:
+            start = None
+
+            if weights is not None and (weights[valid] > 0).all(): start = weights[valid]
+
+            weights_out[valid] = self._calculate_risk_parity_weights(cov[numpy.ix_(valid, valid)], start)
+
+        return weights_out
+
+    def _calculate_risk_parity_weights(self, cov, weights=None, max_iterations=500, tolerance=1e-9):
+        """
+        _calculate_risk_parity_weights - Calculates weights which give every asset the same contribution to portfolio
+        vol, normalised to add up to one. Solves w_i (cov w)_i = 1 / n for every asset at once (a damped Jacobi version
+        of cyclical coordinate descent, where each iteration is one matrix vector product), falling back to Newton's
+        method on the equivalent convex problem if that doesn't converge (eg. for ill conditioned covariance estimated
+        from fewer periods than assets), and to inverse vol weights if there is no solution
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        var = numpy.diag(cov)
+        budget = 1.0 / len(var)
+
+        # start from inverse vol weights (or the previous weights), scaled so the portfolio has unit variance
+        if weights is None: weights = 1.0 / numpy.sqrt(var)
+
+        start = weights / math.sqrt(numpy.dot(weights, numpy.dot(cov, weights)))
+        weights = start
+
+        with numpy.errstate(over='ignore', invalid='ignore'):
+            for i in range(0, max_iterations):
+                # each weight solves var_i w_i^2 + c_i w_i - budget = 0, where c_i is its covariance with other assets
+                c = numpy.dot(cov, weights) - var * weights
+
+                new_weights = 0.5 * (weights + (-c + numpy.sqrt(c * c + 4.0 * var * budget)) / (2.0 * var))
+
+                if not(numpy.isfinite(new_weights).all()): break
+
+                weights = new_weights
+
+                if numpy.max(numpy.abs(c + var * weights - budget / weights)) <= tolerance * numpy.max(budget / weights):
+                    return weights / numpy.sum(weights)
+
+        # Newton's method minimising w' cov w / 2 - budget * sum(log(w)), whose minimum has equal risk contributions
+        weights = start
+
+        for i in range(0, 20):
+            gradient = numpy.dot(cov, weights) - budget / weights
+            step = numpy.linalg.solve(cov + numpy.diag(budget / (weights * weights)), gradient)
+
+            # don't let weights go negative
+            scale = 1.0
+
+            while (weights - scale * step <= 0).any(): scale = scale * 0.5
+
+            weights = weights - scale * step
+
+            if numpy.max(numpy.abs(scale * step)) <= tolerance * numpy.max(weights):
+                return weights / numpy.sum(weights)
+
+        # there may be no solution if covariance is singular (eg. from fewer periods than assets)
+        LoggerManager().getLogger(__name__).warning("Risk parity weights didn't converge, using inverse vol weights")
+
+        return (1.0 / numpy.sqrt(var)) / numpy.sum(1.0 / numpy.sqrt(var))
+
+    def calculate_leverage_factor(self, returns_df, vol_target, vol_max_leverage, vol_periods=60, vol_obs_in_year=252,
+                                  vol_rebalance_freq='BM', data_resample_freq=None, data_resample_type='mean',
+                                  returns=True, period_shift=0):
+        """
+        calculate_leverage_factor - Calculates the time series of leverage for a specified vol target
+
+        Parameters
+        ----------
+        returns_df : DataFrame
+            Asset returns
+
+        vol_target : float
+            vol target for assets
+
+        vol_max_leverage : float
+            maximum leverage allowed
+
+        vol_periods : int
+            number of periods to calculate volatility
+
+        vol_obs_in_year : int
+            number of observations in the year
+
+        vol_rebalance_freq : str
+            how often to rebalance
+
+        data_resample_freq : str
+            frequency to resample returns to before calculating vol (eg. 'B' for intraday data, in which case
+            vol_periods and vol_obs_in_year are for the resampled data), None to use returns as they are
+
+        data_resample_type : str
+            how to resample leverage to rebalance dates (eg. 'mean'), 'last' uses the last leverage in each rebalancing
+            period (usually on the rebalance date), which only calculates vol near rebalance dates (much quicker for
+            intraday data). If there's no bar on a rebalance date, 'last' uses the bar before it
+
+        returns : boolean
+            is this returns time series or prices?
+
+        period_shift : int
+            should we delay the signal by a number of periods?
+
+        Returns
+        -------
+        pandas.Dataframe
+        """
+
+        calculations = Calculations()
+        filter = Filter()
+
+        if not returns: returns_df = calculations.calculate_returns(returns_df)
+
+        if data_resample_freq is not None:
+            return self._calculate_resampled_leverage_factor(returns_df, vol_target, vol_max_leverage, vol_periods,
+                                                             vol_obs_in_year, vol_rebalance_freq, data_resample_freq,
+                                                             data_resample_type, period_shift)
+
+        if data_resample_type == 'last' and period_shift == 0:
+            return self._calculate_rebalance_leverage_factor(returns_df, vol_target, vol_max_leverage, vol_periods,
+                                                             vol_obs_in_year, vol_rebalance_freq)
+
+        roll_vol_df = calculations.rolling_volatility(returns_df,
+                                                      periods=vol_periods, obs_in_year=vol_obs_in_year).shift(
+            period_shift)
+
+        # calculate the leverage as function of vol target (with max lev constraint)
+        lev_df = vol_target / roll_vol_df
+        lev_df[lev_df > vol_max_leverage] = vol_max_leverage
+
+        lev_df = filter.resample_time_series_frequency(lev_df, vol_rebalance_freq, data_resample_type)
+
+        returns_df, lev_df = returns_df.align(lev_df, join='left', axis=0)
+
+        lev_df = lev_df.fillna(method='ffill')
+        lev_df.ix[0:vol_periods] = numpy.nan  # ignore the first elements before the vol window kicks in
+
+        return lev_df
+
+    def _get_rebalance_rows(self, index, rebalance_freq):
+        """
+        _get_rebalance_rows - Gets the rows of the rebalance dates (on the rebalance frequency, eg. the last business day
+        of each month for 'BM') in an index, the last bar on or before each rebalance date (so for intraday data, the
+        last bar of the rebalance date)
+
+        Returns
+        -------
+        numpy.ndarray
+        """
 
-    def get_benchmark(self):
-        return self._benchmark_pnl
+        if len(index) == 0: return numpy.zeros(0, dtype=int)
 
-    def get_benchmark_ret_stats(self):
-        return self._benchmark_ret_stats
+        dates = pandas.DatetimeIndex(index).normalize()
 
-    def get_strategy_group_benchmark_annualised_pnl(self):
-        return self._strategy_group_benchmark_annualised_pnl
+        rows = dates.searchsorted(pandas.date_range(dates[0], dates[-1], freq=rebalance_freq), side='right') - 1
 
-    #### Plotting
+        return numpy.unique(rows[rows >= 0])
 
-    def reduce_plot(self, data_frame):
+    def _calculate_rebalance_leverage_factor(self, returns_df, vol_target, vol_max_leverage, vol_periods,
+                                             vol_obs_in_year, vol_rebalance_freq):
         """
-        reduce_plot - Reduces the frequency of a time series to every business day so it can be plotted more easily
-
-        Parameters
-        ----------
-        data_frame: pandas.DataFrame
-            Strategy time series
+        _calculate_rebalance_leverage_factor - Calculates leverage on rebalance dates only (the last bar on or before
+        each date on the rebalance frequency) and carries it forward, without calculating vol on dates where it isn't
+        used. Same as resampling leverage on every date with 'last' for daily data, including returns with gaps (where
+        the leverage is from the last bar in each period with a full vol window), except that if there is no bar on a
+        rebalance date, the bar before is used (rather than skipping that rebalance). For intraday data, the leverage is
+        from the last bar of the rebalance date, and when the returns have no gaps, only the bars in each vol window are
+        read where the windows are shorter than the rebalancing periods
 
         Returns
         -------
         pandas.DataFrame
         """
-        try:
-            # make plots on every business day (will downsample intraday data)
-            data_frame = data_frame.resample('B')
-            data_frame = data_frame.fillna(method='pad')
 
-            return data_frame
-        except:
-            return data_frame
+        returns = returns_df.values.astype(numpy.float64, copy=False)
+        rows, cols = returns.shape
 
-    ##### Quick helper functions to plot aspects of the strategy such as P&L, leverage etc.
-    def plot_individual_leverage(self):
+        index = returns_df.index
 
-        style = self.create_style("Leverage", "Individual Leverage")
+        rebalance = self._get_rebalance_rows(index, vol_rebalance_freq)
 
-        try:
-            self.chart.plot(self.reduce_plot(self._individual_leverage), chart_type='line', style=style)
-        except: pass
+        if len(rebalance) == 0:
+            if rows > 0:
+                LoggerManager().getLogger(__name__).warning("No rebalance dates for " + str(vol_rebalance_freq)
+                                                            + " in returns, so there is no leverage")
 
-    def plot_strategy_group_pnl_trades(self):
+            return pandas.DataFrame(data=numpy.full((rows, cols), numpy.nan), index=index, columns=returns_df.columns)
 
-        style = self.create_style("(bp)", "Individual Trade PnL")
+        vol = self._calculate_rebalance_vol(returns, rebalance, vol_periods, vol_obs_in_year)
 
-        # zero when there isn't a trade exit
-        # strategy_pnl_trades = self._strategy_pnl_trades * 100 * 100
-        # strategy_pnl_trades = strategy_pnl_trades.dropna()
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            lev = vol_target / vol
 
-        # note only works with single large basket trade
-        try:
-            strategy_pnl_trades = self._strategy_pnl_trades.fillna(0) * 100 * 100
-            self.chart.plot(self.reduce_plot(strategy_pnl_trades), chart_type='line', style=style)
-        except: pass
+        lev[lev > vol_max_leverage] = vol_max_leverage
 
-    def plot_strategy_pnl(self):
+        return pandas.DataFrame(data=self._carry_forward_rebalance_leverage(lev, rebalance, rows, vol_periods),
+                                index=index, columns=returns_df.columns)
 
-        style = self.create_style("", "Strategy PnL")
+    def _calculate_rebalance_vol(self, returns, rebalance, vol_periods, vol_obs_in_year):
+        """
+        _calculate_rebalance_vol - Calculates annualised vol for each rebalance row, in the same way as resampling
+        rolling vol to the rebalance dates with 'last': from the vol window of the last row in the rebalancing period
+        which has a full window without gaps (usually the rebalance row itself), otherwise NaN. Columns with gaps are
+        read in full, to find the last rows with full windows
 
-        try:
-            self.chart.plot(self.reduce_plot(self._strategy_pnl), chart_type='line', style=style)
-        except: pass
+        Returns
+        -------
+        numpy.ndarray (rebalance rows x assets)
+        """
 
-    def plot_strategy_signal_proportion(self, strip = None):
+        vol = self._calculate_window_vol(returns, rebalance + 1, vol_periods, vol_obs_in_year)
 
-        signal = self._strategy_signal
+        previous = numpy.concatenate([[-1], rebalance[:-1]])
+        rows = numpy.arange(returns.shape[0])
 
-        # count number of long, short and flat periods in our sample
-        long = signal[signal > 0].count()
-        short = signal[signal < 0].count()
-        flat = signal[signal == 0].count()
+        for i in numpy.nonzero(numpy.isnan(vol).any(axis=0))[0]:
+            finite = numpy.isfinite(returns[:, i])
 
-        keys = long.index
+            if finite.all(): continue
 
-        # how many trades have there been (ignore size of the trades)
-        trades = abs(signal - signal.shift(-1))
-        trades = trades[trades > 0].count()
+            # last row at or before each rebalance row whose window has no gaps (ie. vol_periods since the last gap)
+            last_gap = numpy.maximum.accumulate(numpy.where(finite, -1, rows))
+            last_full = numpy.maximum.accumulate(numpy.where(rows - last_gap >= vol_periods, rows, -1))[rebalance]
 
-        df_trades = pandas.DataFrame(index = keys, columns = ['Trades'], data = trades)
+            # only from the same rebalancing period (otherwise the leverage of the previous period carries on)
+            moved = numpy.isnan(vol[:, i]) & (last_full > previous)
 
-        df = pandas.DataFrame(index = keys, columns = ['Long', 'Short', 'Flat'])
+            if moved.any():
+                vol[moved, i] = self._calculate_window_vol(returns[:, i:i + 1], last_full[moved] + 1, vol_periods,
+                                                           vol_obs_in_year)[:, 0]
 
-        df['Long'] = long
-        df['Short']  = short
-        df['Flat'] = flat
+        return vol
 
-        if strip is not None: keys = [k.replace(strip, '') for k in keys]
+    def _calculate_window_vol(self, returns, end, vol_periods, vol_obs_in_year):
+        """
+        _calculate_window_vol - Calculates annualised vol over the vol window ending before each row in end
 
-        df.index = keys
-        df_trades.index = keys
-        # df = df.sort_index()
+        Returns
+        -------
+        numpy.ndarray (windows x assets)
+        """
 
-        style = self.create_style("", "")
+        window_sum, window_sum_sq, window_count = self._calculate_window_sums(returns, end, vol_periods)
 
-        try:
-            style.file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Strategy signal proportion).png'
-            style.html_file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Strategy signal proportion).html'
-            self.chart.plot(self.reduce_plot(df), chart_type='bar', style=style)
+        n = float(vol_periods)
 
-            style.file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Strategy trade no).png'
-            style.html_file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Strategy trade no).html'
-            self.chart.plot(self.reduce_plot(df_trades), chart_type='bar', style=style)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            var = (window_sum_sq - window_sum * window_sum / n) / (n - 1)
 
-        except: pass
+        var[var < 0] = 0
 
-    def plot_strategy_leverage(self):
-        style = self.create_style("Leverage", "Strategy Leverage")
+        # like a rolling std, vol needs a full window without gaps
+        var[window_count < n] = numpy.nan
 
-        try:
-            self.chart.plot(self.reduce_plot(self._strategy_leverage), chart_type='line', style=style)
-        except: pass
+        return numpy.sqrt(var * vol_obs_in_year)
 
-    def plot_strategy_group_benchmark_pnl(self, strip = None):
+    def _carry_forward_rebalance_leverage(self, lev, rebalance, rows, vol_periods):
+        """
+        _carry_forward_rebalance_leverage - Carries forward leverage from each rebalance row to the next (nothing before
+        the first)
 
-        style = self.create_style("", "Group Benchmark PnL - cumulative")
+        Returns
+        -------
+        numpy.ndarray (rows x columns of lev)
+        """
 
-        strat_list = self._strategy_group_benchmark_pnl.columns #.sort_values()
+        lev = pandas.DataFrame(lev).fillna(method='ffill').values
 
-        for line in strat_list:
-            self.logger.info(line)
+        lev = numpy.concatenate([numpy.full((rebalance[0], lev.shape[1]), numpy.nan),
+                                 numpy.repeat(lev, numpy.diff(numpy.append(rebalance, rows)), axis=0)])
 
-        # plot cumulative line of returns
-        self.chart.plot(self.reduce_plot(self._strategy_group_benchmark_pnl), style=style)
+        lev[0:vol_periods] = numpy.nan  # ignore the first elements before the vol window kicks in
 
-        # needs write stats flag turned on
-        try:
-            keys = self._strategy_group_benchmark_ret_stats.keys()
-            ir = []
+        return lev
 
-            for key in keys: ir.append(self._strategy_group_benchmark_ret_stats[key].inforatio()[0])
+    def _calculate_window_sums(self, returns, end, vol_periods):
+        """
+        _calculate_window_sums - Calculates the sum, sum of squares and number of finite returns in the vol window
+        ending before each row in end (NaNs count as zero in the sums)
 
-            if strip is not None: keys = [k.replace(strip, '') for k in keys]
+        Returns
+        -------
+        numpy.ndarray (sums), numpy.ndarray (sums of squares), numpy.ndarray (counts), each (windows x assets)
+        """
 
-            ret_stats = pandas.DataFrame(index = keys, data = ir, columns = ['IR'])
-            # ret_stats = ret_stats.sort_index()
-            style.file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Group Benchmark PnL - IR) ' + style.SCALE_FACTOR + '.png'
-            style.html_file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (Group Benchmark PnL - IR) ' + style.SCALE_FACTOR + '.html'
-            style.display_brand_label = False
+        cols = returns.shape[1]
 
-            self.chart.plot(ret_stats, chart_type='bar', style=style)
+        if len(end) == 0: return numpy.zeros((0, cols)), numpy.zeros((0, cols)), numpy.zeros((0, cols))
 
-        except: pass
+        # windows which cover much less than the data (eg. monthly rebalancing of intraday data) are read directly
+        if len(end) * vol_periods < returns.shape[0]:
+            window = end[:, numpy.newaxis] - vol_periods + numpy.arange(vol_periods)
 
-    def plot_strategy_group_benchmark_annualised_pnl(self, cols = None):
-        # TODO - unfinished, needs checking!
+            window_returns = returns[numpy.maximum(window, 0)]
+            window_returns[window < 0] = numpy.nan
 
-        if cols is None: cols = self._strategy_group_benchmark_annualised_pnl.columns
+            finite = numpy.isfinite(window_returns)
+            window_returns = numpy.where(finite, window_returns, 0.0)
 
-        style = self.create_style("", "Group Benchmark Annualised PnL")
-        style.color = ['red', 'blue', 'purple', 'gray', 'yellow', 'green', 'pink']
+            return window_returns.sum(axis=1), (window_returns * window_returns).sum(axis=1), finite.sum(axis=1)
 
-        self.chart.plot(self.reduce_plot(self._strategy_group_benchmark_annualised_pnl[cols]), chart_type='line', style=style)
+        start = numpy.maximum(end - vol_periods, 0)
 
+        # prefix sums at the start and end of each vol window, from sums between consecutive window boundaries (so only
+        # rows from the first window onwards are read, and nothing the size of the data is accumulated)
+        boundaries = numpy.unique(numpy.concatenate([start, end]))
+        first = boundaries[0]
 
-    def plot_strategy_group_leverage(self):
+        returns = returns[first:boundaries[-1]]
+        finite = numpy.isfinite(returns)
 
-        style = self.create_style("Leverage", "Group Leverage")
-        self.chart.plot(self.reduce_plot(self._strategy_group_leverage), chart_type='line', style=style)
+        zero = numpy.zeros((1, cols))
+        segments = boundaries[:-1] - first
 
-    def plot_strategy_signals(self, date = None, strip = None):
+        if finite.all():
+            finite_count = numpy.concatenate([zero, numpy.cumsum(numpy.diff(boundaries))[:, numpy.newaxis]
+                                              * numpy.ones(cols)])
+        else:
+            returns = numpy.where(finite, returns, 0.0)
+            finite_count = numpy.concatenate([zero, numpy.cumsum(numpy.add.reduceat(finite, segments, axis=0), axis=0)])
 
-        ######## plot signals
-        strategy_signal = self._strategy_signal
-        strategy_signal = 100 * (strategy_signal)
+        sum_returns = numpy.concatenate([zero, numpy.cumsum(numpy.add.reduceat(returns, segments, axis=0), axis=0)])
+        sum_sq_returns = numpy.concatenate([zero, numpy.cumsum(
+            numpy.add.reduceat(returns * returns, segments, axis=0), axis=0)])
 
-        if date is None:
-            last_day = strategy_signal.ix[-1].transpose().to_frame()
-        else:
-            last_day = strategy_signal.ix[date].transpose().to_frame()
+        end = numpy.searchsorted(boundaries, end)
+        start = numpy.searchsorted(boundaries, start)
 
-        if strip is not None:
-            last_day.index = [x.replace(strip, '') for x in last_day.index]
+        return sum_returns[end] - sum_returns[start], sum_sq_returns[end] - sum_sq_returns[start], \
+               finite_count[end] - finite_count[start]
 
-        style = self.create_style("positions (% portfolio notional)", "Positions")
-        self.chart.plot(last_day, chart_type='bar', style=style)
+    def _calculate_resampled_leverage_factor(self, returns_df, vol_target, vol_max_leverage, vol_periods,
+                                             vol_obs_in_year, vol_rebalance_freq, data_resample_freq,
+                                             data_resample_type, period_shift):
+        """
+        _calculate_resampled_leverage_factor - Calculates leverage from returns resampled to a coarser frequency (eg.
+        daily vol for minute data), and broadcasts it back onto the original times with an as-of join. The leverage of
+        each resampled period is only known at the last bar of that period, so is used from there onwards
 
-    def create_style(self, title, file_add):
-        style = Style()
+        Returns
+        -------
+        pandas.DataFrame
+        """
 
-        style.title = self.FINAL_STRATEGY + " " + title
-        style.display_legend = True
-        style.scale_factor = self.SCALE_FACTOR
+        resampled_df, last_bar = self._resample_returns(returns_df, data_resample_freq)
 
-        if self.DEFAULT_PLOT_ENGINE not in ['plotly', 'cufflinks'] and self.SAVE_FIGURES:
-            style.file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (' + file_add + ') ' + str(style.scale_factor) + '.png'
+        lev_df = self.calculate_leverage_factor(resampled_df, vol_target, vol_max_leverage, vol_periods, vol_obs_in_year,
+                                                vol_rebalance_freq, None, data_resample_type, period_shift=period_shift)
 
-        style.html_file_output = self.DUMP_PATH + self.FINAL_STRATEGY + ' (' + file_add + ') ' + str(style.scale_factor) + '.html'
+        return self._broadcast_resampled_leverage(lev_df, last_bar, returns_df.index)
 
-        try:
-            style.silent_display = self.SILENT_DISPLAY
-        except: pass
+    def _resample_returns(self, returns_df, data_resample_freq):
+        """
+        _resample_returns - Compounds returns over each period of a coarser frequency, periods without any bars (eg.
+        weekends) are dropped
 
-        return style
+        Returns
+        -------
+        pandas.DataFrame (resampled returns), pandas.Series (time of the last bar in each period)
+        """
 
-#######################################################################################################################
+        last_bar = pandas.Series(returns_df.index, index=returns_df.index).resample(data_resample_freq).max().dropna()
 
-"""
-RiskEngine
+        resampled_df = numpy.expm1(numpy.log1p(returns_df).resample(data_resample_freq).sum())
+        resampled_df = resampled_df.mask(returns_df.resample(data_resample_freq).count() == 0)
 
-Adjusts signal weighting according to risk constraints (volatility targeting)
+        return resampled_df.loc[last_bar.index], last_bar
 
-"""
+    def _broadcast_resampled_leverage(self, lev_df, last_bar, index):
+        # as-of join, each bar takes the leverage of the last period which has finished
+        lev_df.index = pandas.DatetimeIndex(last_bar.values)
 
-class RiskEngine(object):
-    def calculate_vol_adjusted_index_from_prices(self, prices_df, br):
+        return lev_df.reindex(index, method='ffill')
+
+    def calculate_leverage_factor_grid(self, returns_df, vol_targets, vol_max_leverages, vol_periods, vol_obs_in_year=252,
+                                       vol_rebalance_freq='BM', data_resample_freq=None, data_resample_type='mean'):
         """
-        calculate_vol_adjusted_index_from_price - Adjusts an index of prices for a vol target
+        calculate_leverage_factor_grid - Calculates leverage for every combination of vol targets, maximum leverages and
+        vol periods in one go (rather than calling calculate_leverage_factor for each). Rolling vol is calculated once for
+        each number of vol periods, and the leverage for every target and maximum leverage is resampled to rebalance
+        dates together ('last' only calculates vol on rebalance dates, as in calculate_leverage_factor). Gives the same
+        leverage as calculate_leverage_factor for each combination.
 
         Parameters
         ----------
-        br : BacktestRequest
-            Parameters for the backtest specifying start date, finish data, transaction costs etc.
+        returns_df : DataFrame
+            Asset returns
 
-        asset_a_df : pandas.DataFrame
-            Asset prices to be traded
+        vol_targets : list(float)
+            vol targets
+
+        vol_max_leverages : list(float)
+            maximum leverages allowed
+
+        vol_periods : list(int)
+            numbers of periods to calculate volatility
+
+        vol_obs_in_year : int
+            number of observations in the year
+
+        vol_rebalance_freq : str
+            how often to rebalance
+
+        data_resample_freq : str
+            frequency to resample returns to before calculating vol (None to use returns as they are)
+
+        data_resample_type : str
+            how to resample leverage to rebalance dates (eg. 'mean' or 'last')
 
         Returns
         -------
-        pandas.Dataframe containing vol adjusted index
+        numpy.ndarray (vol periods x vol targets x max leverages x time x assets)
         """
 
         calculations = Calculations()
+        filter = Filter()
 
-        returns_df, leverage_df = self.calculate_vol_adjusted_returns(prices_df, br, returns=False)
+        vol_targets = numpy.atleast_1d(numpy.asarray(vol_targets, dtype=numpy.float64))
+        vol_max_leverages = numpy.atleast_1d(numpy.asarray(vol_max_leverages, dtype=numpy.float64))
+        vol_periods = numpy.atleast_1d(vol_periods)
 
-        return calculations.create_mult_index(returns_df)
+        if data_resample_freq is not None:
+            vol_returns_df, last_bar = self._resample_returns(returns_df, data_resample_freq)
+        else:
+            vol_returns_df = returns_df
+
+        rows = len(vol_returns_df.index)
+        cols = len(vol_returns_df.columns)
 
-    def calculate_vol_adjusted_returns(self, returns_df, br, returns=True):
+        lev_grid = numpy.empty((len(vol_periods), len(vol_targets), len(vol_max_leverages), len(returns_df.index), cols))
+
+        # like calculate_leverage_factor, 'last' only needs vol on rebalance dates
+        rebalance = None
+
+        if data_resample_type == 'last':
+            rebalance = self._get_rebalance_rows(vol_returns_df.index, vol_rebalance_freq)
+
+            if len(rebalance) == 0 and rows > 0:
+                LoggerManager().getLogger(__name__).warning("No rebalance dates for " + str(vol_rebalance_freq)
+                                                            + " in returns, so there is no leverage")
+
+        for p in range(0, len(vol_periods)):
+            if rebalance is not None:
+                vol = self._calculate_rebalance_vol(vol_returns_df.values.astype(numpy.float64, copy=False), rebalance,
+                                                    int(vol_periods[p]), vol_obs_in_year)
+            else:
+                vol = calculations.rolling_volatility(vol_returns_df, periods=int(vol_periods[p]),
+                                                      obs_in_year=vol_obs_in_year).values
+
+            # leverage for every target and maximum leverage side by side (targets x max leverages x assets columns)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                lev = vol_targets[:, numpy.newaxis, numpy.newaxis] / vol[:, numpy.newaxis, numpy.newaxis, :]
+
+            lev = numpy.where(lev > vol_max_leverages[numpy.newaxis, numpy.newaxis, :, numpy.newaxis],
+                              vol_max_leverages[numpy.newaxis, numpy.newaxis, :, numpy.newaxis], lev)
+
+            lev = lev.reshape(lev.shape[0], -1)
+
+            if rebalance is None:
+                lev_df = filter.resample_time_series_frequency(pandas.DataFrame(data=lev, index=vol_returns_df.index),
+                                                               vol_rebalance_freq, data_resample_type)
+
+                lev_df = lev_df.reindex(vol_returns_df.index).fillna(method='ffill')
+                lev_df.iloc[0:int(vol_periods[p])] = numpy.nan  # ignore the elements before the vol window kicks in
+            elif len(rebalance) == 0:
+                lev_df = pandas.DataFrame(data=numpy.nan, index=vol_returns_df.index, columns=range(lev.shape[1]))
+            else:
+                lev_df = pandas.DataFrame(data=self._carry_forward_rebalance_leverage(lev, rebalance, rows,
+                                                                                      int(vol_periods[p])),
+                                          index=vol_returns_df.index)
+
+            if data_resample_freq is not None:
+                lev_df = self._broadcast_resampled_leverage(lev_df, last_bar, returns_df.index)
+
+            lev_grid[p] = lev_df.values.reshape(len(returns_df.index), len(vol_targets), len(vol_max_leverages),
+                                                cols).transpose(1, 2, 0, 3)
+
+        return lev_grid
+
+    def calculate_vol_adjusted_returns_grid(self, returns_df, vol_targets, vol_max_leverages, vol_periods,
+                                            vol_obs_in_year=252, vol_rebalance_freq='BM', data_resample_freq=None,
+                                            data_resample_type='mean', tc=0.0):
         """
-        calculate_vol_adjusted_returns - Adjusts returns for a vol target
+        calculate_vol_adjusted_returns_grid - Calculates returns (after transaction costs) adjusted for every combination
+        of vol targets, maximum leverages and vol periods
 
         Parameters
         ----------
-        br : BacktestRequest
-            Parameters for the backtest specifying start date, finish data, transaction costs etc.
+        returns_df : DataFrame
+            Asset returns
 
-        returns_a_df : pandas.DataFrame
-            Asset returns to be traded
+        vol_targets, vol_max_leverages, vol_periods, vol_obs_in_year, vol_rebalance_freq, data_resample_freq,
+        data_resample_type
+            see calculate_leverage_factor_grid
+
+        tc : float or numpy.ndarray
+            transaction costs, which must broadcast against (time x assets)
 
         Returns
         -------
-        pandas.DataFrame
+        numpy.ndarray (vol periods x vol targets x max leverages x time x assets), numpy.ndarray (leverage, same shape)
         """
 
-        calculations = Calculations()
+        lev_grid = self.calculate_leverage_factor_grid(returns_df, vol_targets, vol_max_leverages, vol_periods,
+                                                       vol_obs_in_year, vol_rebalance_freq, data_resample_freq,
+                                                       data_resample_type)
 
-        if not returns: returns_df = calculations.calculate_returns(returns_df)
+        shape = lev_grid.shape
+        rows, cols = shape[3], shape[4]
+        combinations = shape[0] * shape[1] * shape[2]
 
-        if not (hasattr(br, 'portfolio_vol_resample_type')):
-            br.portfolio_vol_resample_type = 'mean'
+        # every combination side by side in one (time x combinations * assets) matrix for the kernel
+        lev = numpy.moveaxis(lev_grid, 3, 0).reshape(rows, combinations * cols)
+        returns = numpy.tile(returns_df.values, (1, combinations))
 
-        if not (hasattr(br, 'portfolio_vol_resample_freq')):
-            br.portfolio_vol_resample_freq = None
+        tc = numpy.asarray(tc, dtype=numpy.float64)
 
-        leverage_df = self.calculate_leverage_factor(returns_df,
-                                                     br.portfolio_vol_target, br.portfolio_vol_max_leverage,
-                                                     br.portfolio_vol_periods, br.portfolio_vol_obs_in_year,
-                                                     br.portfolio_vol_rebalance_freq, br.portfolio_vol_resample_freq,
-                                                     br.portfolio_vol_resample_type)
+        if tc.ndim > 0: tc = numpy.tile(numpy.broadcast_to(tc, (rows, cols)), (1, combinations))
 
-        vol_returns_df = calculations.calculate_signal_returns_with_tc_matrix(leverage_df, returns_df, tc=br.spot_tc_bp)
-        vol_returns_df.columns = returns_df.columns
+        vol_returns = PnLKernel().calculate_signal_returns_with_tc(lev, returns, tc=tc)
 
-        return vol_returns_df, leverage_df
+        return numpy.moveaxis(vol_returns.reshape((rows,) + shape[0:3] + (cols,)), 0, 3), lev_grid
 
-    def calculate_leverage_factor(self, returns_df, vol_target, vol_max_leverage, vol_periods=60, vol_obs_in_year=252,
-                                  vol_rebalance_freq='BM', data_resample_freq=None, data_resample_type='mean',
-                                  returns=True, period_shift=0):
+    def calculate_vol_target_surface(self, returns_df, vol_targets, vol_max_leverages, vol_periods,
+                                     vol_obs_in_year=252, vol_rebalance_freq='BM', data_resample_freq=None,
+                                     data_resample_type='mean', tc=0.0, ann_factor=252, portfolio_combination='mean'):
         """
-        calculate_leverage_factor - Calculates the time series of leverage for a specified vol target
+        calculate_vol_target_surface - Calculates return statistics of the portfolio of vol adjusted returns for every
+        combination of vol targets, maximum leverages and vol periods
 
         Parameters
         ----------
         returns_df : DataFrame
-            Asset returns
+            Asset returns (eg. of signals)
 
-        vol_target : float
-            vol target for assets
+        vol_targets, vol_max_leverages, vol_periods, vol_obs_in_year, vol_rebalance_freq, data_resample_freq,
+        data_resample_type, tc
+            see calculate_vol_adjusted_returns_grid
 
-        vol_max_leverage : float
-            maximum leverage allowed
+        ann_factor : int
+            number of observations in the year (for annualising returns and vol)
 
-        vol_periods : int
-            number of periods to calculate volatility
+        portfolio_combination : str
+            'mean' or 'sum' of asset returns
 
-        vol_obs_in_year : int
-            number of observations in the year
+        Returns
+        -------
+        pandas.DataFrame (indexed by vol periods, vol target and max leverage)
+        """
 
-        vol_rebalance_freq : str
-            how often to rebalance
+        vol_returns, lev_grid = self.calculate_vol_adjusted_returns_grid(returns_df, vol_targets, vol_max_leverages,
+                                                                         vol_periods, vol_obs_in_year, vol_rebalance_freq,
+                                                                         data_resample_freq, data_resample_type, tc)
 
-        vol_resample_type : str
-            do we need to resample the underlying data first? (eg. have we got intraday data?)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            if portfolio_combination == 'sum':
+                portfolio = numpy.nansum(vol_returns, axis=4)
+            else:
+                portfolio = numpy.nanmean(vol_returns, axis=4)
 
-        returns : boolean
-            is this returns time series or prices?
+            ann_returns = numpy.nanmean(portfolio, axis=3) * ann_factor
+            ann_vol = numpy.nanstd(portfolio, axis=3, ddof=1) * numpy.sqrt(ann_factor)
 
-        period_shift : int
-            should we delay the signal by a number of periods?
+        index = pandas.MultiIndex.from_product([numpy.atleast_1d(vol_periods), numpy.atleast_1d(vol_targets),
+                                                numpy.atleast_1d(vol_max_leverages)],
+                                               names=['vol_periods', 'vol_target', 'vol_max_leverage'])
 
-        Returns
-        -------
-        pandas.Dataframe
-        """
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return pandas.DataFrame({'ann_returns' : ann_returns.ravel(), 'ann_vol' : ann_vol.ravel(),
+                                     'inforatio' : (ann_returns / ann_vol).ravel()}, index=index,
+                                    columns=['ann_returns', 'ann_vol', 'inforatio'])
 
-        calculations = Calculations()
-        filter = Filter()
+#######################################################################################################################
 
-        if data_resample_freq is not None:
-            return
-            # TODO not implemented yet
+# state of each basket worker process (set once when the process starts)
+_basket_worker_state = {}
 
-        if not returns: returns_df = calculations.calculate_returns(returns_df)
+def _init_basket_worker(trading_model, br, shared_frames, tech_params, basket_dict):
+    _basket_worker_state['trading_model'] = trading_model
+    _basket_worker_state['br'] = br
+    _basket_worker_state['data_frames'] = [x.get_data_frame() for x in shared_frames]
+    _basket_worker_state['shared_frames'] = shared_frames  # keep shared memory attached
+    _basket_worker_state['tech_params'] = tech_params
+    _basket_worker_state['basket_dict'] = basket_dict
 
-        roll_vol_df = calculations.rolling_volatility(returns_df,
-                                                      periods=vol_periods, obs_in_year=vol_obs_in_year).shift(
-            period_shift)
+def _run_basket_worker(key):
+    asset_df, spot_df, spot_df2 = _basket_worker_state['data_frames']
 
-        # calculate the leverage as function of vol target (with max lev constraint)
-        lev_df = vol_target / roll_vol_df
-        lev_df[lev_df > vol_max_leverage] = vol_max_leverage
+    return _construct_basket(_basket_worker_state['trading_model'], _basket_worker_state['br'], asset_df, spot_df,
+                             spot_df2, _basket_worker_state['tech_params'], _basket_worker_state['basket_dict'], key)
 
-        lev_df = filter.resample_time_series_frequency(lev_df, vol_rebalance_freq, data_resample_type)
+def _construct_basket(trading_model, br, asset_df, spot_df, spot_df2, tech_params, basket_dict, key):
+    """
+    _construct_basket - Backtests the strategy for one basket
 
-        returns_df, lev_df = returns_df.align(lev_df, join='left', axis=0)
+    Returns
+    -------
+    dict (outputs of the basket, including signals and trades if it is the final strategy)
+    """
 
-        lev_df = lev_df.fillna(method='ffill')
-        lev_df.ix[0:vol_periods] = numpy.nan  # ignore the first elements before the vol window kicks in
+    profiler = getattr(br, 'profiler', None)
+    records = profiler.get_record_count() if profiler is not None else 0
+
+    with profile_stage(profiler, 'basket', key = key):
+        asset_cut_df = asset_df[[x +'.close' for x in basket_dict[key]]]
+        spot_cut_df = spot_df[[x +'.close' for x in basket_dict[key]]]
+
+        results, backtest = trading_model.construct_individual_strategy(br, spot_cut_df, spot_df2, asset_cut_df,
+                                                                        tech_params, key)
+
+        basket = {'results' : results, 'leverage' : backtest.get_porfolio_leverage(),
+                  'ret_stats' : backtest.get_portfolio_pnl_ret_stats()}
+
+        # only need the signals and trades of the final strategy
+        if key == trading_model.FINAL_STRATEGY:
+            basket['signal'] = backtest.get_porfolio_signal()
+            basket['pnl_trades'] = backtest.get_pnl_trades()
+            basket['trades'] = backtest.get_trades()
+
+    # stages recorded for this basket (so they can be sent back from worker processes)
+    basket['profile'] = profiler.get_records()[records:] if profiler is not None else []
 
-        return lev_df
\ No newline at end of file
+    return basket
@@ -1,5 +1,7 @@
 __author__ = 'saeedamen'
 
+import numpy
+
 from findatapy.market import MarketDataRequest
 
 from finmarketpy.economics import TechParams
@@ -36,7 +38,14 @@ class BacktestRequest(MarketDataRequest):
 
     @spot_tc_bp.setter
     def spot_tc_bp(self, spot_tc_bp):
-        self.__spot_tc_bp = spot_tc_bp / (2.0 * 100.0 * 100.0)
+        # can be a scalar, one per asset, a Series/DataFrame with asset names as columns, an array the same shape as the
+        # asset returns, or a function of asset prices which gives one of these (see Backtest._get_tc)
+        if isinstance(spot_tc_bp, (list, tuple)): spot_tc_bp = numpy.array(spot_tc_bp, dtype=float)
+
+        if callable(spot_tc_bp):
+            self.__spot_tc_bp = ScaledFunction(spot_tc_bp, 1.0 / (2.0 * 100.0 * 100.0))
+        else:
+            self.__spot_tc_bp = spot_tc_bp / (2.0 * 100.0 * 100.0)
 
     @property
     def asset(self):
@@ -64,3 +73,15 @@ class BacktestRequest(MarketDataRequest):
 
         self.__instrument = instrument
 
+class ScaledFunction(object):
+    """
+    ScaledFunction - Scales the output of a function (eg. to convert transaction costs from bp), which can be pickled
+    (unlike a lambda) if the function can be
+    """
+
+    def __init__(self, func, scale):
+        self._func = func
+        self._scale = scale
+
+    def __call__(self, *args, **kwargs):
+        return self._func(*args, **kwargs) * self._scale
@@ -0,0 +1,554 @@
+__author__ = 'saeedamen'
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+BatchBacktest
+
+Conducts many backtests in one go, where each backtest trades the same assets with different signals and/or transaction
+costs (eg. for parameter sweeps). Unlike looping over Backtest, the asset prices are only aligned, forward filled and
+converted into returns once, and all the signals are stacked into a single (parameters x time x assets) array, so the
+P&L, portfolios and return statistics for every combination are computed in a single vectorised pass.
+
+"""
+
+import numpy
+import pandas
+
+from findatapy.timeseries import Calculations, RetStats
+from findatapy.util import LoggerManager
+
+from finmarketpy.backtest.backtestengine import Backtest, RiskEngine
+from finmarketpy.backtest.executionrules import ExecutionRules
+from finmarketpy.util.arraycalculations import ArrayCalculations
+
+class BatchBacktest(object):
+
+    # BacktestRequest fields which must be identical for every backtest in a batch (spot_tc_bp can vary)
+    SHARED_FIELDS = ['ann_factor', 'portfolio_combination',
+                     'signal_vol_adjust', 'signal_vol_target', 'signal_vol_max_leverage', 'signal_vol_periods',
+                     'signal_vol_obs_in_year', 'signal_vol_rebalance_freq', 'signal_vol_resample_freq',
+                     'signal_vol_resample_type',
+                     'portfolio_vol_adjust', 'portfolio_vol_target', 'portfolio_vol_max_leverage',
+                     'portfolio_vol_periods', 'portfolio_vol_obs_in_year', 'portfolio_vol_rebalance_freq',
+                     'portfolio_vol_resample_freq', 'portfolio_vol_resample_type']
+
+    # values of shared fields when they aren't set (which backtests fill in)
+    SHARED_FIELD_DEFAULTS = {'portfolio_combination' : 'mean', 'signal_vol_resample_type' : 'mean',
+                             'portfolio_vol_resample_type' : 'mean'}
+
+    def __init__(self):
+        self.logger = LoggerManager().getLogger(__name__)
+        self._pnl = None
+        self._portfolio = None
+        self._ret_stats_pnl = None
+        return
+
+    def get_shared_key(self, br):
+        """
+        get_shared_key - Gets the values of the backtest parameters which must be shared by all the backtests in a batch
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest
+
+        Returns
+        -------
+        tuple
+        """
+        return tuple([str(getattr(br, x, self.SHARED_FIELD_DEFAULTS.get(x, None))) for x in self.SHARED_FIELDS])
+
+    def calculate_trading_PnL(self, br, asset_a_df, signal_df_list, portfolio_names = None):
+        """
+        calculate_trading_PnL - Calculates P&L of many trading strategies on the same assets and statistics to be
+        retrieved later
+
+        Parameters
+        ----------
+        br : BacktestRequest or list(BacktestRequest)
+            Parameters for the backtests. If a list is given, there should be one for each signal and they can only
+            differ by transaction costs (spot_tc_bp)
+
+        asset_a_df : pandas.DataFrame
+            Asset prices to be traded
+
+        signal_df_list : list(pandas.DataFrame)
+            Signals for each trading strategy (columns should be in the same order as assets)
+
+        portfolio_names : list(str)
+            Names for each portfolio (defaults to 'Port 0', 'Port 1' etc.)
+        """
+
+        array_calculations = ArrayCalculations()
+
+        if not(isinstance(br, list)): br = [br] * len(signal_df_list)
+
+        if len(br) != len(signal_df_list):
+            raise Exception("Need one BacktestRequest for each signal")
+
+        shared_key = self.get_shared_key(br[0])
+
+        for b in br:
+            if self.get_shared_key(b) != shared_key:
+                raise Exception("BacktestRequests in a batch can only differ by transaction costs")
+
+        br_shared = br[0]
+
+        if portfolio_names is None: portfolio_names = ['Port ' + str(i) for i in range(0, len(signal_df_list))]
+
+        self._check_supported(br)
+
+        signal = self._calculate_signal(br_shared, asset_a_df, signal_df_list)
+
+        # transaction costs can differ for each backtest (broadcast over time and assets)
+        tc = self._get_scalar_tc(br)[numpy.newaxis, :, numpy.newaxis]
+
+        pnl = array_calculations.calculate_signal_returns_with_tc(signal, self._returns[:, numpy.newaxis, :], tc)
+
+        portfolio = array_calculations.combine_portfolio(pnl, self._portfolio_combination, axis=2)
+
+        self._signal = signal                           # time x parameters x assets (before portfolio leverage)
+        self._pnl = pnl                                 # time x parameters x assets
+
+        self._calculate_portfolio(br_shared, portfolio, tc.ravel(), portfolio_names)
+
+    def _check_supported(self, br):
+        # backtests which depend on the path of each backtest can't be batched (use Backtest for these)
+        if RiskEngine().is_ex_ante_portfolio(br[0]):
+            raise Exception("BatchBacktest doesn't support portfolios combined from covariance (use Backtest)")
+
+        for b in br:
+            if ExecutionRules().has_rules(b):
+                raise Exception("BatchBacktest doesn't support execution rules such as stop losses (use Backtest)")
+
+    def _calculate_signal(self, br_shared, asset_a_df, signal_df_list):
+        """
+        _calculate_signal - Aligns and fills signals for every backtest and applies the leverage of individual signals
+        (which is the same for all the backtests), also calculating the asset returns
+
+        Returns
+        -------
+        numpy.ndarray (time x parameters x assets)
+        """
+
+        calculations = Calculations()
+        array_calculations = ArrayCalculations()
+
+        # align, mask and forward fill the traded assets only once for all the backtests
+        asset_df = asset_a_df.ffill()
+        asset_nan = numpy.isnan(asset_a_df.values)
+
+        returns_df = calculations.calculate_returns(asset_df)
+        returns = returns_df.values
+
+        # stack signals into (parameters x time x assets), aligned to asset dates
+        signal = numpy.empty((len(signal_df_list), len(asset_df.index), len(asset_df.columns)))
+
+        for i in range(0, len(signal_df_list)):
+            signal[i] = signal_df_list[i].reindex(asset_df.index).values
+
+        # only allow signals to change on the days when we can trade assets
+        signal[:, asset_nan] = numpy.nan
+
+        # forward fill along time (first axis after transposing to time x parameters x assets)
+        signal = array_calculations.ffill(signal.transpose(1, 0, 2))
+
+        signal_cols = signal_df_list[0].columns.values
+        returns_cols = returns_df.columns.values
+
+        pnl_cols = []
+
+        for i in range(0, len(returns_cols)):
+            pnl_cols.append(returns_cols[i] + " / " + signal_cols[i])
+
+        self._individual_leverage = None
+
+        # leverage for individual signals only depends on the asset returns, so is the same for all the backtests
+        if getattr(br_shared, 'signal_vol_adjust', False) is True:
+            risk_engine = RiskEngine()
+
+            if not(hasattr(br_shared, 'signal_vol_resample_type')):
+                br_shared.signal_vol_resample_type = 'mean'
+
+            if not(hasattr(br_shared, 'signal_vol_resample_freq')):
+                br_shared.signal_vol_resample_freq = None
+
+            leverage_df = risk_engine.calculate_leverage_factor(returns_df, br_shared.signal_vol_target,
+                                           br_shared.signal_vol_max_leverage,
+                                           br_shared.signal_vol_periods, br_shared.signal_vol_obs_in_year,
+                                           br_shared.signal_vol_rebalance_freq, br_shared.signal_vol_resample_freq,
+                                           br_shared.signal_vol_resample_type)
+
+            signal *= leverage_df.values[:, numpy.newaxis, :]
+
+            self._individual_leverage = leverage_df
+
+        self._index = asset_df.index
+        self._pnl_cols = pnl_cols
+        self._signal_cols = signal_df_list[0].columns
+        self._portfolio_combination = getattr(br_shared, 'portfolio_combination', 'mean')
+        self._returns = returns
+
+        return signal
+
+    def calculate_tc_shock_PnL(self, br, asset_a_df, signal_df, portfolio_names = None):
+        """
+        calculate_tc_shock_PnL - Calculates P&L of one trading strategy for many levels of transaction costs. As P&L is
+        linear in transaction costs (gross P&L - tc x turnover), the signals, gross P&L and turnover are only
+        calculated once, and the portfolio for every level of transaction costs is a single matrix operation (followed
+        by the portfolio vol target, calculated for all levels at once), so the time taken hardly depends on the
+        number of levels.
+
+        Parameters
+        ----------
+        br : list(BacktestRequest)
+            Parameters for the backtests, one for each level of transaction costs (they can only differ by spot_tc_bp)
+
+        asset_a_df : pandas.DataFrame
+            Asset prices to be traded
+
+        signal_df : pandas.DataFrame
+            Signals for the trading strategy
+
+        portfolio_names : list(str)
+            Names for each portfolio (defaults to 'Port 0', 'Port 1' etc.)
+        """
+
+        shared_key = self.get_shared_key(br[0])
+
+        for b in br:
+            if self.get_shared_key(b) != shared_key:
+                raise Exception("BacktestRequests for TC shock can only differ by transaction costs")
+
+        br_shared = br[0]
+
+        if portfolio_names is None: portfolio_names = ['Port ' + str(i) for i in range(0, len(br))]
+
+        self._check_supported(br)
+
+        # signals after leverage (which don't depend on transaction costs), without the P&L and statistics of a backtest
+        signal = self._calculate_signal(br_shared, asset_a_df, [signal_df])[:, 0, :]
+
+        array_calculations = ArrayCalculations()
+
+        gross = array_calculations.shift(signal) * self._returns
+        turnover = array_calculations.calculate_signal_tc(signal, 1)
+
+        # P&L is NaN for every level of transaction costs wherever gross P&L or turnover is NaN (and where every asset
+        # is NaN, the portfolio is 0 for 'sum' and NaN for 'mean', as in Backtest)
+        valid = ~(numpy.isnan(gross) | numpy.isnan(turnover))
+        count = valid.sum(axis=1)
+
+        gross_total = numpy.where(valid, gross, 0).sum(axis=1)
+        turnover_total = numpy.where(valid, turnover, 0).sum(axis=1)
+
+        if self._portfolio_combination != 'sum':
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                gross_total = gross_total / count
+                turnover_total = turnover_total / count
+
+        tc = self._get_scalar_tc(br)
+
+        # time x levels of transaction costs
+        portfolio = gross_total[:, numpy.newaxis] - turnover_total[:, numpy.newaxis] * tc[numpy.newaxis, :]
+
+        if self._portfolio_combination != 'sum': portfolio[count == 0, :] = numpy.nan
+
+        self._gross = numpy.where(valid, gross, numpy.nan)
+        self._turnover = numpy.where(valid, turnover, numpy.nan)
+        self._tc = tc
+
+        # signals are the same for every level (a view, rather than a copy for each)
+        self._signal = numpy.broadcast_to(signal[:, numpy.newaxis, :], (signal.shape[0], len(br), signal.shape[1]))
+        self._pnl = None                                # individual P&L is calculated for each level when needed
+
+        self._calculate_portfolio(br_shared, portfolio, tc, portfolio_names)
+
+    def _calculate_portfolio(self, br_shared, portfolio, tc, portfolio_names):
+        """
+        _calculate_portfolio - Applies portfolio vol target (for all the backtests at once) and calculates portfolio
+        statistics
+
+        Parameters
+        ----------
+        br_shared : BacktestRequest
+            Parameters shared by all the backtests
+
+        portfolio : numpy.ndarray
+            Portfolio returns (time x backtests) before any portfolio leverage
+
+        tc : numpy.ndarray
+            Transaction costs of each backtest
+
+        portfolio_names : list(str)
+            Names for each portfolio
+        """
+
+        array_calculations = ArrayCalculations()
+
+        portfolio_df = pandas.DataFrame(data = portfolio, index = self._index, columns = portfolio_names)
+
+        portfolio_leverage = numpy.ones(portfolio.shape)
+
+        # portfolio vol target is calculated for all the backtests at once (each is a column)
+        if getattr(br_shared, 'portfolio_vol_adjust', False) is True:
+            risk_engine = RiskEngine()
+
+            if not (hasattr(br_shared, 'portfolio_vol_resample_type')):
+                br_shared.portfolio_vol_resample_type = 'mean'
+
+            if not (hasattr(br_shared, 'portfolio_vol_resample_freq')):
+                br_shared.portfolio_vol_resample_freq = None
+
+            portfolio_leverage_df = risk_engine.calculate_leverage_factor(portfolio_df,
+                                           br_shared.portfolio_vol_target, br_shared.portfolio_vol_max_leverage,
+                                           br_shared.portfolio_vol_periods, br_shared.portfolio_vol_obs_in_year,
+                                           br_shared.portfolio_vol_rebalance_freq, br_shared.portfolio_vol_resample_freq,
+                                           br_shared.portfolio_vol_resample_type)
+
+            portfolio_leverage = portfolio_leverage_df.values
+
+            portfolio = array_calculations.calculate_signal_returns_with_tc(portfolio_leverage, portfolio, tc)
+            portfolio_df = pandas.DataFrame(data = portfolio, index = self._index, columns = portfolio_names)
+
+        self._portfolio_names = portfolio_names
+        self._ann_factor = br_shared.ann_factor
+
+        self._portfolio = portfolio_df
+        self._portfolio_leverage = pandas.DataFrame(data = portfolio_leverage, index = self._index,
+                                                    columns = portfolio_names)
+
+        self._ret_stats_portfolio = RetStats()
+        self._ret_stats_portfolio.calculate_ret_stats(self._portfolio, br_shared.ann_factor)
+
+        self._ret_stats_pnl = None
+
+        self._cumportfolio = pandas.DataFrame(data = array_calculations.create_mult_index(portfolio),
+                                              index = self._index, columns = portfolio_names)
+
+    def _get_scalar_tc(self, br):
+        # batches share transaction costs across dates and assets (use Backtest for time varying transaction costs)
+        for b in br:
+            if callable(b.spot_tc_bp) or numpy.ndim(b.spot_tc_bp) != 0:
+                raise Exception("BatchBacktest only supports a single transaction cost for every asset and date")
+
+        return numpy.array([b.spot_tc_bp for b in br], dtype=float)
+
+    def get_batch_size(self):
+        """
+        get_batch_size - Gets the number of backtests in the batch
+
+        Returns
+        -------
+        int
+        """
+        return len(self._portfolio_names)
+
+    def _get_pnl(self, i):
+        # time x assets
+        if self._pnl is None:
+            return self._gross - self._tc[i] * self._turnover
+
+        return self._pnl[:, i, :]
+
+    def get_pnl(self, i):
+        """
+        get_pnl - Gets P&L returns of individual assets for a backtest in the batch
+
+        Parameters
+        ----------
+        i : int
+            Index of backtest
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return pandas.DataFrame(data = self._get_pnl(i), index = self._index, columns = self._pnl_cols)
+
+    def get_pnl_ret_stats(self):
+        """
+        get_pnl_ret_stats - Gets P&L return statistics of individual assets for every backtest as class to be queried
+        (columns are ordered by backtest, then by asset)
+
+        Returns
+        -------
+        RetStats
+        """
+
+        if self._ret_stats_pnl is None:
+            cols = [p + " " + c for p in self._portfolio_names for c in self._pnl_cols]
+
+            pnl = numpy.hstack([self._get_pnl(i) for i in range(0, len(self._portfolio_names))])
+
+            pnl_df = pandas.DataFrame(data = pnl, index = self._index, columns = cols)
+
+            self._ret_stats_pnl = RetStats()
+            self._ret_stats_pnl.calculate_ret_stats(pnl_df, self._ann_factor)
+
+        return self._ret_stats_pnl
+
+    def get_cumpnl(self, i):
+        """
+        get_cumpnl - Gets P&L as a cumulative time series of individual assets for a backtest in the batch
+
+        Parameters
+        ----------
+        i : int
+            Index of backtest
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return pandas.DataFrame(data = ArrayCalculations().create_mult_index(self._get_pnl(i)), index = self._index,
+                                columns = self._pnl_cols)
+
+    def get_portfolio_pnl(self):
+        """
+        get_portfolio_pnl - Gets portfolio returns in raw form for every backtest (one column each)
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return self._portfolio
+
+    def get_cumportfolio(self):
+        """
+        get_cumportfolio - Gets P&L as a cumulative time series of portfolio for every backtest (one column each)
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return self._cumportfolio
+
+    def get_portfolio_pnl_desc(self):
+        """
+        get_portfolio_pnl_desc - Gets P&L return statistics of every portfolio as strings
+
+        Returns
+        -------
+        list(str)
+        """
+        return self._ret_stats_portfolio.summary()
+
+    def get_portfolio_pnl_ret_stats(self):
+        """
+        get_portfolio_pnl_ret_stats - Gets P&L return statistics of every portfolio as class to be queried
+
+        Returns
+        -------
+        RetStats
+        """
+        return self._ret_stats_portfolio
+
+    def get_individual_leverage(self):
+        """
+        get_individual_leverage - Gets leverage for each asset historically (shared by every backtest)
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return self._individual_leverage
+
+    def get_porfolio_leverage(self):
+        """
+        get_portfolio_leverage - Gets the leverage for every portfolio (one column each)
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return self._portfolio_leverage
+
+    def get_signal(self, i):
+        """
+        get_signal - Gets the signals (with individual leverage, but excluding portfolio leverage) for a backtest
+
+        Parameters
+        ----------
+        i : int
+            Index of backtest
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return pandas.DataFrame(data = self._signal[:, i, :], index = self._index, columns = self._signal_cols)
+
+    def get_porfolio_signal(self, i):
+        """
+        get_portfolio_signal - Gets the signals (with individual leverage & portfolio leverage) for a backtest
+
+        Parameters
+        ----------
+        i : int
+            Index of backtest
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        portfolio_signal = self._signal[:, i, :] * self._portfolio_leverage.values[:, i][:, numpy.newaxis]
+
+        if self._portfolio_combination != 'sum':
+            portfolio_signal = portfolio_signal / float(self._signal.shape[2])
+
+        return pandas.DataFrame(data = portfolio_signal, index = self._index, columns = self._signal_cols)
+
+    def check_parity(self, br, asset_a_df, signal_df_list):
+        """
+        check_parity - Checks the batch gives the same portfolio returns as running Backtest on each signal in turn
+
+        Parameters
+        ----------
+        br : BacktestRequest or list(BacktestRequest)
+            Parameters for the backtests (as for calculate_trading_PnL)
+
+        asset_a_df : pandas.DataFrame
+            Asset prices to be traded
+
+        signal_df_list : list(pandas.DataFrame)
+            Signals for each trading strategy
+
+        Returns
+        -------
+        float (maximum absolute difference, inf if NaNs are in different places)
+        """
+
+        if not(isinstance(br, list)): br = [br] * len(signal_df_list)
+
+        batch = BatchBacktest()
+        batch.calculate_trading_PnL(br, asset_a_df, signal_df_list)
+
+        batch_portfolio = batch.get_portfolio_pnl().values
+
+        diff = 0.0
+
+        for i in range(0, len(signal_df_list)):
+            backtest = Backtest()
+            backtest.calculate_trading_PnL(br[i], asset_a_df, signal_df_list[i])
+
+            x = batch_portfolio[:, i]
+            y = backtest.get_portfolio_pnl().values[:, 0]
+
+            if not (numpy.isnan(x) == numpy.isnan(y)).all(): return numpy.inf
+
+            if x.size > 0: diff = max(diff, numpy.nanmax(numpy.abs(x - y), initial=0.0))
+
+        return diff
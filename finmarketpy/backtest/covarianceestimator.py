@@ -0,0 +1,202 @@
+__author__ = 'saeedamen'
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+CovarianceEstimator
+
+Covariance matrix of asset returns which is updated with new returns, rather than recalculated from the whole window on
+each date. New rows are added (and for rolling covariance, rows leaving the window are removed) as low rank updates of
+the running sums of returns and cross products, so updating with k rows costs O(k x assets^2), done as matrix products.
+Rolling covariance keeps the last vol_periods rows in a fixed size ring buffer. EWMA covariance is zero mean (like
+RiskMetrics), with the bias of the early observations corrected.
+
+Rows where every return is NaN (eg. P&L before any signal has started) are skipped, and don't count towards the window.
+Other NaN returns are treated as zero (eg. a signal which hasn't started has no P&L), so rolling covariance is the same
+as a pandas rolling covariance of the returns after dropping rows which are all NaN and filling NaNs with zero.
+
+Used by RiskEngine for ex-ante portfolio vol targeting and risk based portfolio weights.
+
+"""
+
+import numpy
+
+class CovarianceEstimator(object):
+
+    def __init__(self, method = 'rolling', periods = 60, ewma_decay = 0.94, obs_in_year = 252):
+        """
+        __init__ - Creates estimator (the number of assets is set by the first update)
+
+        Parameters
+        ----------
+        method : str
+            'rolling' for covariance over a rolling window or 'ewma' for exponentially weighted covariance
+
+        periods : int
+            number of periods in rolling window (for EWMA, number of periods before the covariance is used)
+
+        ewma_decay : float
+            weight of the previous covariance for EWMA (eg. 0.94)
+
+        obs_in_year : int
+            number of observations in the year (to annualise covariance)
+        """
+
+        if method not in ['rolling', 'ewma']:
+            raise Exception("Unknown covariance method " + str(method))
+
+        self._method = method
+        self._periods = periods
+        self._ewma_decay = ewma_decay
+        self._obs_in_year = obs_in_year
+
+        self._count = 0
+        self._sum = None
+
+    def _create_state(self, assets):
+        self._sum = numpy.zeros(assets)
+        self._cross = numpy.zeros((assets, assets))
+
+        # ring buffer of the last rows of the window (rolling, unused rows are zero so they don't change the sums), where
+        # the next row is written, and rows added since the sums were last recalculated from it
+        self._buffer = numpy.zeros((self._periods, assets)) if self._method == 'rolling' else None
+        self._position = 0
+        self._since_recalculated = 0
+
+    def update(self, returns):
+        """
+        update - Updates covariance with the returns of one or more new rows (rows which are all NaN are skipped, other
+        NaN returns are treated as zero)
+
+        Parameters
+        ----------
+        returns : numpy.ndarray
+            Returns (assets or time x assets)
+        """
+
+        returns = numpy.atleast_2d(numpy.asarray(returns, dtype = numpy.float64))
+
+        finite = numpy.isfinite(returns)
+
+        if not(finite.all()):
+            keep = finite.any(axis = 1)
+
+            returns = numpy.where(finite, returns, 0.0)[keep]
+
+        if len(returns) == 0: return
+
+        if self._sum is None: self._create_state(returns.shape[1])
+
+        if self._method == 'rolling':
+            self._update_rolling(returns)
+        else:
+            self._update_ewma(returns)
+
+        self._count = self._count + len(returns)
+
+    def _update_rolling(self, returns):
+        periods = self._periods
+
+        # only the last rows can be in the window
+        if len(returns) >= periods:
+            self._buffer[:] = returns[-periods:]
+            self._position = 0
+            self._since_recalculated = periods
+        else:
+            rows = (self._position + numpy.arange(len(returns))) % periods
+
+            # new rows replace the oldest rows, which leave the window
+            leaving = self._buffer[rows]
+            self._buffer[rows] = returns
+
+            self._position = (self._position + len(returns)) % periods
+            self._since_recalculated = self._since_recalculated + len(returns)
+
+        # recalculate from the window once it has been replaced, so rounding errors don't build up
+        if self._since_recalculated >= periods:
+            self._sum = self._buffer.sum(axis = 0)
+            self._cross = numpy.dot(self._buffer.T, self._buffer)
+            self._since_recalculated = 0
+        else:
+            self._sum = self._sum + returns.sum(axis = 0) - leaving.sum(axis = 0)
+            self._cross = self._cross + numpy.dot(returns.T, returns) - numpy.dot(leaving.T, leaving)
+
+    def _update_ewma(self, returns):
+        rows = len(returns)
+
+        # weight of each new row, the latest has weight (1 - decay)
+        weights = (1.0 - self._ewma_decay) * self._ewma_decay ** numpy.arange(rows - 1, -1, -1)
+        weighted = returns * numpy.sqrt(weights)[:, numpy.newaxis]
+
+        self._cross = self._ewma_decay ** rows * self._cross + numpy.dot(weighted.T, weighted)
+
+    def is_ready(self):
+        """
+        is_ready - Have there been enough returns to use the covariance?
+
+        Returns
+        -------
+        bool
+        """
+        return self._count >= self._periods
+
+    def get_covariance(self):
+        """
+        get_covariance - Gets the annualised covariance matrix (NaN if there haven't been enough returns)
+
+        Returns
+        -------
+        numpy.ndarray (assets x assets)
+        """
+
+        if not(self.is_ready()):
+            return numpy.full(self._cross.shape, numpy.nan) if self._sum is not None else None
+
+        if self._method == 'rolling':
+            n = float(self._periods)
+
+            cov = (self._cross - numpy.outer(self._sum, self._sum) / n) / (n - 1)
+        else:
+            cov = self._cross / (1.0 - self._ewma_decay ** self._count)
+
+        return cov * self._obs_in_year
+
+    def get_vol(self):
+        """
+        get_vol - Gets the annualised vol of each asset
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        return numpy.sqrt(numpy.maximum(numpy.diag(self.get_covariance()), 0))
+
+    def get_count(self):
+        return self._count
+
+    def get_observations(self):
+        """
+        get_observations - Gets the number of returns the covariance is estimated from, for EWMA the effective number
+        (sum of weights squared / sum of squared weights), so covariance of more assets than this is (close to) singular
+
+        Returns
+        -------
+        float
+        """
+
+        if self._method == 'rolling': return min(self._count, self._periods)
+
+        decay = self._ewma_decay
+        n = self._count
+
+        return (1.0 + decay) * (1.0 - decay ** n) ** 2 / ((1.0 - decay) * (1.0 - decay ** (2 * n)))
@@ -0,0 +1,248 @@
+__author__ = 'saeedamen'
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+ExecutionRules
+
+Path dependent execution rules, which adjust the positions implied by signals before the P&L is calculated: stop losses,
+trailing stops, take profits (all as fractional moves in price from entry, or from the best price since entry for
+trailing stops) and no-trade bands (which skip changes in position smaller than the band). These are checked on each bar
+using the (filled down) prices, so positions are closed on the bar where a rule is hit. After a stop or take profit, the
+position stays flat until the signal changes direction.
+
+Backtest applies the rules to signals after the leverage of individual signals (signal_vol_adjust), so the no-trade band
+also skips small rebalances from vol targeting. Portfolio leverage (portfolio_vol_adjust, or risk weighted portfolios)
+depends on the P&L of these positions, so it is applied afterwards and isn't filtered by the band.
+
+The rules are applied in one loop per asset over NumPy arrays, compiled with Numba when it is installed (otherwise the
+same loop runs in Python, which is much slower). The state at the end of the loop can be used to carry on with new bars
+(eg. when extending a backtest).
+
+"""
+
+import numpy
+
+from findatapy.util import LoggerManager
+
+njit = None
+
+try:
+    from numba import njit
+except: pass
+
+# rows of the state of the loop for each asset
+_LAST_PRICE, _LAST_SIGNAL, _POSITION, _ENTRY, _BEST, _STOPPED_DIRECTION = range(6)
+
+def _execution_loop(asset, signal, stop_loss, take_profit, trailing_stop, no_trade_band, state):
+    rows = asset.shape[0]
+    cols = asset.shape[1]
+
+    position_out = numpy.empty((rows, cols))
+    state = state.copy()
+
+    for n in range(cols):
+        last_price = state[_LAST_PRICE, n]
+        last_signal = state[_LAST_SIGNAL, n]
+        position = state[_POSITION, n]
+        entry = state[_ENTRY, n]
+        best = state[_BEST, n]
+        stopped_direction = state[_STOPPED_DIRECTION, n]
+
+        for t in range(rows):
+            price = asset[t, n]
+            sig = signal[t, n]
+
+            # signals can only change on days when we can trade the asset, and both are filled down
+            if numpy.isnan(price):
+                price = last_price
+                sig = last_signal
+            elif numpy.isnan(sig):
+                sig = last_signal
+
+            last_price = price
+            last_signal = sig
+
+            if numpy.isnan(sig) or numpy.isnan(price):
+                position = numpy.nan
+                stopped_direction = 0.0
+                position_out[t, n] = numpy.nan
+
+                continue
+
+            # check the rules for the position held into this bar
+            if not(numpy.isnan(position)) and position != 0.0:
+                direction = numpy.sign(position)
+
+                if direction * price > direction * best: best = price
+
+                move = direction * (price / entry - 1.0)
+
+                if move <= -stop_loss[n] or move >= take_profit[n] \
+                        or direction * (price / best - 1.0) <= -trailing_stop[n]:
+                    position = 0.0
+                    stopped_direction = direction
+
+            # stay flat after being stopped out, until signal changes direction
+            if stopped_direction != 0.0:
+                if numpy.sign(sig) == stopped_direction:
+                    position_out[t, n] = 0.0
+
+                    continue
+
+                stopped_direction = 0.0
+
+            # trade to the signal, unless the change is within the no-trade band
+            if numpy.isnan(position) or abs(sig - position) >= no_trade_band[n]:
+                if numpy.isnan(position) or numpy.sign(sig) != numpy.sign(position):
+                    entry = price
+                    best = price
+
+                position = sig
+
+            position_out[t, n] = position
+
+        state[_LAST_PRICE, n] = last_price
+        state[_LAST_SIGNAL, n] = last_signal
+        state[_POSITION, n] = position
+        state[_ENTRY, n] = entry
+        state[_BEST, n] = best
+        state[_STOPPED_DIRECTION, n] = stopped_direction
+
+    return position_out, state
+
+if njit is not None:
+    _execution_loop = njit(cache=True, nogil=True)(_execution_loop)
+
+class ExecutionRules(object):
+
+    # BacktestRequest fields for each rule (and the value which turns off the rule)
+    RULE_FIELDS = {'stop_loss' : numpy.inf, 'take_profit' : numpy.inf, 'trailing_stop' : numpy.inf,
+                   'no_trade_band' : 0.0}
+
+    def __init__(self, compiled = None):
+        """
+        __init__ - Creates execution rules
+
+        Parameters
+        ----------
+        compiled : bool
+            Use the compiled (Numba) loop? By default, use it when Numba is installed
+        """
+        self.logger = LoggerManager().getLogger(__name__)
+
+        if compiled is None: compiled = njit is not None
+
+        if compiled and njit is None:
+            self.logger.warning("Numba is not installed, so execution rules will be slow")
+
+        self._compiled = compiled
+
+    def has_rules(self, br):
+        """
+        has_rules - Are there any execution rules in a BacktestRequest?
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest
+
+        Returns
+        -------
+        bool
+        """
+
+        for k in self.RULE_FIELDS.keys():
+            if getattr(br, k, None) is not None: return True
+
+        return False
+
+    def create_state(self, cols):
+        """
+        create_state - Creates the state before any bars (no prices, signals or positions)
+
+        Parameters
+        ----------
+        cols : int
+            Number of assets
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        state = numpy.full((6, cols), numpy.nan)
+        state[_STOPPED_DIRECTION] = 0.0
+
+        return state
+
+    def get_position(self, state):
+        """
+        get_position - Gets the positions at the end of the bars the state comes from
+
+        Parameters
+        ----------
+        state : numpy.ndarray
+            State at the end of earlier bars
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        return state[_POSITION].copy()
+
+    def apply_rules(self, br, asset, signal, state = None):
+        """
+        apply_rules - Adjusts signals for execution rules (stop_loss, take_profit, trailing_stop and no_trade_band in
+        the BacktestRequest, each can be a scalar or one per asset, None for no rule)
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest
+
+        asset : numpy.ndarray
+            Asset prices (time x assets), NaN on asset holidays
+
+        signal : numpy.ndarray
+            Signals (time x assets), aligned with asset
+
+        state : numpy.ndarray
+            State at the end of earlier bars (None to start from scratch)
+
+        Returns
+        -------
+        numpy.ndarray (positions, filled down over asset holidays), numpy.ndarray (state at the end)
+        """
+
+        asset = numpy.ascontiguousarray(asset, dtype=numpy.float64)
+        signal = numpy.ascontiguousarray(signal, dtype=numpy.float64)
+
+        cols = asset.shape[1]
+
+        if state is None: state = self.create_state(cols)
+
+        rules = []
+
+        for k in ['stop_loss', 'take_profit', 'trailing_stop', 'no_trade_band']:
+            value = getattr(br, k, None)
+
+            if value is None: value = self.RULE_FIELDS[k]
+
+            rules.append(numpy.ascontiguousarray(
+                numpy.broadcast_to(numpy.asarray(value, dtype=numpy.float64), (cols,))))
+
+        # uncompiled version of the loop, if we don't want to use Numba
+        loop = _execution_loop if self._compiled else getattr(_execution_loop, 'py_func', _execution_loop)
+
+        return loop(asset, signal, rules[0], rules[1], rules[2], rules[3], state)
@@ -0,0 +1,202 @@
+__author__ = 'saeedamen'
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+IncrementalRetStats
+
+RetStats which can be updated with new returns, without going over the whole history again. Keeps running accumulators
+of the count and central moments (merged with the pairwise update formulae of Chan/Pebay, which are numerically stable),
+the cumulative index level and the drawdown, so each update is O(new returns). Gives the same statistics as calculating
+RetStats on the whole history.
+
+"""
+
+import math
+
+import numpy
+import pandas
+
+from findatapy.timeseries import RetStats
+
+class IncrementalRetStats(RetStats):
+
+    def __init__(self):
+        super(IncrementalRetStats, self).__init__()
+
+        self._count = None
+
+    def calculate_ret_stats(self, returns_df, ann_factor):
+        """
+        calculate_ret_stats - Calculates return statistics from scratch and seeds the accumulators
+
+        Parameters
+        ----------
+        returns_df : pandas.DataFrame
+            Returns
+
+        ann_factor : int
+            Number of observations in a year
+        """
+
+        self._ann_factor = ann_factor
+        self._columns = returns_df.columns
+
+        cols = len(returns_df.columns)
+
+        self._count = numpy.zeros(cols)
+        self._mean = numpy.zeros(cols)
+        self._m2 = numpy.zeros(cols)
+        self._m3 = numpy.zeros(cols)
+        self._m4 = numpy.zeros(cols)
+
+        self._prod = numpy.ones(cols)                   # cumulative product of (1 + returns)
+        self._started = numpy.zeros(cols, dtype=bool)   # have we had a valid return yet?
+        self._max_level = numpy.full(cols, numpy.nan)
+        self._min_dd = numpy.full(cols, numpy.nan)
+        self._rows = 0
+
+        self.update(returns_df)
+
+    def update(self, returns_df):
+        """
+        update - Updates return statistics with returns which follow on from those already seen
+
+        Parameters
+        ----------
+        returns_df : pandas.DataFrame
+            New returns
+
+        Returns
+        -------
+        pandas.DataFrame (cumulative index of the new returns, carrying on from earlier returns)
+        """
+
+        returns = returns_df.values.astype(float)
+
+        self._started_on_first_row = numpy.zeros(len(returns_df.columns), dtype=bool)
+
+        level = numpy.zeros(returns.shape)
+
+        if returns.shape[0] > 0:
+            self._update_moments(returns)
+            level = self._update_drawdown(returns)
+
+        self._set_stats()
+
+        return pandas.DataFrame(data = level, index = returns_df.index, columns = returns_df.columns)
+
+    def get_started_on_first_row(self):
+        """
+        get_started_on_first_row - Which columns had their first valid return on the first row of the last update (so
+        the cumulative index should be 100 on the row before, which was in an earlier update)
+
+        Returns
+        -------
+        numpy.ndarray (bool)
+        """
+        return self._started_on_first_row
+
+    def _update_moments(self, returns):
+        valid = ~numpy.isnan(returns)
+
+        nb = valid.sum(axis=0).astype(float)
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean_b = numpy.where(valid, returns, 0).sum(axis=0) / nb
+            mean_b[nb == 0] = 0
+
+            dev = numpy.where(valid, returns - mean_b, 0)
+
+            m2_b = (dev ** 2).sum(axis=0)
+            m3_b = (dev ** 3).sum(axis=0)
+            m4_b = (dev ** 4).sum(axis=0)
+
+            na = self._count
+            n = na + nb
+
+            delta = mean_b - self._mean
+
+            # pairwise combination of central moments
+            na_nb_n = numpy.where(n > 0, na * nb / n, 0)
+
+            m4 = self._m4 + m4_b \
+                 + delta ** 4 * na_nb_n * numpy.where(n > 0, (na ** 2 - na * nb + nb ** 2) / n ** 2, 0) \
+                 + 6 * delta ** 2 * numpy.where(n > 0, (na ** 2 * m2_b + nb ** 2 * self._m2) / n ** 2, 0) \
+                 + 4 * delta * numpy.where(n > 0, (na * m3_b - nb * self._m3) / n, 0)
+
+            m3 = self._m3 + m3_b \
+                 + delta ** 3 * na_nb_n * numpy.where(n > 0, (na - nb) / n, 0) \
+                 + 3 * delta * numpy.where(n > 0, (na * m2_b - nb * self._m2) / n, 0)
+
+            m2 = self._m2 + m2_b + delta ** 2 * na_nb_n
+
+            mean = self._mean + numpy.where(n > 0, delta * nb / n, 0)
+
+        self._count, self._mean, self._m2, self._m3, self._m4 = n, mean, m2, m3, m4
+
+    def _update_drawdown(self, returns):
+        nan_mask = numpy.isnan(returns)
+
+        # carry on the product in the same order as a cumulative product over the whole history
+        prod = numpy.cumprod(numpy.vstack([self._prod[numpy.newaxis, :],
+                                           numpy.where(nan_mask, 1.0, 1.0 + returns)]), axis=0)[1:]
+
+        self._prod = prod[-1]
+
+        level = 100.0 * prod
+
+        level[nan_mask] = numpy.nan
+
+        # the index starts at 100 one point before the first valid return (see Calculations.create_mult_index)
+        first = numpy.argmax(~nan_mask, axis=0)
+        starting = ~self._started & (~nan_mask).any(axis=0)
+
+        for i in numpy.where(starting)[0]:
+            if first[i] > 0 or self._rows == 0:
+                level[max(first[i] - 1, 0), i] = 100.0
+            else:
+                # point before is in an earlier update
+                self._max_level[i] = numpy.fmax(self._max_level[i], 100.0)
+                self._started_on_first_row[i] = True
+
+        self._started = self._started | starting
+
+        with numpy.errstate(invalid='ignore'):
+            running_max = numpy.fmax.accumulate(numpy.vstack([self._max_level[numpy.newaxis, :], level]), axis=0)
+
+            dd = level / running_max[1:] - 1
+
+        self._max_level = running_max[-1]
+        self._min_dd = numpy.fmin(self._min_dd, numpy.fmin.reduce(dd, axis=0))
+        self._rows = self._rows + returns.shape[0]
+
+        return level
+
+    def _set_stats(self):
+        n = self._count
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = numpy.where(n > 0, self._mean, numpy.nan)
+            var = numpy.where(n > 1, self._m2 / (n - 1), numpy.nan)
+
+            # unbiased excess kurtosis (same as pandas.DataFrame.kurtosis)
+            kurt = numpy.where(n > 3,
+                               n * (n + 1) * (n - 1) * self._m4 / ((n - 2) * (n - 3) * self._m2 ** 2)
+                               - 3 * (n - 1) ** 2 / ((n - 2) * (n - 3)), numpy.nan)
+
+        self._rets = pandas.Series(mean * self._ann_factor, index=self._columns)
+        self._vol = pandas.Series(numpy.sqrt(var) * math.sqrt(self._ann_factor), index=self._columns)
+        self._inforatio = self._rets / self._vol
+        self._kurtosis = pandas.Series(kurt, index=self._columns) / math.sqrt(self._ann_factor)
+        self._dd = pandas.Series(self._min_dd, index=self._columns)
@@ -0,0 +1,321 @@
+__author__ = 'saeedamen'
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+OnlineLeverage
+
+Vol targeting leverage which is updated one bar at a time (eg. in a live trading process), rather than recalculating the
+rolling volatility of the whole history on every bar like RiskEngine.calculate_leverage_factor. Keeps the state of each
+asset in fixed size arrays: either a ring buffer of the last vol_periods returns with running sums (rolling vol, which
+gives the same leverage as RiskEngine) or an exponentially weighted variance (EWMA vol). Each update is O(assets).
+
+Leverage is capped at vol_max_leverage and averaged over each rebalancing period, where bars are in the period of their
+date (eg. the month ending on its last business day for 'BM', including every intraday bar on that day). The average is
+used from the first bar of the next period, or for daily bars (time stamped at midnight) from the rebalance date itself,
+as in RiskEngine. The state can be saved to disk and loaded again, so a live process can carry on where it stopped.
+
+"""
+
+import numpy
+import pandas
+
+class OnlineLeverage(object):
+
+    # attributes which make up the state (saved by save_state)
+    STATE_FIELDS = ['_vol_target', '_vol_max_leverage', '_vol_periods', '_vol_obs_in_year', '_vol_rebalance_freq',
+                    '_method', '_ewma_decay', '_columns', '_bars', '_last_date', '_period_end', '_buffer', '_position',
+                    '_sum', '_sum_sq', '_nan_count', '_count', '_var', '_period_sum', '_period_count', '_leverage',
+                    '_vol']
+
+    def __init__(self, vol_target = 0.1, vol_max_leverage = 5, vol_periods = 60, vol_obs_in_year = 252,
+                 vol_rebalance_freq = 'BM', method = 'rolling', ewma_decay = 0.94):
+        """
+        __init__ - Creates estimator (the number of assets is set by the first update)
+
+        Parameters
+        ----------
+        vol_target : float
+            vol target for assets
+
+        vol_max_leverage : float
+            maximum leverage allowed
+
+        vol_periods : int
+            number of periods to calculate volatility (for EWMA, number of periods before leverage is used)
+
+        vol_obs_in_year : int
+            number of observations in the year
+
+        vol_rebalance_freq : str
+            how often to rebalance (None for every bar)
+
+        method : str
+            'rolling' for rolling window vol or 'ewma' for exponentially weighted vol
+
+        ewma_decay : float
+            weight of the previous variance for EWMA vol (eg. 0.94)
+        """
+
+        if method not in ['rolling', 'ewma']:
+            raise Exception("Unknown vol method " + str(method))
+
+        self._vol_target = vol_target
+        self._vol_max_leverage = vol_max_leverage
+        self._vol_periods = vol_periods
+        self._vol_obs_in_year = vol_obs_in_year
+        self._vol_rebalance_freq = vol_rebalance_freq
+        self._method = method
+        self._ewma_decay = ewma_decay
+
+        self._columns = None
+        self._bars = 0
+        self._set_offset()
+
+    def _set_offset(self):
+        from pandas.tseries.frequencies import to_offset
+
+        self._offset = to_offset(self._vol_rebalance_freq) if self._vol_rebalance_freq is not None else None
+
+    def _create_state(self, assets):
+        self._last_date = None
+        self._period_end = None
+
+        # rolling vol (ring buffer of returns, with running sums of the finite ones)
+        self._buffer = numpy.full((self._vol_periods, assets), numpy.nan)
+        self._position = 0
+        self._sum = numpy.zeros(assets)
+        self._sum_sq = numpy.zeros(assets)
+        self._nan_count = numpy.full(assets, self._vol_periods)
+
+        # EWMA vol
+        self._count = numpy.zeros(assets)
+        self._var = numpy.zeros(assets)
+
+        # leverage averaged over the current rebalancing period, and the leverage in use
+        self._period_sum = numpy.zeros(assets)
+        self._period_count = numpy.zeros(assets)
+        self._leverage = numpy.full(assets, numpy.nan)
+        self._vol = numpy.full(assets, numpy.nan)
+
+    def update(self, date, returns):
+        """
+        update - Updates vol and leverage with the returns of a new bar
+
+        Parameters
+        ----------
+        date : datetime
+            Time of the bar (after the previous bar)
+
+        returns : pandas.Series or numpy.ndarray
+            Returns of each asset over the bar (NaN if unknown)
+
+        Returns
+        -------
+        pandas.Series or numpy.ndarray (leverage for each asset, NaN before enough bars)
+        """
+
+        date = pandas.Timestamp(date)
+
+        if self._columns is None:
+            self._columns = list(returns.index) if isinstance(returns, pandas.Series) else list(range(len(returns)))
+
+            self._create_state(len(self._columns))
+
+        if self._last_date is not None and date <= self._last_date:
+            raise Exception("Bars must be in time order, got " + str(date) + " after " + str(self._last_date))
+
+        self._last_date = date
+
+        if isinstance(returns, pandas.Series):
+            leverage = self._update(date, returns.values.astype(numpy.float64))
+
+            return pandas.Series(leverage, index = returns.index)
+
+        return self._update(date, numpy.asarray(returns, dtype = numpy.float64))
+
+    def _update(self, date, returns):
+        if self._method == 'rolling':
+            vol = self._update_rolling_vol(returns)
+        else:
+            vol = self._update_ewma_vol(returns)
+
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            leverage = self._vol_target / vol
+
+        leverage[leverage > self._vol_max_leverage] = self._vol_max_leverage
+
+        self._vol = vol
+
+        # average leverage over each rebalancing period (keyed on the date of each bar, so every intraday bar on the
+        # rebalance date is in the period ending on that date)
+        if self._offset is None:
+            rebalance = True
+            self._period_sum[:] = 0
+            self._period_count[:] = 0
+        else:
+            day = date.normalize()
+            period_end = self._offset.rollforward(day)
+
+            # first bar of a new period, so the last one is complete and its average is used from now on
+            if self._period_end is None or period_end > self._period_end:
+                if self._period_end is not None: self._apply_period_leverage()
+
+                self._period_end = period_end
+                self._period_sum[:] = 0
+                self._period_count[:] = 0
+
+            # daily bars on the rebalance date are the last bar of the period (as in RiskEngine)
+            rebalance = date == self._period_end
+
+        finite = numpy.isfinite(leverage)
+
+        self._period_sum[finite] = self._period_sum[finite] + leverage[finite]
+        self._period_count[finite] = self._period_count[finite] + 1
+
+        if rebalance: self._apply_period_leverage()
+
+        self._bars = self._bars + 1
+
+        # ignore the first elements before the vol window kicks in
+        if self._bars <= self._vol_periods:
+            return numpy.full(len(self._leverage), numpy.nan)
+
+        return self._leverage.copy()
+
+    def _apply_period_leverage(self):
+        new = self._period_count > 0
+
+        self._leverage[new] = self._period_sum[new] / self._period_count[new]
+
+    def _update_rolling_vol(self, returns):
+        old = self._buffer[self._position]
+
+        old_finite = numpy.isfinite(old)
+        new_finite = numpy.isfinite(returns)
+
+        self._sum = self._sum - numpy.where(old_finite, old, 0) + numpy.where(new_finite, returns, 0)
+        self._sum_sq = self._sum_sq - numpy.where(old_finite, old * old, 0) \
+                       + numpy.where(new_finite, returns * returns, 0)
+        self._nan_count = self._nan_count - ~old_finite + ~new_finite
+
+        self._buffer[self._position] = returns
+        self._position = (self._position + 1) % self._vol_periods
+
+        # recalculate sums from the window each time it wraps around, so rounding errors don't build up
+        if self._position == 0:
+            finite_buffer = numpy.where(numpy.isfinite(self._buffer), self._buffer, 0)
+
+            self._sum = finite_buffer.sum(axis = 0)
+            self._sum_sq = (finite_buffer * finite_buffer).sum(axis = 0)
+
+        n = self._vol_periods
+
+        # like a pandas rolling std, vol is only defined for a full window without gaps
+        with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+            var = (self._sum_sq - self._sum * self._sum / n) / (n - 1)
+
+        var[var < 0] = 0
+        var[self._nan_count > 0] = numpy.nan
+
+        return numpy.sqrt(var * self._vol_obs_in_year)
+
+    def _update_ewma_vol(self, returns):
+        finite = numpy.isfinite(returns)
+
+        # seed with the mean of the squared returns, until there are enough of them
+        seeding = finite & (self._count < self._vol_periods)
+        decaying = finite & ~seeding
+
+        self._count[finite] = self._count[finite] + 1
+
+        self._var[seeding] = self._var[seeding] + (returns[seeding] ** 2 - self._var[seeding]) / self._count[seeding]
+        self._var[decaying] = self._ewma_decay * self._var[decaying] \
+                              + (1.0 - self._ewma_decay) * returns[decaying] ** 2
+
+        var = numpy.where(self._count >= self._vol_periods, self._var, numpy.nan)
+
+        return numpy.sqrt(var * self._vol_obs_in_year)
+
+    def update_data_frame(self, returns_df):
+        """
+        update_data_frame - Updates vol and leverage with the returns of several bars (eg. to seed the estimator from
+        history)
+
+        Parameters
+        ----------
+        returns_df : pandas.DataFrame
+            Returns of each asset
+
+        Returns
+        -------
+        pandas.DataFrame (leverage after each bar)
+        """
+
+        leverage = numpy.empty(returns_df.shape)
+
+        for i in range(0, len(returns_df.index)):
+            leverage[i] = self.update(returns_df.index[i], returns_df.values[i])
+
+        return pandas.DataFrame(data = leverage, index = returns_df.index, columns = returns_df.columns)
+
+    def get_leverage(self):
+        """
+        get_leverage - Gets the leverage in use (as of the last bar)
+
+        Returns
+        -------
+        pandas.Series
+        """
+        if self._bars <= self._vol_periods:
+            return pandas.Series(numpy.nan, index = self._columns)
+
+        return pandas.Series(self._leverage, index = self._columns)
+
+    def get_vol(self):
+        """
+        get_vol - Gets the vol of each asset (as of the last bar, not averaged over the rebalancing period)
+
+        Returns
+        -------
+        pandas.Series
+        """
+        return pandas.Series(self._vol, index = self._columns)
+
+    def save_state(self, path):
+        """
+        save_state - Saves the state of the estimator to disk
+
+        Parameters
+        ----------
+        path : str
+            File to save to
+        """
+        pandas.to_pickle(dict([(x, getattr(self, x, None)) for x in self.STATE_FIELDS]), path)
+
+    def load_state(self, path):
+        """
+        load_state - Loads the state of the estimator (including its parameters) from disk
+
+        Parameters
+        ----------
+        path : str
+            File saved with save_state
+        """
+
+        state = pandas.read_pickle(path)
+
+        for x in self.STATE_FIELDS:
+            setattr(self, x, state[x])
+
+        self._set_offset()
@@ -0,0 +1,360 @@
+__author__ = 'saeedamen'
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+PnLKernel
+
+Calculates the core of a backtest (forward filling signals over asset holidays, applying leverage, P&L, transaction
+costs, combining into a portfolio and cumulative indices) in a single loop over contiguous arrays, compiled with Numba
+when it is installed. This avoids building the intermediate DataFrames of the pandas path, which matters for large
+(eg. intraday) backtests. When Numba isn't installed, it falls back to vectorised NumPy, which gives the same output.
+
+"""
+
+import numpy
+import pandas
+
+from findatapy.timeseries import Calculations
+from findatapy.util import LoggerManager
+
+from finmarketpy.util.arraycalculations import ArrayCalculations
+
+njit = None
+
+try:
+    from numba import njit
+except: pass
+
+def _signal_pnl_loop(asset, signal, leverage, tc, portfolio_sum):
+    rows = asset.shape[0]
+    cols = asset.shape[1]
+
+    signal_out = numpy.empty((rows, cols))
+    pnl = numpy.empty((rows, cols))
+    cumpnl = numpy.empty((rows, cols))
+    portfolio = numpy.empty(rows)
+
+    last_price = numpy.full(cols, numpy.nan)
+    last_signal = numpy.full(cols, numpy.nan)
+    last_leveraged_signal = numpy.full(cols, numpy.nan)
+    prod = numpy.ones(cols)
+    started = numpy.zeros(cols, dtype=numpy.bool_)
+
+    for t in range(rows):
+        total = 0.0
+        count = 0
+
+        for n in range(cols):
+            price = asset[t, n]
+            sig = signal[t, n]
+
+            # signals can only change on days when we can trade the asset, and both are filled down
+            if numpy.isnan(price):
+                price = last_price[n]
+                sig = last_signal[n]
+            elif numpy.isnan(sig):
+                sig = last_signal[n]
+
+            ret = price / last_price[n] - 1.0
+
+            last_price[n] = price
+            last_signal[n] = sig
+
+            if leverage.shape[0] > 0:
+                sig = sig * leverage[t, n]
+
+            prev = last_leveraged_signal[n]
+            last_leveraged_signal[n] = sig
+
+            x = prev * ret - abs(prev - sig) * tc[t, n]
+
+            signal_out[t, n] = sig
+            pnl[t, n] = x
+
+            if numpy.isnan(x):
+                cumpnl[t, n] = numpy.nan
+            else:
+                total += x
+                count += 1
+
+                prod[n] = prod[n] * (1.0 + x)
+                cumpnl[t, n] = 100.0 * prod[n]
+
+                # cumulative index starts at 100 the point before the first return
+                if not started[n]:
+                    started[n] = True
+
+                    if t > 0:
+                        cumpnl[t - 1, n] = 100.0
+                    else:
+                        cumpnl[t, n] = 100.0
+
+        # where every asset is NaN, a sum is 0 and a mean is NaN (as in pandas)
+        if portfolio_sum:
+            portfolio[t] = total
+        elif count == 0:
+            portfolio[t] = numpy.nan
+        else:
+            portfolio[t] = total / count
+
+    # columns which never have a valid return start at 100 on the first point
+    for n in range(cols):
+        if not started[n] and rows > 0:
+            cumpnl[0, n] = 100.0
+
+    return signal_out, pnl, cumpnl, portfolio
+
+def _signal_returns_with_tc_loop(signal, returns, tc):
+    rows = signal.shape[0]
+    cols = signal.shape[1]
+
+    pnl = numpy.empty((rows, cols))
+
+    for n in range(cols):
+        prev = numpy.nan
+
+        for t in range(rows):
+            sig = signal[t, n]
+            pnl[t, n] = prev * returns[t, n] - abs(prev - sig) * tc[t, n]
+            prev = sig
+
+    return pnl
+
+def _mult_index_loop(returns):
+    rows = returns.shape[0]
+    cols = returns.shape[1]
+
+    index = numpy.empty((rows, cols))
+
+    for n in range(cols):
+        prod = 1.0
+        started = False
+
+        for t in range(rows):
+            x = returns[t, n]
+
+            if numpy.isnan(x):
+                index[t, n] = numpy.nan
+            else:
+                prod = prod * (1.0 + x)
+                index[t, n] = 100.0 * prod
+
+                if not started:
+                    started = True
+
+                    if t > 0:
+                        index[t - 1, n] = 100.0
+                    else:
+                        index[t, n] = 100.0
+
+        if not started and rows > 0:
+            index[0, n] = 100.0
+
+    return index
+
+if njit is not None:
+    _signal_pnl_loop = njit(cache=True, nogil=True)(_signal_pnl_loop)
+    _signal_returns_with_tc_loop = njit(cache=True, nogil=True)(_signal_returns_with_tc_loop)
+    _mult_index_loop = njit(cache=True, nogil=True)(_mult_index_loop)
+
+class PnLKernel(object):
+
+    def __init__(self, compiled = None):
+        """
+        __init__ - Creates kernel
+
+        Parameters
+        ----------
+        compiled : bool
+            Use the compiled (Numba) kernel? By default, use it when Numba is installed, otherwise use NumPy
+        """
+        self.logger = LoggerManager().getLogger(__name__)
+
+        if compiled is None: compiled = njit is not None
+
+        if compiled and njit is None:
+            self.logger.warning("Numba is not installed, so using NumPy for P&L kernel")
+
+            compiled = False
+
+        self._compiled = compiled
+
+    def is_compiled(self):
+        return self._compiled
+
+    def _broadcast_tc(self, tc, shape):
+        return numpy.ascontiguousarray(numpy.broadcast_to(numpy.asarray(tc, dtype=numpy.float64), shape))
+
+    def calculate_signal_pnl(self, asset, signal, leverage = None, tc = 0.0, portfolio_combination = 'mean'):
+        """
+        calculate_signal_pnl - Calculates the P&L of signals trading assets (same as Backtest.calculate_trading_PnL before
+        any portfolio vol targeting)
+
+        Parameters
+        ----------
+        asset : numpy.ndarray
+            Asset prices (time x assets), NaN on asset holidays
+
+        signal : numpy.ndarray
+            Signals (time x assets), aligned with asset
+
+        leverage : numpy.ndarray
+            Leverage to apply to signals (time x assets), None for no leverage
+
+        tc : float or numpy.ndarray
+            Transaction costs, which must broadcast against (time x assets), eg. a scalar or one per asset
+
+        portfolio_combination : str
+            'sum' or 'mean' of the individual P&Ls
+
+        Returns
+        -------
+        numpy.ndarray (signal after leverage), numpy.ndarray (P&L), numpy.ndarray (cumulative P&L index),
+        numpy.ndarray (portfolio P&L)
+        """
+
+        asset = numpy.ascontiguousarray(asset, dtype=numpy.float64)
+        signal = numpy.ascontiguousarray(signal, dtype=numpy.float64)
+        tc = self._broadcast_tc(tc, asset.shape)
+
+        if self._compiled:
+            return self._calculate_signal_pnl_loop(asset, signal, leverage, tc, portfolio_combination)
+
+        array_calculations = ArrayCalculations()
+
+        signal = signal.copy()
+        signal[numpy.isnan(asset)] = numpy.nan
+
+        signal = array_calculations.ffill(signal)
+        returns = array_calculations.calculate_returns(array_calculations.ffill(asset))
+
+        if leverage is not None: signal = signal * leverage
+
+        pnl = array_calculations.calculate_signal_returns_with_tc(signal, returns, tc)
+
+        return signal, pnl, array_calculations.create_mult_index(pnl), \
+               array_calculations.combine_portfolio(pnl, portfolio_combination, axis=1)
+
+    def _calculate_signal_pnl_loop(self, asset, signal, leverage, tc, portfolio_combination):
+        # the loop is compiled if Numba is installed, otherwise it runs in pure Python (very slow, only for checking)
+        if leverage is None:
+            leverage = numpy.empty((0, 0))
+        else:
+            leverage = numpy.ascontiguousarray(leverage, dtype=numpy.float64)
+
+        return _signal_pnl_loop(asset, signal, leverage, tc, portfolio_combination == 'sum')
+
+    def calculate_signal_returns_with_tc(self, signal, returns, tc = 0.0):
+        """
+        calculate_signal_returns_with_tc - Calculates returns of signals after transaction costs (eg. for applying
+        portfolio leverage)
+
+        Parameters
+        ----------
+        signal : numpy.ndarray
+            Signals (time x assets)
+
+        returns : numpy.ndarray
+            Returns (time x assets)
+
+        tc : float or numpy.ndarray
+            Transaction costs, which must broadcast against (time x assets)
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        signal = numpy.ascontiguousarray(signal, dtype=numpy.float64)
+        returns = numpy.ascontiguousarray(returns, dtype=numpy.float64)
+
+        if self._compiled:
+            return _signal_returns_with_tc_loop(signal, returns, self._broadcast_tc(tc, signal.shape))
+
+        return ArrayCalculations().calculate_signal_returns_with_tc(signal, returns, tc)
+
+    def create_mult_index(self, returns):
+        """
+        create_mult_index - Creates a cumulative index (starting at 100) from returns (time x assets)
+
+        Parameters
+        ----------
+        returns : numpy.ndarray
+            Returns
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        returns = numpy.ascontiguousarray(returns, dtype=numpy.float64)
+
+        if self._compiled:
+            return _mult_index_loop(returns)
+
+        return ArrayCalculations().create_mult_index(returns)
+
+    def _calculate_signal_pnl_pandas(self, asset, signal, leverage, tc, portfolio_combination):
+        # same steps as the pandas path of Backtest.calculate_trading_PnL
+        calculations = Calculations()
+
+        asset_df = pandas.DataFrame(asset)
+        signal_df = pandas.DataFrame(signal)
+
+        signal_df = signal_df.mask(numpy.isnan(asset_df.values))
+        signal_df = signal_df.fillna(method='ffill')
+        asset_df = asset_df.fillna(method='ffill')
+
+        returns_df = calculations.calculate_returns(asset_df)
+
+        if leverage is not None:
+            signal_df = pandas.DataFrame(signal_df.values * leverage, index=signal_df.index, columns=signal_df.columns)
+
+        pnl_df = calculations.calculate_signal_returns_with_tc_matrix(signal_df, returns_df, tc=tc)
+
+        if portfolio_combination == 'sum':
+            portfolio = pnl_df.sum(axis=1)
+        else:
+            portfolio = pnl_df.mean(axis=1)
+
+        return signal_df.values, pnl_df.values, calculations.create_mult_index(pnl_df).values, portfolio.values
+
+    def check_parity(self, asset, signal, leverage = None, tc = 0.0, portfolio_combination = 'mean'):
+        """
+        check_parity - Checks the loop kernel (compiled with Numba, or in pure Python if Numba isn't installed) and the
+        NumPy kernel both give the same output as the pandas path of Backtest for some data
+
+        Returns
+        -------
+        float (maximum absolute difference, inf if NaNs are in different places)
+        """
+
+        asset = numpy.ascontiguousarray(asset, dtype=numpy.float64)
+        signal = numpy.ascontiguousarray(signal, dtype=numpy.float64)
+        tc = self._broadcast_tc(tc, asset.shape)
+
+        pandas_ = self._calculate_signal_pnl_pandas(asset, signal, leverage, tc, portfolio_combination)
+
+        numpy_ = PnLKernel(compiled = False).calculate_signal_pnl(asset, signal, leverage, tc, portfolio_combination)
+        compiled = self._calculate_signal_pnl_loop(asset, signal, leverage, tc, portfolio_combination)
+
+        diff = 0.0
+
+        for kernel in [compiled, numpy_]:
+            for x, y in zip(kernel, pandas_):
+                if not (numpy.isnan(x) == numpy.isnan(y)).all(): return numpy.inf
+
+                if x.size > 0: diff = max(diff, numpy.nanmax(numpy.abs(x - y), initial=0.0))
+
+        return diff
@@ -0,0 +1,239 @@
+__author__ = 'saeedamen'
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+ReturnsBootstrap
+
+Confidence bands for the statistics reported by RetStats (returns, vol, IR and maximum drawdown), by resampling the
+portfolio and individual asset returns of a Backtest with a stationary (random block lengths) or block (fixed block
+lengths) bootstrap, which keeps some of the autocorrelation of the returns. Rows are resampled together for every column,
+so the correlation between the portfolio and assets is kept too.
+
+The resampled paths are generated as a single (paths x time x columns) array and the statistics calculated with
+vectorised reductions over the time axis, rather than looping over paths. Paths are processed in chunks, to limit memory.
+
+"""
+
+import math
+
+import numpy
+import pandas
+
+from findatapy.util import LoggerManager
+
+class ReturnsBootstrap(object):
+
+    STATS = ['returns', 'vol', 'inforatio', 'drawdown']
+
+    def __init__(self, method = 'stationary', block_length = 20, paths = 10000, chunk_size = 500, seed = None):
+        """
+        __init__ - Creates bootstrap
+
+        Parameters
+        ----------
+        method : str
+            'stationary' (block lengths drawn from a geometric distribution) or 'block' (fixed block lengths)
+
+        block_length : int
+            Average (stationary) or fixed (block) length of each block of returns
+
+        paths : int
+            Number of resampled paths
+
+        chunk_size : int
+            Maximum number of paths to resample together (limits memory)
+
+        seed : int
+            Seed for random numbers (None for random)
+        """
+        self.logger = LoggerManager().getLogger(__name__)
+
+        if method not in ['stationary', 'block']:
+            raise Exception("Bootstrap method must be 'stationary' or 'block'")
+
+        self._method = method
+        self._block_length = block_length
+        self._paths = paths
+        self._chunk_size = chunk_size
+        self._random_state = numpy.random.RandomState(seed)
+
+        self._stats = None
+
+    def create_indices(self, rows, paths):
+        """
+        create_indices - Creates the rows of each resampled path, where blocks wrap around the end of the history
+
+        Parameters
+        ----------
+        rows : int
+            Number of rows of returns
+
+        paths : int
+            Number of paths
+
+        Returns
+        -------
+        numpy.ndarray (paths x rows)
+        """
+
+        t = numpy.arange(rows)
+
+        if self._method == 'stationary':
+            new_block = self._random_state.random_sample((paths, rows)) < 1.0 / self._block_length
+        else:
+            new_block = numpy.zeros((paths, rows), dtype=bool)
+            new_block[:, ::self._block_length] = True
+
+        new_block[:, 0] = True
+
+        # position in each path where its current block started
+        block_start = numpy.maximum.accumulate(numpy.where(new_block, t, 0), axis=1)
+
+        starts = self._random_state.randint(0, rows, size=(paths, rows))
+
+        return (starts[numpy.arange(paths)[:, numpy.newaxis], block_start] + (t - block_start)) % rows
+
+    def calculate_bootstrap_stats(self, returns_df, ann_factor):
+        """
+        calculate_bootstrap_stats - Calculates statistics for every resampled path of returns
+
+        Parameters
+        ----------
+        returns_df : pandas.DataFrame
+            Returns (eg. portfolio and individual assets)
+
+        ann_factor : int
+            Number of observations in a year
+        """
+
+        returns = returns_df.values.astype(numpy.float64)
+
+        # ignore rows before the first return (eg. before signals start)
+        valid_rows = numpy.where((~numpy.isnan(returns)).any(axis=1))[0]
+
+        if len(valid_rows) > 0: returns = returns[valid_rows[0]:]
+
+        rows, cols = returns.shape
+
+        self._columns = returns_df.columns
+        self._stats = dict([(s, numpy.empty((self._paths, cols))) for s in self.STATS])
+
+        if rows == 0:
+            for s in self.STATS: self._stats[s].fill(numpy.nan)
+
+            return
+
+        self.logger.info("Bootstrapping " + str(self._paths) + " paths of " + str(rows) + " returns")
+
+        for start in range(0, self._paths, self._chunk_size):
+            finish = min(start + self._chunk_size, self._paths)
+
+            # all the resampled paths in the chunk as one array (paths x time x columns)
+            resampled = returns[self.create_indices(rows, finish - start)]
+
+            self._calculate_stats(resampled, ann_factor, slice(start, finish))
+
+    def _calculate_stats(self, resampled, ann_factor, paths):
+        valid = ~numpy.isnan(resampled)
+        count = valid.sum(axis=1)
+
+        filled = numpy.where(valid, resampled, 0.0)
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = filled.sum(axis=1) / count
+
+            # sample standard deviation (same as RetStats)
+            var = (numpy.where(valid, resampled - mean[:, numpy.newaxis, :], 0.0) ** 2).sum(axis=1) / (count - 1)
+
+            mean[count < 1] = numpy.nan
+            var[count < 2] = numpy.nan
+
+            rets = mean * ann_factor
+            vol = numpy.sqrt(var) * math.sqrt(ann_factor)
+
+            self._stats['returns'][paths] = rets
+            self._stats['vol'][paths] = vol
+            self._stats['inforatio'][paths] = rets / vol
+
+        # drawdown of cumulative index (which starts at 1 before the first return)
+        level = numpy.cumprod(1.0 + filled, axis=1)
+        running_max = numpy.maximum(numpy.maximum.accumulate(level, axis=1), 1.0)
+
+        drawdown = (level / running_max - 1.0).min(axis=1)
+        drawdown[count < 1] = numpy.nan
+
+        self._stats['drawdown'][paths] = drawdown
+
+    def calculate_backtest_bootstrap(self, backtest, ann_factor = 252, include_assets = True):
+        """
+        calculate_backtest_bootstrap - Calculates statistics for resampled paths of the portfolio returns of a
+        Backtest (and optionally the returns of the individual assets)
+
+        Parameters
+        ----------
+        backtest : Backtest
+            Backtest which has calculated P&L
+
+        ann_factor : int
+            Number of observations in a year
+
+        include_assets : bool
+            Also resample individual asset returns?
+        """
+
+        returns_df = backtest.get_portfolio_pnl()
+
+        if include_assets:
+            returns_df = pandas.concat([returns_df, backtest.get_pnl()], axis=1)
+
+        self.calculate_bootstrap_stats(returns_df, ann_factor)
+
+    def get_stat_paths(self, stat):
+        """
+        get_stat_paths - Gets a statistic for every resampled path
+
+        Parameters
+        ----------
+        stat : str
+            'returns', 'vol', 'inforatio' or 'drawdown'
+
+        Returns
+        -------
+        pandas.DataFrame (paths x columns)
+        """
+
+        return pandas.DataFrame(data = self._stats[stat], columns = self._columns)
+
+    def get_confidence_bands(self, stat = 'inforatio', confidence = 0.95):
+        """
+        get_confidence_bands - Gets confidence bands for a statistic across the resampled paths
+
+        Parameters
+        ----------
+        stat : str
+            'returns', 'vol', 'inforatio' or 'drawdown'
+
+        confidence : float
+            Confidence level (eg. 0.95 for 2.5% and 97.5% percentiles)
+
+        Returns
+        -------
+        pandas.DataFrame (lower, median and upper for each column)
+        """
+
+        tail = (1.0 - confidence) / 2.0
+
+        bands = numpy.nanpercentile(self._stats[stat], [100.0 * tail, 50.0, 100.0 * (1.0 - tail)], axis=0)
+
+        return pandas.DataFrame(data = bands, index = ['Lower', 'Median', 'Upper'], columns = self._columns)
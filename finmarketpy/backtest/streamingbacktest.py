@@ -0,0 +1,190 @@
+__author__ = 'saeedamen'
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+StreamingBacktest
+
+Backtest for histories which are too large to fit in memory (eg. years of intraday data for many assets), which consumes
+time ordered chunks of asset prices and signals (eg. slices of memory mapped arrays from MarketDataCache). The first chunk
+is backtested with Backtest.calculate_trading_PnL and later chunks with Backtest.extend_trading_PnL, which carries on from
+the terminal state of the backtest (last prices and signals, the bars covering the vol window, cumulative index levels
+and running return statistics). The P&L of each chunk is written out and only the last bar is kept in memory, so the
+memory used depends on the chunk size, not the length of the history. The final statistics are the same as calculating
+the backtest in memory.
+
+"""
+
+import copy
+import os
+
+import numpy
+import pandas
+
+from finmarketpy.backtest.backtestengine import Backtest
+from finmarketpy.backtest.incrementalretstats import IncrementalRetStats
+
+class StreamingBacktest(Backtest):
+
+    # outputs written out for each chunk (and the files they are written to)
+    STREAMING_OUTPUTS = {'_pnl' : 'pnl.csv',
+                         '_portfolio' : 'portfolio.csv',
+                         '_cumpnl' : 'cumpnl.csv',
+                         '_cumportfolio' : 'cumportfolio.csv',
+                         '_portfolio_signal' : 'portfolio_signal.csv'}
+
+    # outputs which are trimmed to the last bar after each chunk
+    STREAMING_TRIMMED = ['_pnl', '_portfolio', '_cumpnl', '_cumportfolio', '_portfolio_signal', '_signal',
+                         '_portfolio_leverage', '_portfolio_weights', '_individual_leverage']
+
+    def __init__(self):
+        super(StreamingBacktest, self).__init__()
+
+        self._rows = 0
+
+    def get_chunks(self, asset_df, signal_df, chunk_size):
+        """
+        get_chunks - Splits assets and signals into time ordered chunks, which are slices by position (so memory mapped
+        data stays memory mapped until each chunk is used)
+
+        Parameters
+        ----------
+        asset_df : pandas.DataFrame
+            Asset prices to be traded
+
+        signal_df : pandas.DataFrame
+            Signals for the trading strategy (aligned with assets)
+
+        chunk_size : int
+            Number of bars in each chunk
+
+        Returns
+        -------
+        generator of (pandas.DataFrame, pandas.DataFrame)
+        """
+
+        for start in range(0, len(asset_df.index), chunk_size):
+            yield asset_df.iloc[start:start + chunk_size], signal_df.iloc[start:start + chunk_size]
+
+    def calculate_streaming_PnL(self, br, chunks, output_path = None, chunk_callback = None):
+        """
+        calculate_streaming_PnL - Calculates P&L of a trading strategy from time ordered chunks of assets and signals.
+        Afterwards the return statistics are for the whole history, but time series outputs only have the last bar (the
+        rest are written out)
+
+        Parameters
+        ----------
+        br : BacktestRequest
+            Parameters for the backtest
+
+        chunks : iterable of (pandas.DataFrame, pandas.DataFrame)
+            Asset prices and signals for each chunk (in time order, see get_chunks)
+
+        output_path : str
+            Folder to write outputs of each chunk as CSVs (None to not write them)
+
+        chunk_callback : function
+            Called with a dict of the outputs of each chunk (eg. to write them in another format)
+        """
+
+        # don't calculate return statistics for the first chunk (running statistics are used instead)
+        br_first = copy.copy(br)
+        br_first.lazy_results = True
+
+        if output_path is not None:
+            if not(os.path.isdir(output_path)): os.makedirs(output_path)
+
+            # start new files
+            for f in self.STREAMING_OUTPUTS.values():
+                if os.path.isfile(os.path.join(output_path, f)): os.remove(os.path.join(output_path, f))
+
+        self._rows = 0
+
+        first = True
+
+        for asset_df, signal_df in chunks:
+            if len(asset_df.index) == 0: continue
+
+            if first:
+                self.calculate_trading_PnL(br_first, asset_df, signal_df)
+                self._start_ret_stats(br)
+
+                first = False
+            else:
+                self.extend_trading_PnL(br, asset_df, signal_df)
+
+            # the last bar is held back, because the next chunk can change it (eg. where a cumulative index starts)
+            self._write_chunk(output_path, chunk_callback, slice(0, -1))
+            self._trim()
+
+        if not(first):
+            self._write_chunk(output_path, chunk_callback, slice(0, None))
+
+    def _start_ret_stats(self, br):
+        """
+        _start_ret_stats - Seeds running return statistics (used when extending the backtest) from the first chunk
+        """
+
+        state = self._extend_state
+
+        state['ret_stats_pnl'] = IncrementalRetStats()
+        state['ret_stats_pnl'].calculate_ret_stats(self._pnl.astype(numpy.float64, copy = False), br.ann_factor)
+
+        state['ret_stats_portfolio'] = IncrementalRetStats()
+        state['ret_stats_portfolio'].calculate_ret_stats(self._portfolio.astype(numpy.float64, copy = False),
+                                                         br.ann_factor)
+
+        self._ret_stats_pnl = state['ret_stats_pnl']
+        self._ret_stats_portfolio = state['ret_stats_portfolio']
+
+        self._lazy.discard('_ret_stats_pnl')
+        self._lazy.discard('_ret_stats_portfolio')
+
+        self._calculate_lazy_results()
+
+    def _write_chunk(self, output_path, chunk_callback, rows):
+        outputs = {}
+
+        for name in self.STREAMING_OUTPUTS.keys():
+            outputs[name] = getattr(self, name).iloc[rows]
+
+        if len(outputs['_pnl'].index) == 0: return
+
+        if output_path is not None:
+            for name in self.STREAMING_OUTPUTS.keys():
+                path = os.path.join(output_path, self.STREAMING_OUTPUTS[name])
+
+                outputs[name].to_csv(path, mode = 'a', header = not(os.path.isfile(path)))
+
+        if chunk_callback is not None:
+            chunk_callback(outputs)
+
+        self._rows = self._rows + len(outputs['_pnl'].index)
+
+    def _trim(self):
+        for name in self.STREAMING_TRIMMED:
+            data_frame = getattr(self, name, None)
+
+            if data_frame is not None: setattr(self, name, data_frame.iloc[-1:].copy())
+
+        if numpy.ndim(self._tc) == 2: self._tc = self._tc[-1:].copy()
+
+    def get_rows(self):
+        """
+        get_rows - Gets number of bars written out so far
+
+        Returns
+        -------
+        int
+        """
+        return self._rows
@@ -36,6 +36,8 @@ from chartpy import Chart, Style, ChartConstants
 from findatapy.timeseries import Calculations, Timezone
 from findatapy.util.loggermanager import LoggerManager
 from finmarketpy.backtest import Backtest
+from finmarketpy.backtest.batchbacktest import BatchBacktest
+from finmarketpy.util.sharedframe import SharedFrame
 
 class TradeAnalysis(object):
 
@@ -89,61 +91,133 @@ class TradeAnalysis(object):
 
         plt.show()
 
-    def run_tc_shock(self, strategy, tc = None):
+    def run_tc_shock(self, strategy, tc = None, batch = False, pool_size = None, analytic = False):
+        """
+        run_tc_shock - Backtests a strategy for different levels of transaction costs and plots the results of each
+
+        Parameters
+        ----------
+        strategy : TradingModel
+            defining trading strategy
+
+        tc : list(float)
+            Transaction costs (bp)
+
+        batch : bool
+            Calculate the backtests together with BatchBacktest (vectorised)
+
+        pool_size : int
+            Number of worker processes to calculate the backtests in parallel (None to run serially)
+
+        analytic : bool
+            Calculate signals, gross P&L and turnover once, then every level of transaction costs in one matrix
+            operation (time taken hardly depends on the number of levels)
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
         if tc is None: tc = [0, 0.25, 0.5, 0.75, 1, 1.25, 1.5, 1.75, 2.0]
 
         parameter_list = [{'spot_tc_bp' : x } for x in tc]
         pretty_portfolio_names = [str(x) + 'bp' for x in tc]    # names of the portfolio
         parameter_type = 'TC analysis'                          # broad type of parameter name
 
+        if analytic:
+            port_list, ir = self._run_tc_shock_analytic(strategy, parameter_list, pretty_portfolio_names)
+
+            return self._plot_sensitivity(strategy, port_list, ir, pretty_portfolio_names, parameter_type)
+
         return self.run_arbitrary_sensitivity(strategy,
                                  parameter_list=parameter_list,
                                  pretty_portfolio_names=pretty_portfolio_names,
-                                 parameter_type=parameter_type)
+                                 parameter_type=parameter_type,
+                                 batch=batch,
+                                 pool_size=pool_size)
 
     ###### Parameters and signal generations (need to be customised for every model)
     def run_arbitrary_sensitivity(self, trading_model, parameter_list = None, parameter_names = None,
-                                  pretty_portfolio_names = None, parameter_type = None):
-
-        asset_df, spot_df, spot_df2, basket_dict = trading_model.fill_assets()
+                                  pretty_portfolio_names = None, parameter_type = None, batch = False,
+                                  pool_size = None):
+        """
+        run_arbitrary_sensitivity - Backtests a strategy for a list of parameters and plots the results of each
 
-        port_list = None
-        ret_stats_list = []
+        Parameters
+        ----------
+        trading_model : TradingModel
+            defining trading strategy
 
-        for i in range(0, len(parameter_list)):
-            br = trading_model.fill_backtest_request()
+        parameter_list : list(dict)
+            BacktestRequest fields to change for each backtest
 
-            current_parameter = parameter_list[i]
+        pretty_portfolio_names : list(str)
+            Names of each backtest
 
-            # for calculating P&L
-            for k in current_parameter.keys():
-                setattr(br, k, current_parameter[k])
+        parameter_type : str
+            Broad type of parameter name
 
-            trading_model.br = br   # for calculating signals
+        batch : bool
+            Calculate the backtests together with BatchBacktest (vectorised)
 
-            signal_df = trading_model.construct_signal(spot_df, spot_df2, br.tech_params, br)
+        pool_size : int
+            Number of worker processes to calculate the backtests in parallel (None to run serially)
 
-            backtest = Backtest()
-            self.logger.info("Calculating... " + str(pretty_portfolio_names[i]))
+        Returns
+        -------
+        pandas.DataFrame
+        """
 
-            backtest.calculate_trading_PnL(br, asset_df, signal_df)
-            ret_stats_list.append(backtest.get_portfolio_pnl_ret_stats())
-            stats = str(backtest.get_portfolio_pnl_desc()[0])
+        asset_df, spot_df, spot_df2, basket_dict = trading_model.fill_assets()
 
-            port = backtest.get_cumportfolio().resample('B').mean()
-            port.columns = [str(pretty_portfolio_names[i]) + ' ' + stats]
+        if batch:
+            port_list, ir = self._run_arbitrary_sensitivity_batch(trading_model, asset_df, spot_df, spot_df2,
+                                                                  parameter_list, pretty_portfolio_names)
+        else:
+            if pool_size is not None and pool_size > 1:
+                self.logger.info("Calculating " + str(len(parameter_list)) + " parameters on "
+                                 + str(pool_size) + " processes...")
 
-            if port_list is None:
-                port_list = port
+                results = self._run_pool(_run_sensitivity_worker, trading_model, [asset_df, spot_df, spot_df2],
+                                         parameter_list, pool_size)
             else:
-                port_list = port_list.join(port)
+                results = []
+
+                for i in range(0, len(parameter_list)):
+                    self.logger.info("Calculating... " + str(pretty_portfolio_names[i]))
+
+                    results.append(_run_sensitivity_parameter(trading_model, asset_df, spot_df, spot_df2,
+                                                              parameter_list[i]))
+
+            port_list = None
+            ir = []
+
+            # results are always in the same order as the parameters
+            for i in range(0, len(results)):
+                port, stats, port_ir = results[i]
+
+                port.columns = [str(pretty_portfolio_names[i]) + ' ' + stats]
+                ir.append(port_ir)
+
+                if port_list is None:
+                    port_list = port
+                else:
+                    port_list = port_list.join(port)
 
         # reset the parameters of the strategy
         trading_model.br = trading_model.fill_backtest_request()
 
-        style = Style()
+        return self._plot_sensitivity(trading_model, port_list, ir, pretty_portfolio_names, parameter_type)
 
-        ir = [t.inforatio()[0] for t in ret_stats_list]
+    def _plot_sensitivity(self, trading_model, port_list, ir, pretty_portfolio_names, parameter_type):
+        """
+        _plot_sensitivity - Plots the cumulative returns and IR of a strategy for a list of parameters
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        style = Style()
 
         # if we have too many combinations remove legend and use scaled shaded colour
         # if len(port_list) > 10:
@@ -171,28 +245,152 @@ class TradeAnalysis(object):
 
         return port_list
 
-    ###### Parameters and signal generations (need to be customised for every model)
-    ###### Plot all the output seperately
-    def run_arbitrary_sensitivity_separately(self, trading_model, parameter_list = None,
-                                             pretty_portfolio_names = None, strip = None):
+    def _run_tc_shock_analytic(self, trading_model, parameter_list, pretty_portfolio_names):
+        """
+        _run_tc_shock_analytic - Calculates the backtests for every level of transaction costs with
+        BatchBacktest.calculate_tc_shock_PnL, so the signal is only constructed once
 
-        # asset_df, spot_df, spot_df2, basket_dict = strat.fill_assets()
-        final_strategy = trading_model.FINAL_STRATEGY
+        Returns
+        -------
+        pandas.DataFrame (cumulative portfolios), list(float) (IR of each portfolio)
+        """
+
+        asset_df, spot_df, spot_df2, basket_dict = trading_model.fill_assets()
+
+        br_list = []
+
+        for current_parameter in parameter_list:
+            br = trading_model.fill_backtest_request()
+
+            for k in current_parameter.keys():
+                setattr(br, k, current_parameter[k])
+
+            br_list.append(br)
+
+        trading_model.br = br_list[0]   # for calculating signals (which don't depend on transaction costs)
+
+        signal_df = trading_model.construct_signal_cached(spot_df, spot_df2, br_list[0].tech_params, br_list[0])
+
+        self.logger.info("Calculating " + str(len(br_list)) + " levels of transaction costs...")
+
+        batch_backtest = BatchBacktest()
+        batch_backtest.calculate_tc_shock_PnL(br_list, asset_df, signal_df,
+                                              portfolio_names = [str(x) for x in pretty_portfolio_names])
+
+        stats = batch_backtest.get_portfolio_pnl_desc()
+        ir = list(batch_backtest.get_portfolio_pnl_ret_stats().inforatio())
+
+        port_list = batch_backtest.get_cumportfolio().resample('B').mean()
+        port_list.columns = [str(pretty_portfolio_names[i]) + ' ' + str(stats[i]) for i in range(0, len(stats))]
+
+        # reset the parameters of the strategy
+        trading_model.br = trading_model.fill_backtest_request()
+
+        return port_list, ir
+
+    def _run_arbitrary_sensitivity_batch(self, trading_model, asset_df, spot_df, spot_df2, parameter_list,
+                                         pretty_portfolio_names):
+        """
+        _run_arbitrary_sensitivity_batch - Calculates the backtests for every parameter using BatchBacktest, grouping
+        together parameters which only differ by signal or transaction costs, so each group is one vectorised pass
+
+        Returns
+        -------
+        pandas.DataFrame (cumulative portfolios), list(float) (IR of each portfolio)
+        """
+
+        from collections import OrderedDict
+
+        batch_backtest = BatchBacktest()     # only used to group parameters
+
+        br_list = []
+        signal_list = []
+        groups = OrderedDict()
 
         for i in range(0, len(parameter_list)):
             br = trading_model.fill_backtest_request()
 
             current_parameter = parameter_list[i]
 
-            # for calculating P&L
             for k in current_parameter.keys():
                 setattr(br, k, current_parameter[k])
 
+            trading_model.br = br   # for calculating signals
+
+            br_list.append(br)
+            signal_list.append(trading_model.construct_signal_cached(spot_df, spot_df2, br.tech_params, br))
+
+            groups.setdefault(batch_backtest.get_shared_key(br), []).append(i)
+
+        port = [None] * len(parameter_list)
+        ir = [None] * len(parameter_list)
+
+        for key in groups.keys():
+            ind = groups[key]
+
+            self.logger.info("Calculating batch... " + ", ".join([str(pretty_portfolio_names[i]) for i in ind]))
+
+            batch_backtest = BatchBacktest()
+            batch_backtest.calculate_trading_PnL([br_list[i] for i in ind], asset_df, [signal_list[i] for i in ind],
+                                                 portfolio_names = [str(pretty_portfolio_names[i]) for i in ind])
+
+            stats = batch_backtest.get_portfolio_pnl_desc()
+            batch_ir = batch_backtest.get_portfolio_pnl_ret_stats().inforatio()
+            cumportfolio = batch_backtest.get_cumportfolio().resample('B').mean()
+
+            for j in range(0, len(ind)):
+                port[ind[j]] = cumportfolio[[cumportfolio.columns[j]]]
+                port[ind[j]].columns = [str(pretty_portfolio_names[ind[j]]) + ' ' + str(stats[j])]
+                ir[ind[j]] = batch_ir[j]
+
+        # results are returned in the same order as the parameters
+        port_list = port[0]
+
+        for i in range(1, len(port)):
+            port_list = port_list.join(port[i])
+
+        return port_list, ir
+
+    ###### Parameters and signal generations (need to be customised for every model)
+    ###### Plot all the output seperately
+    def run_arbitrary_sensitivity_separately(self, trading_model, parameter_list = None,
+                                             pretty_portfolio_names = None, strip = None, pool_size = None):
+
+        # asset_df, spot_df, spot_df2, basket_dict = strat.fill_assets()
+        final_strategy = trading_model.FINAL_STRATEGY
+
+        results = None
+
+        # calculate every strategy in parallel first (assets are loaded once), then plot them in order
+        if pool_size is not None and pool_size > 1:
+            self.logger.info("Calculating " + str(len(parameter_list)) + " parameters on "
+                             + str(pool_size) + " processes...")
+
+            asset_df, spot_df, spot_df2, basket_dict = trading_model.load_assets()
+
+            args = [dict(parameter_list[i], FINAL_STRATEGY = final_strategy + " " + pretty_portfolio_names[i])
+                    for i in range(0, len(parameter_list))]
+
+            results = self._run_pool(_run_strategy_worker, trading_model, [asset_df, spot_df, spot_df2], args,
+                                     pool_size, basket_dict = basket_dict)
+
+        for i in range(0, len(parameter_list)):
             trading_model.FINAL_STRATEGY = final_strategy + " " + pretty_portfolio_names[i]
 
-            self.logger.info("Calculating... " + pretty_portfolio_names[i])
-            trading_model.br = br
-            trading_model.construct_strategy(br = br)
+            if results is not None:
+                trading_model.__dict__.update(results[i])
+            else:
+                br = trading_model.fill_backtest_request()
+
+                current_parameter = parameter_list[i]
+
+                # for calculating P&L
+                for k in current_parameter.keys():
+                    setattr(br, k, current_parameter[k])
+
+                self.logger.info("Calculating... " + pretty_portfolio_names[i])
+                trading_model.br = br
+                trading_model.construct_strategy(br = br)
 
             trading_model.plot_strategy_pnl()
             trading_model.plot_strategy_leverage()
@@ -202,6 +400,36 @@ class TradeAnalysis(object):
         trading_model.br = trading_model.fill_backtest_request()
         trading_model.FINAL_STRATEGY = final_strategy
 
+    def _run_pool(self, worker, trading_model, data_frame_list, parameter_list, pool_size, basket_dict = None):
+        """
+        _run_pool - Runs a worker function for every parameter in a process pool. The trading model and market data are
+        sent to each worker process once when it starts (market data through shared memory), rather than with every
+        parameter.
+
+        Returns
+        -------
+        list (results of worker, in the same order as parameter_list)
+        """
+
+        import multiprocessing
+
+        shared_frames = [SharedFrame(x) for x in data_frame_list]
+
+        try:
+            pool = multiprocessing.Pool(processes = pool_size, initializer = _init_worker,
+                                        initargs = (trading_model, shared_frames, basket_dict))
+
+            try:
+                # map preserves the order of the parameters
+                results = pool.map(worker, parameter_list, chunksize = 1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            for x in shared_frames: x.close()
+
+        return results
+
     def run_day_of_month_analysis(self, trading_model):
         from finmarketpy.economics.seasonality import Seasonality
 
@@ -249,6 +477,73 @@ class TradeAnalysis(object):
 
         return month
 
+#######################################################################################################################
+
+# state of each worker process (set once when the process starts)
+_worker_state = {}
+
+def _init_worker(trading_model, shared_frames, basket_dict):
+    _worker_state['trading_model'] = trading_model
+    _worker_state['data_frames'] = [x.get_data_frame() for x in shared_frames]
+    _worker_state['shared_frames'] = shared_frames  # keep shared memory attached
+    _worker_state['basket_dict'] = basket_dict
+
+def _run_sensitivity_parameter(trading_model, asset_df, spot_df, spot_df2, current_parameter):
+    """
+    _run_sensitivity_parameter - Backtests the strategy signal for one set of parameters
+
+    Returns
+    -------
+    pandas.DataFrame (cumulative portfolio), str (statistics), float (IR)
+    """
+
+    br = trading_model.fill_backtest_request()
+
+    # for calculating P&L
+    for k in current_parameter.keys():
+        setattr(br, k, current_parameter[k])
+
+    trading_model.br = br   # for calculating signals
+
+    signal_df = trading_model.construct_signal_cached(spot_df, spot_df2, br.tech_params, br)
+
+    # only need the portfolio statistics, so don't calculate the other outputs
+    if not(hasattr(br, 'lazy_results')): br.lazy_results = True
+
+    backtest = Backtest()
+    backtest.calculate_trading_PnL(br, asset_df, signal_df)
+
+    stats = str(backtest.get_portfolio_pnl_desc()[0])
+    ir = backtest.get_portfolio_pnl_ret_stats().inforatio()[0]
+
+    port = backtest.get_cumportfolio().resample('B').mean()
+
+    return port, stats, ir
+
+def _run_sensitivity_worker(current_parameter):
+    asset_df, spot_df, spot_df2 = _worker_state['data_frames']
+
+    return _run_sensitivity_parameter(_worker_state['trading_model'], asset_df, spot_df, spot_df2, current_parameter)
+
+def _run_strategy_worker(current_parameter):
+    trading_model = _worker_state['trading_model']
+    asset_df, spot_df, spot_df2 = _worker_state['data_frames']
+    basket_dict = _worker_state['basket_dict']
+
+    # use the market data already loaded by the parent process
+    trading_model.load_assets = lambda: (asset_df, spot_df, spot_df2, basket_dict)
+
+    br = trading_model.fill_backtest_request()
 
+    for k in current_parameter.keys():
+        if k == 'FINAL_STRATEGY':
+            trading_model.FINAL_STRATEGY = current_parameter[k]
+        else:
+            setattr(br, k, current_parameter[k])
 
+    trading_model.br = br
+    trading_model.construct_strategy(br = br)
 
+    # only send back the results of the strategy
+    return dict([(k, v) for k, v in trading_model.__dict__.items()
+                 if k.startswith('_strategy') or k.startswith('_benchmark') or k == '_individual_leverage'])
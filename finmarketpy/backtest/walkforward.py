@@ -0,0 +1,361 @@
+__author__ = 'saeedamen'
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+WalkForward
+
+Walk forward optimisation of the TechParams of a TradingModel. The assets are loaded once, and the signal and portfolio
+returns for every parameter are calculated once over the whole history (in batches with BatchBacktest, optionally
+constructing the signals of each batch in parallel in a process pool). Each fold then picks the parameter with the best
+in sample objective (eg. IR) using views of the portfolio returns (rather than copies or new backtests) and the out of
+sample returns of the chosen parameters are stitched together.
+
+The out of sample returns of each fold are those of the chosen parameter backtested over the whole history, so any
+transaction costs from switching parameters between folds are not included.
+
+"""
+
+import copy
+import itertools
+import math
+
+from collections import OrderedDict
+
+import numpy
+import pandas
+
+from findatapy.timeseries import Calculations, RetStats
+from findatapy.util import LoggerManager
+
+from finmarketpy.backtest.batchbacktest import BatchBacktest
+from finmarketpy.util.sharedframe import SharedFrame
+
+class WalkForward(object):
+
+    def __init__(self):
+        self.logger = LoggerManager().getLogger(__name__)
+        self._oos_pnl = None
+
+    def create_parameter_grid(self, parameter_dict):
+        """
+        create_parameter_grid - Creates every combination of TechParams values
+
+        Parameters
+        ----------
+        parameter_dict : dict
+            TechParams fields and the values to try for each (eg. {'sma_period' : [20, 50, 100, 200]})
+
+        Returns
+        -------
+        list(dict)
+        """
+
+        keys = list(parameter_dict.keys())
+
+        return [OrderedDict(zip(keys, values)) for values in itertools.product(*[parameter_dict[k] for k in keys])]
+
+    def create_folds(self, index, in_sample_periods, out_sample_periods, anchored = False):
+        """
+        create_folds - Creates a fold schedule, where each in sample period is followed by an out of sample period, and
+        folds are rolled forward by the out of sample period (so out of sample periods don't overlap)
+
+        Parameters
+        ----------
+        index : pandas.DatetimeIndex
+            Dates of the backtest
+
+        in_sample_periods : int
+            Number of points in each in sample period
+
+        out_sample_periods : int
+            Number of points in each out of sample period
+
+        anchored : bool
+            Should every in sample period start at the beginning of the history (otherwise a rolling window)?
+
+        Returns
+        -------
+        list(tuple) (positions of in sample start, in sample end/out of sample start, out of sample end)
+        """
+
+        folds = []
+
+        in_sample_end = in_sample_periods
+
+        while in_sample_end < len(index):
+            in_sample_start = 0 if anchored else in_sample_end - in_sample_periods
+            out_sample_end = min(in_sample_end + out_sample_periods, len(index))
+
+            folds.append((in_sample_start, in_sample_end, out_sample_end))
+
+            in_sample_end = out_sample_end
+
+        return folds
+
+    def run_walk_forward(self, trading_model, parameter_grid, folds = None, in_sample_periods = 756,
+                         out_sample_periods = 252, anchored = False, objective = 'ir', pool_size = None,
+                         batch_size = 20):
+        """
+        run_walk_forward - Runs walk forward optimisation of a trading strategy (its FINAL_STRATEGY basket)
+
+        Parameters
+        ----------
+        trading_model : TradingModel
+            defining trading strategy
+
+        parameter_grid : list(dict) or dict
+            TechParams values for each parameter, or the values to try for each field (see create_parameter_grid)
+
+        folds : list(tuple)
+            Fold schedule (see create_folds), by default created from in_sample_periods and out_sample_periods
+
+        in_sample_periods : int
+            Number of points in each in sample period
+
+        out_sample_periods : int
+            Number of points in each out of sample period
+
+        anchored : bool
+            Should every in sample period start at the beginning of the history?
+
+        objective : str or function
+            'ir' or 'returns' (annualised) or a function which takes in sample returns (time x parameters array) and
+            gives a score for each parameter (higher is better)
+
+        pool_size : int
+            Number of processes to construct the signals of each batch of parameters in parallel (None to run serially)
+
+        batch_size : int
+            Number of parameters to backtest together (limits memory)
+
+        Returns
+        -------
+        pandas.DataFrame (cumulative out of sample portfolio)
+        """
+
+        if isinstance(parameter_grid, dict): parameter_grid = self.create_parameter_grid(parameter_grid)
+
+        # load the market data only once for every parameter
+        asset_df, spot_df, spot_df2, basket_dict = trading_model.load_assets()
+
+        tickers = basket_dict[trading_model.FINAL_STRATEGY]
+
+        asset_cut_df = asset_df[[x + '.close' for x in tickers]]
+        spot_cut_df = spot_df[[x + '.close' for x in tickers]]
+
+        names = [', '.join([str(k) + '=' + str(v) for k, v in p.items()]) for p in parameter_grid]
+
+        # portfolio returns of every parameter over the whole history (time x parameters)
+        returns = numpy.empty((len(asset_cut_df.index), len(parameter_grid)))
+
+        br_list = []
+
+        for i in range(0, len(parameter_grid)):
+            br = trading_model.fill_backtest_request()
+            br.tech_params = copy.deepcopy(br.tech_params)
+
+            for k in parameter_grid[i].keys():
+                setattr(br.tech_params, k, parameter_grid[i][k])
+
+            br_list.append(br)
+
+        # signals are calculated with the parameters set on the strategy, which are reset afterwards
+        has_br = hasattr(trading_model, 'br')
+        original_br = getattr(trading_model, 'br', None)
+
+        pool = None
+        shared_frames = []
+
+        try:
+            if pool_size is not None and pool_size > 1:
+                import multiprocessing
+
+                # the strategy and market data are sent to each worker process once (market data through shared memory)
+                shared_frames = [SharedFrame(spot_cut_df), SharedFrame(spot_df2)]
+
+                pool = multiprocessing.Pool(processes = pool_size, initializer = _init_signal_worker,
+                                            initargs = (trading_model, shared_frames))
+
+            for start in range(0, len(parameter_grid), batch_size):
+                finish = min(start + batch_size, len(parameter_grid))
+
+                self.logger.info("Calculating parameters " + ", ".join(names[start:finish]))
+
+                # map preserves the order of the parameters
+                if pool is not None:
+                    signal_df_list = pool.map(_run_signal_worker, br_list[start:finish], chunksize = 1)
+                else:
+                    signal_df_list = [_construct_signal(trading_model, spot_cut_df, spot_df2, br)
+                                      for br in br_list[start:finish]]
+
+                batch_backtest = BatchBacktest()
+                batch_backtest.calculate_trading_PnL(br_list[finish - 1], asset_cut_df, signal_df_list)
+
+                returns[:, start:finish] = batch_backtest.get_portfolio_pnl().values
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+            for x in shared_frames: x.close()
+
+            # reset the parameters of the strategy (without leaving parameters on a strategy which didn't have any)
+            if has_br:
+                trading_model.br = original_br
+            elif hasattr(trading_model, 'br'):
+                del trading_model.br
+
+        if folds is None:
+            folds = self.create_folds(asset_cut_df.index, in_sample_periods, out_sample_periods, anchored = anchored)
+
+        ann_factor = br_list[-1].ann_factor
+
+        fold_results = []
+
+        for fold in folds:
+            in_sample_start, in_sample_end, out_sample_end = fold
+
+            # views of the returns (no copies)
+            score = self._calculate_objective(returns[in_sample_start:in_sample_end], objective, ann_factor)
+
+            # ignore parameters with no valid score in sample
+            if numpy.isnan(score).all():
+                best = 0
+            else:
+                best = int(numpy.nanargmax(score))
+
+            fold_results.append((best, score[best]))
+
+        # stitch together the out of sample returns of the best parameter in each fold
+        oos_pnl = numpy.empty(len(asset_cut_df.index))
+        oos_pnl.fill(numpy.nan)
+
+        index = asset_cut_df.index
+        fold_summary = []
+
+        for fold, result in zip(folds, fold_results):
+            in_sample_start, in_sample_end, out_sample_end = fold
+            best, score = result
+
+            oos_pnl[in_sample_end:out_sample_end] = returns[in_sample_end:out_sample_end, best]
+
+            fold_summary.append([index[in_sample_start], index[in_sample_end - 1], index[in_sample_end],
+                                 index[out_sample_end - 1], names[best], score])
+
+        oos_pnl = pandas.DataFrame(data = oos_pnl, index = index, columns = ['Port'])
+
+        if len(folds) > 0:
+            oos_pnl = oos_pnl.iloc[folds[0][1]:]
+
+        self._parameter_grid = parameter_grid
+        self._parameter_pnl = pandas.DataFrame(data = returns, index = index, columns = names)
+        self._fold_summary = pandas.DataFrame(data = fold_summary,
+                                              columns = ['In Sample Start', 'In Sample Finish', 'Out Sample Start',
+                                                         'Out Sample Finish', 'Parameters', 'In Sample Score'])
+        self._oos_pnl = oos_pnl
+
+        self._ret_stats_oos = RetStats()
+        self._ret_stats_oos.calculate_ret_stats(oos_pnl, ann_factor)
+
+        self._cum_oos_pnl = Calculations().create_mult_index(oos_pnl)
+        self._cum_oos_pnl.columns = ['Port']
+
+        return self._cum_oos_pnl
+
+    def _calculate_objective(self, returns, objective, ann_factor):
+        if callable(objective):
+            return numpy.asarray(objective(returns), dtype=float)
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            count = (~numpy.isnan(returns)).sum(axis=0)
+            mean = numpy.where(count > 0, numpy.nansum(returns, axis=0) / numpy.maximum(count, 1), numpy.nan)
+
+            if objective == 'returns':
+                return mean * ann_factor
+
+            # same as RetStats (sample standard deviation)
+            var = numpy.nansum((returns - mean) ** 2, axis=0) / (count - 1)
+            var[count < 2] = numpy.nan
+
+            return (mean * ann_factor) / (numpy.sqrt(var) * math.sqrt(ann_factor))
+
+    def get_oos_pnl(self):
+        """
+        get_oos_pnl - Gets out of sample portfolio returns (stitched together from every fold)
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return self._oos_pnl
+
+    def get_cum_oos_pnl(self):
+        """
+        get_cum_oos_pnl - Gets out of sample portfolio returns as a cumulative time series
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return self._cum_oos_pnl
+
+    def get_oos_ret_stats(self):
+        """
+        get_oos_ret_stats - Gets return statistics of out of sample portfolio
+
+        Returns
+        -------
+        RetStats
+        """
+        return self._ret_stats_oos
+
+    def get_fold_summary(self):
+        """
+        get_fold_summary - Gets the dates of each fold, the parameter chosen and its in sample score
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return self._fold_summary
+
+    def get_parameter_pnl(self):
+        """
+        get_parameter_pnl - Gets portfolio returns of every parameter over the whole history
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return self._parameter_pnl
+
+#######################################################################################################################
+
+# state of each signal worker process (set once when the process starts)
+_signal_worker_state = {}
+
+def _init_signal_worker(trading_model, shared_frames):
+    _signal_worker_state['trading_model'] = trading_model
+    _signal_worker_state['data_frames'] = [x.get_data_frame() for x in shared_frames]
+    _signal_worker_state['shared_frames'] = shared_frames  # keep shared memory attached
+
+def _run_signal_worker(br):
+    spot_df, spot_df2 = _signal_worker_state['data_frames']
+
+    return _construct_signal(_signal_worker_state['trading_model'], spot_df, spot_df2, br)
+
+def _construct_signal(trading_model, spot_df, spot_df2, br):
+    trading_model.br = br   # for calculating signals
+
+    return trading_model.construct_signal_cached(spot_df, spot_df2, br.tech_params, br)
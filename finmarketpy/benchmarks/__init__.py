@@ -0,0 +1,4 @@
+__author__ = 'saeedamen'
+
+from finmarketpy.benchmarks.benchmarkrunner import BenchmarkRunner
+from finmarketpy.benchmarks.syntheticdata import SyntheticData
@@ -0,0 +1,414 @@
+__author__ = 'saeedamen' # Saeed Amen
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+BenchmarkRunner
+
+Benchmarks the main calculations of finmarketpy (Backtest.calculate_trading_PnL, RiskEngine.calculate_leverage_factor,
+each TechIndicator, EventStudy.get_intraday_moves_over_custom_event and Seasonality) on deterministic synthetic data
+from SyntheticData, so they run offline and give comparable results between runs. Records the wall time, CPU time and
+peak memory of each benchmark (best of several repeats) to a JSON results file, which can be compared against a stored
+baseline to find regressions.
+
+Run from the command line with
+
+    python -m finmarketpy.benchmarks.benchmarkrunner --assets 50 --periods 2520 --output results.json --baseline base.json
+
+"""
+
+import json
+import platform
+
+from collections import OrderedDict
+
+import pandas
+
+from findatapy.util import LoggerManager
+
+from finmarketpy.benchmarks.syntheticdata import SyntheticData
+from finmarketpy.util.stageprofiler import StageProfiler
+
+class BenchmarkRunner(object):
+
+    TECH_INDICATORS = ['SMA', 'EMA', 'ROC', 'polarity', 'SMA2', 'RSI', 'BB', 'long-only']
+
+    def __init__(self, assets = 10, periods = 2520, intraday_periods = 100000, repeat = 3, seed = 0,
+                 trace_memory = True):
+        """
+        __init__ - Creates runner
+
+        Parameters
+        ----------
+        assets : int
+            Number of assets in the universe
+
+        periods : int
+            Number of daily observations
+
+        intraday_periods : int
+            Number of minute observations (for event studies and intraday seasonality)
+
+        repeat : int
+            Number of times to run each benchmark (fastest is recorded)
+
+        seed : int
+            Seed for synthetic data
+
+        trace_memory : bool
+            Record peak memory of each benchmark (tracemalloc slows down Python code, so timings are also measured
+            separately without it)
+        """
+        self.logger = LoggerManager().getLogger(__name__)
+
+        self._assets = assets
+        self._periods = periods
+        self._intraday_periods = intraday_periods
+        self._repeat = repeat
+        self._seed = seed
+        self._trace_memory = trace_memory
+
+        self._results = None
+
+    def create_data(self):
+        """
+        create_data - Creates the synthetic data used by the benchmarks
+
+        Returns
+        -------
+        dict
+        """
+
+        synthetic_data = SyntheticData(seed = self._seed)
+
+        data = {}
+
+        data['prices'] = synthetic_data.create_prices(assets = self._assets, periods = self._periods,
+                                                      holiday_prob = 0.01)
+        data['intraday'] = synthetic_data.create_prices(assets = 1, periods = self._intraday_periods, freq = '1min',
+                                                        start_date = '01 Jan 2016', obs_in_year = 252 * 1440)
+        data['events'] = synthetic_data.create_economic_events(start_date = data['intraday'].index[0],
+                                                               finish_date = data['intraday'].index[-1],
+                                                               freq = 'B')
+
+        return data
+
+    def get_benchmarks(self):
+        """
+        get_benchmarks - Gets every benchmark, as functions which take the synthetic data
+
+        Returns
+        -------
+        OrderedDict(str, function)
+        """
+
+        benchmarks = OrderedDict()
+
+        benchmarks['Backtest.calculate_trading_PnL'] = self._benchmark_backtest
+        benchmarks['RiskEngine.calculate_leverage_factor'] = self._benchmark_leverage
+
+        for name in self.TECH_INDICATORS:
+            benchmarks['TechIndicator.create_tech_ind ' + name] = self._create_tech_ind_benchmark(name)
+
+        benchmarks['TechIndicator.create_tech_ind_batch SMA'] = self._benchmark_tech_ind_batch
+
+        benchmarks['EventStudy.get_intraday_moves_over_custom_event'] = self._benchmark_event_study
+        benchmarks['Seasonality.time_of_day_seasonality'] = self._benchmark_time_of_day_seasonality
+        benchmarks['Seasonality.bus_day_of_month_seasonality'] = self._benchmark_bus_day_of_month_seasonality
+        benchmarks['Seasonality.monthly_seasonality'] = self._benchmark_monthly_seasonality
+
+        return benchmarks
+
+    def _create_backtest_request(self):
+        from finmarketpy.backtest import BacktestRequest
+
+        br = BacktestRequest()
+
+        br.spot_tc_bp = 2.5
+        br.ann_factor = 252
+
+        br.signal_vol_adjust = True
+        br.signal_vol_target = 0.1
+        br.signal_vol_max_leverage = 5
+        br.signal_vol_periods = 20
+        br.signal_vol_obs_in_year = 252
+        br.signal_vol_rebalance_freq = 'BM'
+        br.signal_vol_resample_freq = None
+
+        br.portfolio_vol_adjust = True
+        br.portfolio_vol_target = 0.1
+        br.portfolio_vol_max_leverage = 5
+        br.portfolio_vol_periods = 20
+        br.portfolio_vol_obs_in_year = 252
+        br.portfolio_vol_rebalance_freq = 'BM'
+        br.portfolio_vol_resample_freq = None
+
+        return br
+
+    def _create_tech_params(self):
+        from finmarketpy.economics import TechParams
+
+        tech_params = TechParams()
+
+        tech_params.sma_period = 50
+        tech_params.sma2_period = 100
+        tech_params.ema_period = 50
+        tech_params.roc_period = 20
+        tech_params.rsi_period = 14
+        tech_params.rsi_lower = 30
+        tech_params.rsi_upper = 70
+        tech_params.bb_period = 20
+        tech_params.bb_mult = 2
+
+        return tech_params
+
+    def _benchmark_backtest(self, data):
+        from finmarketpy.backtest import Backtest
+
+        prices = data['prices']
+
+        # simple trend following signal
+        signal = (prices.fillna(method = 'ffill') > prices.fillna(method = 'ffill').rolling(50).mean()) * 2.0 - 1.0
+        signal.columns = [x + ' Signal' for x in prices.columns]
+
+        return lambda: Backtest().calculate_trading_PnL(self._create_backtest_request(), prices, signal)
+
+    def _benchmark_leverage(self, data):
+        from findatapy.timeseries import Calculations
+        from finmarketpy.backtest.backtestengine import RiskEngine
+
+        returns = Calculations().calculate_returns(data['prices'].fillna(method = 'ffill'))
+
+        return lambda: RiskEngine().calculate_leverage_factor(returns, 0.1, 5, 20, 252, 'BM')
+
+    def _create_tech_ind_benchmark(self, name):
+        def benchmark(data):
+            from finmarketpy.economics import TechIndicator
+
+            tech_params = self._create_tech_params()
+
+            return lambda: TechIndicator().create_tech_ind(data['prices'], name, tech_params)
+
+        return benchmark
+
+    def _benchmark_tech_ind_batch(self, data):
+        from finmarketpy.economics import TechIndicator
+
+        # sweep of SMA periods (eg. for parameter optimisation)
+        return lambda: TechIndicator().create_tech_ind_batch(data['prices'], 'SMA', list(range(10, 301, 10)))
+
+    def _benchmark_event_study(self, data):
+        from findatapy.timeseries import Calculations
+        from finmarketpy.economics import EventStudy
+
+        returns = Calculations().calculate_returns(data['intraday'])
+
+        return lambda: EventStudy().get_intraday_moves_over_custom_event(returns.copy(), data['events'])
+
+    def _benchmark_time_of_day_seasonality(self, data):
+        from findatapy.timeseries import Calculations
+        from finmarketpy.economics import Seasonality
+
+        returns = Calculations().calculate_returns(data['intraday'])
+
+        return lambda: Seasonality().time_of_day_seasonality(returns)
+
+    def _benchmark_bus_day_of_month_seasonality(self, data):
+        from findatapy.timeseries import Calculations
+        from finmarketpy.economics import Seasonality
+
+        returns = Calculations().calculate_returns(data['prices'].fillna(method = 'ffill'))
+
+        return lambda: Seasonality().bus_day_of_month_seasonality(returns.copy())
+
+    def _benchmark_monthly_seasonality(self, data):
+        from findatapy.timeseries import Calculations
+        from finmarketpy.economics import Seasonality
+
+        returns = Calculations().calculate_returns(data['prices'].fillna(method = 'ffill'))
+
+        return lambda: Seasonality().monthly_seasonality(returns.copy())
+
+    def run_benchmarks(self, names = None):
+        """
+        run_benchmarks - Runs benchmarks (benchmarks which fail are recorded with their error, rather than stopping the
+        run)
+
+        Parameters
+        ----------
+        names : list(str)
+            Benchmarks to run (None for all)
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        data = self.create_data()
+        benchmarks = self.get_benchmarks()
+
+        if names is None: names = list(benchmarks.keys())
+
+        results = []
+
+        for name in names:
+            self.logger.info("Running benchmark " + name)
+
+            result = OrderedDict([('name', name), ('wall_time', None), ('cpu_time', None), ('memory_peak', None),
+                                  ('error', None)])
+
+            try:
+                run = benchmarks[name](data)
+
+                # timings without memory tracing, which would slow down Python code
+                timings = StageProfiler(trace_memory = False)
+
+                for i in range(0, self._repeat):
+                    with timings.stage(name):
+                        run()
+
+                df = timings.get_dataframe()
+
+                result['wall_time'] = float(df['wall_time'].min())
+                result['cpu_time'] = float(df['cpu_time'].min())
+
+                if self._trace_memory:
+                    memory = StageProfiler(trace_memory = True)
+
+                    with memory.stage(name):
+                        run()
+
+                    result['memory_peak'] = int(memory.get_records()[0]['memory_peak'])
+            except Exception as e:
+                self.logger.warning("Benchmark " + name + " failed: " + str(e))
+
+                result['error'] = type(e).__name__ + ': ' + str(e)
+
+            results.append(result)
+
+        self._results = results
+
+        return self.get_results()
+
+    def get_results(self):
+        """
+        get_results - Gets results of the last run
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return pandas.DataFrame(self._results, columns = ['name', 'wall_time', 'cpu_time', 'memory_peak', 'error'])
+
+    def write_results(self, path):
+        """
+        write_results - Writes results of the last run (and the settings/environment they were run with) as JSON
+
+        Parameters
+        ----------
+        path : str
+            File to write
+        """
+
+        output = {'settings' : {'assets' : self._assets, 'periods' : self._periods,
+                                'intraday_periods' : self._intraday_periods, 'repeat' : self._repeat,
+                                'seed' : self._seed},
+                  'environment' : {'python' : platform.python_version(), 'pandas' : pandas.__version__,
+                                   'machine' : platform.machine(), 'processor' : platform.processor()},
+                  'results' : self._results}
+
+        with open(path, 'w') as f:
+            json.dump(output, f, indent = 1)
+
+    def read_results(self, path):
+        """
+        read_results - Reads results written by write_results
+
+        Parameters
+        ----------
+        path : str
+            File to read
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        with open(path, 'r') as f:
+            output = json.load(f)
+
+        return pandas.DataFrame(output['results'], columns = ['name', 'wall_time', 'cpu_time', 'memory_peak', 'error'])
+
+    def compare_baseline(self, baseline_path, tolerance = 0.25):
+        """
+        compare_baseline - Compares results of the last run against a baseline
+
+        Parameters
+        ----------
+        baseline_path : str
+            Results file of the baseline (from write_results)
+
+        tolerance : float
+            Fractional increase in wall time or memory which is flagged as a regression
+
+        Returns
+        -------
+        pandas.DataFrame (ratios of time and memory to the baseline, and whether each has regressed)
+        """
+
+        baseline = self.read_results(baseline_path).set_index('name')
+        results = self.get_results().set_index('name')
+
+        comparison = results[['wall_time', 'memory_peak']].join(
+            baseline[['wall_time', 'memory_peak']], rsuffix = '_baseline', how = 'left')
+
+        comparison['wall_time_ratio'] = comparison['wall_time'] / comparison['wall_time_baseline']
+        comparison['memory_peak_ratio'] = comparison['memory_peak'] / comparison['memory_peak_baseline']
+
+        comparison['regression'] = (comparison['wall_time_ratio'] > 1.0 + tolerance) \
+                                   | (comparison['memory_peak_ratio'] > 1.0 + tolerance) \
+                                   | (results['error'].notnull() & baseline['error'].reindex(results.index).isnull())
+
+        return comparison
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Benchmarks finmarketpy on synthetic data')
+
+    parser.add_argument('--assets', type = int, default = 10)
+    parser.add_argument('--periods', type = int, default = 2520)
+    parser.add_argument('--intraday-periods', type = int, default = 100000)
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--benchmarks', nargs = '*', default = None)
+    parser.add_argument('--output', default = 'benchmark_results.json')
+    parser.add_argument('--baseline', default = None)
+    parser.add_argument('--tolerance', type = float, default = 0.25)
+
+    args = parser.parse_args()
+
+    runner = BenchmarkRunner(assets = args.assets, periods = args.periods, intraday_periods = args.intraday_periods,
+                             repeat = args.repeat, seed = args.seed)
+
+    print(runner.run_benchmarks(args.benchmarks).to_string())
+
+    runner.write_results(args.output)
+
+    if args.baseline is not None:
+        comparison = runner.compare_baseline(args.baseline, tolerance = args.tolerance)
+
+        print(comparison.to_string())
+
+        if comparison['regression'].any():
+            raise SystemExit(1)
@@ -0,0 +1,208 @@
+__author__ = 'saeedamen' # Saeed Amen
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+SyntheticData
+
+Generates deterministic synthetic market data (for a given seed), so benchmarks and experiments can run offline on
+datasets of any size: prices (geometric Brownian motion at any frequency, with optional asset holidays), irregularly
+spaced ticks and economic events (release times with actual and survey values). Time series follow the naming
+conventions of findatapy (eg. 'EURUSD.close').
+
+"""
+
+import math
+
+import numpy
+import pandas
+
+class SyntheticData(object):
+
+    def __init__(self, seed = 0):
+        """
+        __init__ - Creates generator
+
+        Parameters
+        ----------
+        seed : int
+            Seed for random numbers (same seed gives same data)
+        """
+        self._seed = seed
+
+    def _get_random_state(self, offset):
+        # each type of data has its own random numbers, so adding one type doesn't change the others
+        return numpy.random.RandomState(self._seed + offset)
+
+    def create_tickers(self, assets):
+        """
+        create_tickers - Creates names for assets
+
+        Parameters
+        ----------
+        assets : int
+            Number of assets
+
+        Returns
+        -------
+        list(str)
+        """
+        return ['A' + str(i).zfill(4) for i in range(0, assets)]
+
+    def create_prices(self, assets = 10, periods = 2520, freq = 'B', start_date = '01 Jan 2000', vol = 0.1,
+                      obs_in_year = 252, holiday_prob = 0.0, field = 'close'):
+        """
+        create_prices - Creates prices following geometric Brownian motion
+
+        Parameters
+        ----------
+        assets : int
+            Number of assets
+
+        periods : int
+            Number of observations
+
+        freq : str
+            Frequency of observations (pandas frequency, eg. 'B' or '1min')
+
+        start_date : str
+            First date
+
+        vol : float
+            Annualised volatility
+
+        obs_in_year : int
+            Number of observations in a year (to scale volatility)
+
+        holiday_prob : float
+            Probability of each price being missing (asset holiday)
+
+        field : str
+            Field of the time series
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        random_state = self._get_random_state(0)
+
+        if freq == 'B':
+            index = pandas.bdate_range(start_date, periods = periods)
+        else:
+            index = pandas.date_range(start_date, periods = periods, freq = freq)
+
+        returns = random_state.randn(periods, assets) * vol / math.sqrt(obs_in_year)
+
+        prices = 100.0 * numpy.exp(numpy.cumsum(returns, axis = 0))
+
+        if holiday_prob > 0:
+            prices[random_state.rand(periods, assets) < holiday_prob] = numpy.nan
+
+        return pandas.DataFrame(data = prices, index = index,
+                                columns = [x + '.' + field for x in self.create_tickers(assets)])
+
+    def create_ticks(self, assets = 1, ticks = 100000, start_date = '01 Jan 2016', mean_interval = 1.0,
+                     vol = 0.1, spread_bp = 1.0):
+        """
+        create_ticks - Creates irregularly spaced ticks (exponentially distributed intervals) with bid, ask and mid
+        prices
+
+        Parameters
+        ----------
+        assets : int
+            Number of assets (ticks are shared by every asset)
+
+        ticks : int
+            Number of ticks
+
+        start_date : str
+            Time of first tick
+
+        mean_interval : float
+            Average interval between ticks (seconds)
+
+        vol : float
+            Annualised volatility
+
+        spread_bp : float
+            Bid/ask spread (bp)
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        random_state = self._get_random_state(1)
+
+        intervals = random_state.exponential(mean_interval, ticks)
+
+        index = pandas.Timestamp(start_date) + pandas.to_timedelta(numpy.cumsum(intervals), unit = 's')
+
+        # volatility scales with the time between ticks
+        seconds_in_year = 252 * 24 * 60 * 60
+
+        returns = random_state.randn(ticks, assets) * vol * numpy.sqrt(intervals / seconds_in_year)[:, numpy.newaxis]
+
+        mid = 100.0 * numpy.exp(numpy.cumsum(returns, axis = 0))
+        half_spread = mid * spread_bp / (2.0 * 100.0 * 100.0)
+
+        tickers = self.create_tickers(assets)
+
+        data = numpy.hstack([mid - half_spread, mid + half_spread, mid])
+        columns = [x + '.bid' for x in tickers] + [x + '.ask' for x in tickers] + [x + '.mid' for x in tickers]
+
+        return pandas.DataFrame(data = data, index = index, columns = columns)
+
+    def create_economic_events(self, start_date = '01 Jan 2000', finish_date = '31 Dec 2009', name = 'NFP',
+                               freq = 'BM', hour = 13, minute = 30, surprise_vol = 1.0):
+        """
+        create_economic_events - Creates economic events, with release times and actual/survey values
+
+        Parameters
+        ----------
+        start_date : str
+            First date of events
+
+        finish_date : str
+            Last date of events
+
+        name : str
+            Name of event
+
+        freq : str
+            Frequency of events (pandas frequency, eg. 'BM' for monthly)
+
+        hour : int
+            Hour of release (UTC)
+
+        minute : int
+            Minute of release
+
+        surprise_vol : float
+            Standard deviation of the difference between actual and survey values
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        random_state = self._get_random_state(2)
+
+        index = pandas.date_range(start_date, finish_date, freq = freq) + pandas.Timedelta(hours = hour, minutes = minute)
+
+        survey = numpy.round(random_state.randn(len(index)) * 2.0 + 5.0, 1)
+        actual = numpy.round(survey + random_state.randn(len(index)) * surprise_vol, 1)
+
+        return pandas.DataFrame(data = {name + '.actual-release' : actual, name + '.survey-average' : survey},
+                                index = index, columns = [name + '.actual-release', name + '.survey-average'])
@@ -4,5 +4,6 @@ from finmarketpy.economics.eventstudy import EventsFactory, EventStudy, HistEcon
 from finmarketpy.economics.marketliquidity import MarketLiquidity
 from finmarketpy.economics.seasonality import Seasonality
 from finmarketpy.economics.report import Report
+from finmarketpy.economics.streamingtechindicator import StreamingTechIndicator
 from finmarketpy.economics.techindicator import TechIndicator
 from finmarketpy.economics.techindicator import TechParams
\ No newline at end of file
@@ -0,0 +1,456 @@
+__author__ = 'saeedamen' # Saeed Amen
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+StreamingTechIndicator
+
+Technical indicators and signals which are updated one bar at a time (eg. in a live trading process), rather than
+recalculating TechIndicator.create_tech_ind on the whole history on every bar. Keeps the state of each asset in fixed size
+arrays: a ring buffer of the last prices with running sums for moving averages and Bollinger bands, and recursive
+weights for EMA, so each update is O(assets) whatever the period.
+
+Gives the same signals as TechIndicator (SMA, EMA, ROC, SMA2, RSI, BB, polarity and long-only), including forward filling
+of missing prices and NaN signals during the warm up. The only exception is RSI, where create_tech_ind finds crossings of
+each bar using the price of the next bar, so here the RSI signal of each bar is the create_tech_ind signal of the bar
+before. The state can be seeded from history with update_data_frame, saved to disk and loaded again, so a live process
+can carry on where it stopped.
+
+"""
+
+import numpy
+import pandas
+
+class StreamingTechIndicator(object):
+
+    # attributes which make up the state (saved by save_state)
+    STATE_FIELDS = ['_name', '_period', '_period2', '_bb_mult', '_rsi_lower', '_rsi_upper', '_only_allow_longs',
+                    '_only_allow_shorts', '_signal_mult', '_strip_signal_name', '_columns', '_bars', '_last_date',
+                    '_last_price', '_offset', '_buffer', '_position', '_sum', '_sum2', '_sum_sq', '_nan_count',
+                    '_nan_count2', '_ewma', '_ewma_weight', '_signal_state', '_techind', '_signal']
+
+    SIGNAL_NAMES = {'SMA' : " SMA Signal", 'EMA' : " EMA Signal", 'ROC' : " ROC Signal",
+                    'polarity' : " Polarity Signal", 'SMA2' : " SMA2 Signal", 'RSI' : " RSI Signal",
+                    'BB' : " BB Signal", 'long-only' : " Long Only Signal"}
+
+    TECHIND_NAMES = {'SMA' : [" SMA"], 'EMA' : [" EMA"], 'ROC' : [" ROC"], 'polarity' : [" Polarity"],
+                     'SMA2' : [" SMA", " SMA2"], 'RSI' : [" RSI"], 'BB' : [" BB Lower", " BB Mid", " BB Upper"],
+                     'long-only' : [" Long Only"]}
+
+    def __init__(self, name, tech_params):
+        """
+        __init__ - Creates indicator (the number of assets is set by the first update)
+
+        Parameters
+        ----------
+        name : str
+            Indicator ('SMA', 'EMA', 'ROC', 'SMA2', 'RSI', 'BB', 'polarity' or 'long-only')
+
+        tech_params : TechParams
+            Parameters of indicator (as for TechIndicator.create_tech_ind)
+        """
+
+        if name not in self.SIGNAL_NAMES:
+            raise Exception("Can't calculate " + str(name) + " one bar at a time")
+
+        self._name = name
+
+        self._period = None
+        self._period2 = None
+        self._bb_mult = None
+        self._rsi_lower = None
+        self._rsi_upper = None
+
+        if name == 'SMA':
+            self._period = tech_params.sma_period
+        elif name == 'EMA':
+            self._period = tech_params.ema_period
+        elif name == 'ROC':
+            self._period = tech_params.roc_period
+        elif name == 'SMA2':
+            self._period = tech_params.sma_period
+            self._period2 = tech_params.sma2_period
+        elif name == 'RSI':
+            self._period = tech_params.rsi_period
+            self._rsi_lower = tech_params.rsi_lower
+            self._rsi_upper = tech_params.rsi_upper
+        elif name == 'BB':
+            self._period = tech_params.bb_period
+            self._bb_mult = tech_params.bb_mult
+
+        self._only_allow_longs = hasattr(tech_params, 'only_allow_longs')
+        self._only_allow_shorts = hasattr(tech_params, 'only_allow_shorts')
+        self._signal_mult = getattr(tech_params, 'signal_mult', None)
+        self._strip_signal_name = getattr(tech_params, 'strip_signal_name', False)
+
+        self._columns = None
+        self._bars = 0
+
+    def _get_buffer_length(self):
+        if self._name in ['SMA', 'ROC', 'RSI', 'BB']: return self._period
+        if self._name == 'SMA2': return max(self._period, self._period2)
+
+        return 0
+
+    def _get_warm_up(self):
+        # number of bars with NaN signals (as create_tech_ind)
+        if self._name in ['SMA', 'EMA', 'ROC', 'BB']: return self._period
+        if self._name == 'SMA2': return max(self._period, self._period2)
+        if self._name == 'RSI': return self._period + 1
+
+        return 0
+
+    def _create_state(self, assets):
+        self._last_date = None
+
+        # last price of each asset (for forward filling) and first price (which prices are centred on in the sums)
+        self._last_price = numpy.full(assets, numpy.nan)
+        self._offset = numpy.full(assets, numpy.nan)
+
+        # ring buffer of the last prices (or price changes for RSI), with running sums over the window(s)
+        self._buffer = numpy.full((self._get_buffer_length(), assets), numpy.nan)
+        self._position = 0
+        self._sum = numpy.zeros(assets)
+        self._sum2 = numpy.zeros(assets)
+        self._sum_sq = numpy.zeros(assets)
+        self._nan_count = numpy.full(assets, self._period if self._period is not None else 0)
+        self._nan_count2 = numpy.full(assets, self._period2 if self._period2 is not None else 0)
+
+        # EMA (weighted average and sum of weights) and signals which are held until the next crossing (RSI and BB)
+        self._ewma = numpy.full(assets, numpy.nan)
+        self._ewma_weight = numpy.zeros(assets)
+        self._signal_state = numpy.full(assets, numpy.nan)
+
+        self._techind = numpy.full(assets * len(self.TECHIND_NAMES[self._name]), numpy.nan)
+        self._signal = numpy.full(assets, numpy.nan)
+
+    def update(self, date, prices):
+        """
+        update - Updates indicator and signal with the prices of a new bar
+
+        Parameters
+        ----------
+        date : datetime
+            Time of the bar (after the previous bar)
+
+        prices : pandas.Series or numpy.ndarray
+            Price of each asset (NaN if unknown, when the last price is used)
+
+        Returns
+        -------
+        pandas.Series or numpy.ndarray (signal for each asset)
+        """
+
+        date = pandas.Timestamp(date)
+
+        if self._columns is None:
+            self._columns = list(prices.index) if isinstance(prices, pandas.Series) else list(range(len(prices)))
+
+            self._create_state(len(self._columns))
+
+        if self._last_date is not None and date <= self._last_date:
+            raise Exception("Bars must be in time order, got " + str(date) + " after " + str(self._last_date))
+
+        self._last_date = date
+
+        if isinstance(prices, pandas.Series):
+            signal = self._update(prices.values.astype(numpy.float64))
+
+            return pandas.Series(signal, index = self._get_signal_names())
+
+        return self._update(numpy.asarray(prices, dtype = numpy.float64))
+
+    def _update(self, prices):
+        previous = self._last_price
+
+        # forward fill missing prices
+        prices = numpy.where(numpy.isnan(prices), previous, prices)
+
+        self._last_price = prices
+
+        first = numpy.isnan(self._offset) & ~numpy.isnan(prices)
+        self._offset[first] = prices[first]
+
+        name = self._name
+
+        if name == 'SMA':
+            sma = self._update_window(prices)[0]
+
+            self._techind = sma
+            signal = numpy.where(prices > sma, 1.0, -1.0)
+
+        elif name == 'EMA':
+            ema = self._update_ewma(prices)
+
+            self._techind = ema
+            signal = numpy.where(prices > ema, 1.0, -1.0)
+
+        elif name == 'ROC':
+            # price a period ago is about to leave the ring buffer
+            old = self._buffer[self._position].copy()
+
+            self._buffer[self._position] = prices
+            self._position = (self._position + 1) % self._period
+
+            with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+                roc = prices / old - 1
+
+            self._techind = roc
+            signal = numpy.where(roc > 0, 1.0, -1.0)
+
+        elif name == 'SMA2':
+            sma, sma2 = self._update_window(prices)
+
+            self._techind = numpy.concatenate([sma, sma2])
+            signal = numpy.where(sma > sma2, 1.0, -1.0)
+
+        elif name == 'RSI':
+            self._techind = self._update_rsi(prices - previous)
+
+            # signal changes on the previous bar if the price crossed a level since then
+            with numpy.errstate(invalid = 'ignore'):
+                sells = (prices < self._rsi_lower) & (previous > self._rsi_lower)
+                buys = (prices > self._rsi_upper) & (previous < self._rsi_upper)
+
+            self._signal_state[buys] = 1
+            self._signal_state[sells] = -1
+
+            signal = self._signal_state.copy()
+
+        elif name == 'BB':
+            mid, std_dev = self._update_window(prices, std = True)
+
+            lower = mid - self._bb_mult * std_dev
+            upper = mid + self._bb_mult * std_dev
+
+            # signal only changes when price breaks out of the bands
+            with numpy.errstate(invalid = 'ignore'):
+                self._signal_state[prices > upper] = 1
+                self._signal_state[prices < lower] = -1
+
+            self._techind = numpy.concatenate([lower, mid, upper])
+            signal = self._signal_state.copy()
+
+        elif name == 'polarity':
+            self._techind = prices
+            signal = numpy.where(prices > 0, 1.0, -1.0)
+
+        elif name == 'long-only':
+            self._techind = prices
+            signal = numpy.ones(len(prices))
+
+        self._bars = self._bars + 1
+
+        # ignore signals before the indicator kicks in
+        if self._bars <= self._get_warm_up():
+            signal[:] = numpy.nan
+
+        if self._only_allow_longs: signal[signal < 0] = 0
+        if self._only_allow_shorts: signal[signal > 0] = 0
+        if self._signal_mult is not None: signal = signal * self._signal_mult
+
+        self._signal = signal
+
+        return signal.copy()
+
+    def _update_window(self, prices, std = False):
+        length = len(self._buffer)
+        centred = prices - self._offset
+
+        # values leaving the window of each period
+        old = self._buffer[(self._position - self._period) % length]
+        old_finite = numpy.isfinite(old)
+        new_finite = numpy.isfinite(centred)
+
+        new = numpy.where(new_finite, centred, 0)
+
+        self._sum = self._sum - numpy.where(old_finite, old, 0) + new
+        self._nan_count = self._nan_count - ~old_finite + ~new_finite
+
+        if std:
+            self._sum_sq = self._sum_sq - numpy.where(old_finite, old * old, 0) + new * new
+
+        if self._period2 is not None:
+            old2 = self._buffer[(self._position - self._period2) % length]
+            old2_finite = numpy.isfinite(old2)
+
+            self._sum2 = self._sum2 - numpy.where(old2_finite, old2, 0) + new
+            self._nan_count2 = self._nan_count2 - ~old2_finite + ~new_finite
+
+        self._buffer[self._position] = centred
+        self._position = (self._position + 1) % length
+
+        # recalculate sums from the window each time it wraps around, so rounding errors don't build up
+        if self._position == 0:
+            finite_buffer = numpy.where(numpy.isfinite(self._buffer), self._buffer, 0)
+
+            self._sum = finite_buffer[length - self._period:].sum(axis = 0)
+
+            if std:
+                self._sum_sq = (finite_buffer * finite_buffer).sum(axis = 0)
+
+            if self._period2 is not None:
+                self._sum2 = finite_buffer[length - self._period2:].sum(axis = 0)
+
+        # like a pandas rolling mean, only defined for a full window without gaps
+        mean = self._sum / self._period + self._offset
+        mean[self._nan_count > 0] = numpy.nan
+
+        if std:
+            n = self._period
+
+            with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+                var = (self._sum_sq - self._sum * self._sum / n) / (n - 1)
+
+            var[var < 0] = 0
+
+            return mean, numpy.sqrt(var)
+
+        if self._period2 is not None:
+            mean2 = self._sum2 / self._period2 + self._offset
+            mean2[self._nan_count2 > 0] = numpy.nan
+
+            return mean, mean2
+
+        return mean, None
+
+    def _update_ewma(self, prices):
+        # adjusted EWMA (as pandas ewm with adjust = True), starting from the first price
+        alpha = 2.0 / (self._period + 1.0)
+
+        valid = ~numpy.isnan(prices)
+        first = valid & numpy.isnan(self._ewma)
+
+        self._ewma[first] = prices[first]
+        self._ewma_weight[first] = 1.0
+
+        update = valid & ~first
+
+        weight = self._ewma_weight[update] * (1.0 - alpha)
+
+        self._ewma[update] = numpy.where(self._ewma[update] != prices[update],
+                                         (weight * self._ewma[update] + prices[update]) / (weight + 1.0),
+                                         prices[update])
+        self._ewma_weight[update] = weight + 1.0
+
+        return self._ewma.copy()
+
+    def _update_rsi(self, delta):
+        # RSI from rolling means of up and down moves (price changes in the ring buffer)
+        old = self._buffer[self._position]
+        old_finite = numpy.isfinite(old)
+        new_finite = numpy.isfinite(delta)
+
+        old = numpy.where(old_finite, old, 0)
+        new = numpy.where(new_finite, delta, 0)
+
+        self._sum = self._sum - numpy.maximum(old, 0) + numpy.maximum(new, 0)
+        self._sum2 = self._sum2 - numpy.maximum(-old, 0) + numpy.maximum(-new, 0)
+        self._nan_count = self._nan_count - ~old_finite + ~new_finite
+
+        self._buffer[self._position] = delta
+        self._position = (self._position + 1) % self._period
+
+        if self._position == 0:
+            finite_buffer = numpy.where(numpy.isfinite(self._buffer), self._buffer, 0)
+
+            self._sum = numpy.maximum(finite_buffer, 0).sum(axis = 0)
+            self._sum2 = numpy.maximum(-finite_buffer, 0).sum(axis = 0)
+
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            rsi = 100.0 - (100.0 / (1.0 + self._sum / self._sum2))
+
+        rsi[self._nan_count > 0] = numpy.nan
+
+        return rsi
+
+    def _get_signal_names(self):
+        if self._strip_signal_name: return self._columns
+
+        return [str(x) + self.SIGNAL_NAMES[self._name] for x in self._columns]
+
+    def _get_techind_names(self):
+        return [str(x) + y for y in self.TECHIND_NAMES[self._name] for x in self._columns]
+
+    def update_data_frame(self, prices_df):
+        """
+        update_data_frame - Updates indicator and signal with the prices of several bars (eg. to seed the indicator from
+        history)
+
+        Parameters
+        ----------
+        prices_df : pandas.DataFrame
+            Price of each asset
+
+        Returns
+        -------
+        pandas.DataFrame (signal after each bar)
+        """
+
+        if self._columns is None:
+            self._columns = list(prices_df.columns)
+
+            self._create_state(len(self._columns))
+
+        signal = numpy.empty(prices_df.shape)
+
+        for i in range(0, len(prices_df.index)):
+            signal[i] = self.update(prices_df.index[i], prices_df.values[i])
+
+        return pandas.DataFrame(data = signal, index = prices_df.index, columns = self._get_signal_names())
+
+    def get_techind(self):
+        """
+        get_techind - Gets technical indicator (as of the last bar)
+
+        Returns
+        -------
+        pandas.Series
+        """
+        return pandas.Series(self._techind, index = self._get_techind_names())
+
+    def get_signal(self):
+        """
+        get_signal - Gets signal (as of the last bar)
+
+        Returns
+        -------
+        pandas.Series
+        """
+        return pandas.Series(self._signal, index = self._get_signal_names())
+
+    def save_state(self, path):
+        """
+        save_state - Saves the state of the indicator to disk
+
+        Parameters
+        ----------
+        path : str
+            File to save to
+        """
+        pandas.to_pickle(dict([(x, getattr(self, x, None)) for x in self.STATE_FIELDS]), path)
+
+    def load_state(self, path):
+        """
+        load_state - Loads the state of the indicator (including its parameters) from disk
+
+        Parameters
+        ----------
+        path : str
+            File saved with save_state
+        """
+
+        state = pandas.read_pickle(path)
+
+        for x in self.STATE_FIELDS:
+            setattr(self, x, state[x])
@@ -24,17 +24,44 @@ import numpy
 
 from findatapy.util.loggermanager import LoggerManager
 
+from finmarketpy.util.arraycalculations import ArrayCalculations
+
 class TechIndicator(object):
 
-    def __init__(self):
+    # TechParams fields of the periods of each indicator which can be calculated by create_tech_ind_batch
+    BATCH_PERIOD_FIELDS = {'SMA' : ['sma_period'], 'EMA' : ['ema_period'], 'ROC' : ['roc_period'],
+                           'SMA2' : ['sma_period', 'sma2_period'], 'BB' : ['bb_period']}
+
+    def __init__(self, signal_cache = None):
+        """
+        __init__ - Creates TechIndicator
+
+        Parameters
+        ----------
+        signal_cache : SignalCache
+            Cache for technical indicators and signals (None to always calculate them)
+        """
         self.logger = LoggerManager().getLogger(__name__)
         self._techind = None
         self._signal = None
+        self._signal_cache = signal_cache
 
     def create_tech_ind(self, data_frame_non_nan, name, tech_params, data_frame_non_nan_early = None):
         self._signal = None
         self._techind = None
 
+        # reuse indicators already calculated for the same data and parameters
+        if self._signal_cache is not None:
+            key = self._signal_cache.get_key(type(self).__module__, type(self).__name__, name, tech_params,
+                                             data_frame_non_nan, data_frame_non_nan_early)
+
+            cached = self._signal_cache.get(key)
+
+            if cached is not None:
+                self._techind, self._signal = cached
+
+                return self._techind
+
         data_frame = data_frame_non_nan.fillna(method="ffill")
 
         if data_frame_non_nan_early is not None:
@@ -206,8 +233,7 @@ class TechIndicator(object):
             self._signal.columns = [x + " " + name + " Signal" for x in data_frame.columns.values]
 
             lower.columns = [x + " BB Lower" for x in data_frame.columns.values]
-            upper.columns = [x + " BB Mid" for x in data_frame.columns.values]
-            upper.columns = [x + " BB Lower" for x in data_frame.columns.values]
+            upper.columns = [x + " BB Upper" for x in data_frame.columns.values]
 
             self._techind = pandas.concat([lower, mid, upper], axis = 1)
         elif name == "long-only":
@@ -239,8 +265,277 @@ class TechIndicator(object):
             if tech_params.strip_signal_name:
                 self._signal.columns = data_frame.columns
 
+        if self._signal_cache is not None:
+            self._signal_cache.put(key, [self._techind, self._signal])
+
         return self._techind
 
+    def create_tech_ind_batch(self, data_frame_non_nan, name, periods, tech_params = None,
+                              data_frame_non_nan_early = None):
+        """
+        create_tech_ind_batch - Calculates a technical indicator and its signals for many periods in one go (eg. for
+        parameter sweeps), giving the same results as calling create_tech_ind for each period. Prices are only forward
+        filled once, and every moving average (SMA, SMA2, BB) comes from a single cumulative sum of prices, so each
+        extra period costs O(time x assets) whatever its length.
+
+        Parameters
+        ----------
+        data_frame_non_nan : pandas.DataFrame
+            Asset prices
+
+        name : str
+            Indicator ('SMA', 'EMA', 'ROC', 'SMA2' or 'BB')
+
+        periods : list(int) or list((int, int))
+            Periods of indicator, for SMA2 pairs of (sma_period, sma2_period)
+
+        tech_params : TechParams
+            Other parameters (bb_mult for BB, only_allow_longs, only_allow_shorts, signal_mult, strip_signal_name)
+
+        data_frame_non_nan_early : pandas.DataFrame
+            Prices for the latest point of SMA and ROC (see create_tech_ind)
+
+        Returns
+        -------
+        pandas.DataFrame (columns MultiIndex of period(s) and indicator, signals from get_signal)
+        """
+
+        self._signal = None
+        self._techind = None
+
+        if name not in self.BATCH_PERIOD_FIELDS:
+            raise Exception("Can't calculate " + str(name) + " for many periods in one go")
+
+        periods = [tuple(x) if name == 'SMA2' else x for x in periods]
+
+        if self._signal_cache is not None:
+            key = self._signal_cache.get_key(type(self).__module__, type(self).__name__, 'batch', name, periods,
+                                             tech_params, data_frame_non_nan, data_frame_non_nan_early)
+
+            cached = self._signal_cache.get(key)
+
+            if cached is not None:
+                self._techind, self._signal = cached
+
+                return self._techind
+
+        columns = list(data_frame_non_nan.columns.values)
+
+        data_frame = data_frame_non_nan.fillna(method="ffill")
+        prices = data_frame.values.astype(numpy.float64)
+
+        prices_early = None
+
+        if data_frame_non_nan_early is not None:
+            prices_early = data_frame_non_nan_early.fillna(method="ffill").reindex(data_frame.index).values
+
+        # arrays of periods x time x assets
+        if name == 'SMA':
+            if prices_early is not None:
+                # lagged sum of the n-1 points, plus today's point
+                sums = self._create_rolling_sums(prices, [x - 1 for x in periods], lag = 1)
+
+                techind = (sums + prices_early) / numpy.asarray(periods, dtype = numpy.float64)[:, None, None]
+                signal = numpy.where(prices_early > techind, 1.0, -1.0)
+            else:
+                techind = self._create_rolling_means(prices, periods)
+                signal = numpy.where(prices > techind, 1.0, -1.0)
+
+            warm_up = periods
+            techind_names = [" SMA"]
+
+        elif name == 'EMA':
+            techind = numpy.empty((len(periods),) + prices.shape)
+
+            for i in range(0, len(periods)):
+                techind[i] = data_frame.ewm(ignore_na=False, span=periods[i], min_periods=0, adjust=True).mean().values
+
+            signal = numpy.where(prices > techind, 1.0, -1.0)
+
+            warm_up = periods
+            techind_names = [" EMA"]
+
+        elif name == 'ROC':
+            array_calculations = ArrayCalculations()
+
+            latest = prices_early if prices_early is not None else prices
+
+            with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+                techind = numpy.stack([latest / array_calculations.shift(prices, x) - 1 for x in periods])
+
+            signal = numpy.where(techind > 0, 1.0, -1.0)
+
+            warm_up = periods
+            techind_names = [" ROC"]
+
+        elif name == 'SMA2':
+            unique_periods = sorted(set([x for pair in periods for x in pair]))
+
+            means = self._create_rolling_means(prices, unique_periods)
+            means = dict(zip(unique_periods, means))
+
+            sma = numpy.stack([means[x[0]] for x in periods])
+            sma2 = numpy.stack([means[x[1]] for x in periods])
+
+            signal = numpy.where(sma > sma2, 1.0, -1.0)
+
+            techind = numpy.concatenate([sma, sma2], axis = 2)
+
+            warm_up = [max(x) for x in periods]
+            techind_names = [" SMA", " SMA2"]
+
+        elif name == 'BB':
+            bb_mult = tech_params.bb_mult
+
+            mid, std_dev = self._create_rolling_means(prices, periods, std = True)
+
+            lower = mid - bb_mult * std_dev
+            upper = mid + bb_mult * std_dev
+
+            # signal only changes when price breaks out of the bands
+            signal = numpy.where(prices > upper, 1.0, numpy.where(prices < lower, -1.0, numpy.nan))
+            signal = ArrayCalculations().ffill(signal.transpose(1, 0, 2)).transpose(1, 0, 2)
+
+            techind = numpy.concatenate([lower, mid, upper], axis = 2)
+
+            warm_up = periods
+            techind_names = [" BB Lower", " BB Mid", " BB Upper"]
+
+        for i in range(0, len(periods)):
+            signal[i, 0:warm_up[i]] = numpy.nan
+
+        if tech_params is not None:
+            if hasattr(tech_params, 'only_allow_longs'):
+                signal[signal < 0] = 0
+
+            if hasattr(tech_params, 'only_allow_shorts'):
+                signal[signal > 0] = 0
+
+            if hasattr(tech_params, 'signal_mult'):
+                signal = signal * tech_params.signal_mult
+
+        signal_names = [x + " " + name + " Signal" for x in columns]
+
+        if tech_params is not None and getattr(tech_params, 'strip_signal_name', False):
+            signal_names = columns
+
+        self._techind = self._create_batch_data_frame(techind, data_frame.index, name, periods,
+                                                      [x + y for y in techind_names for x in columns])
+        self._signal = self._create_batch_data_frame(signal, data_frame.index, name, periods, signal_names)
+
+        if self._signal_cache is not None:
+            self._signal_cache.put(key, [self._techind, self._signal])
+
+        return self._techind
+
+    def _create_rolling_sums(self, prices, periods, lag = 0, squares = False):
+        # prices are shifted by the first valid price of each asset, so the cumulative sums stay small
+        offset = prices[numpy.argmax(~numpy.isnan(prices), axis = 0), numpy.arange(prices.shape[1])]
+        offset[numpy.isnan(offset)] = 0
+
+        nan = numpy.isnan(prices)
+        centred = numpy.where(nan, 0, prices - offset)
+
+        zeros = numpy.zeros((1, prices.shape[1]))
+
+        cum_sum = numpy.concatenate([zeros, numpy.cumsum(centred, axis = 0)])
+        cum_nan = numpy.concatenate([zeros, numpy.cumsum(nan, axis = 0)])
+
+        if squares:
+            cum_squares = numpy.concatenate([zeros, numpy.cumsum(centred * centred, axis = 0)])
+
+        rows = prices.shape[0]
+
+        sums = numpy.full((len(periods),) + prices.shape, numpy.nan)
+        sum_squares = numpy.full(sums.shape, numpy.nan) if squares else None
+
+        for i in range(0, len(periods)):
+            # window of the previous periods[i] points, ending lag points before each row
+            first = periods[i] + lag - 1
+
+            if first >= rows: continue
+
+            end = slice(first + 1 - lag, rows + 1 - lag)
+            start = slice(first + 1 - lag - periods[i], rows + 1 - lag - periods[i])
+
+            # like pandas rolling windows, any NaN in the window gives NaN
+            window_nan = (cum_nan[end] - cum_nan[start]) > 0
+
+            window = cum_sum[end] - cum_sum[start] + periods[i] * offset
+            window[window_nan] = numpy.nan
+
+            sums[i, first:] = window
+
+            if squares:
+                window = cum_squares[end] - cum_squares[start]
+                window[window_nan] = numpy.nan
+
+                sum_squares[i, first:] = window
+
+        if squares:
+            return sums, sum_squares, offset
+
+        return sums
+
+    def _create_rolling_means(self, prices, periods, std = False):
+        n = numpy.asarray(periods, dtype = numpy.float64)[:, None, None]
+
+        if not(std):
+            return self._create_rolling_sums(prices, periods) / n
+
+        sums, sum_squares, offset = self._create_rolling_sums(prices, periods, squares = True)
+
+        mean = sums / n
+
+        # variance of prices around the offset is the same as around zero
+        centred_sums = sums - n * offset
+
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            var = (sum_squares - centred_sums * centred_sums / n) / (n - 1)
+
+        var[var < 0] = 0
+
+        return mean, numpy.sqrt(var)
+
+    def _create_batch_data_frame(self, array, index, name, periods, columns):
+        # periods x time x columns to time x (periods, columns)
+        if name == 'SMA2':
+            tuples = [x + (y,) for x in periods for y in columns]
+        else:
+            tuples = [(x, y) for x in periods for y in columns]
+
+        data = array.transpose(1, 0, 2).reshape(array.shape[1], array.shape[0] * array.shape[2])
+
+        return pandas.DataFrame(data = data, index = index,
+                                columns = pandas.MultiIndex.from_tuples(tuples, names = self.BATCH_PERIOD_FIELDS[name]
+                                                                                        + [None]))
+
+    def get_techind_array(self):
+        """
+        get_techind_array - Gets technical indicators calculated by create_tech_ind_batch as a 3D array
+
+        Returns
+        -------
+        numpy.ndarray (periods x time x indicators)
+        """
+        return self._get_batch_array(self._techind)
+
+    def get_signal_array(self):
+        """
+        get_signal_array - Gets signals calculated by create_tech_ind_batch as a 3D array (eg. to stack for
+        BatchBacktest)
+
+        Returns
+        -------
+        numpy.ndarray (periods x time x assets)
+        """
+        return self._get_batch_array(self._signal)
+
+    def _get_batch_array(self, data_frame):
+        periods = len(data_frame.columns.droplevel(-1).unique())
+
+        return data_frame.values.reshape(len(data_frame.index), periods, -1).transpose(1, 0, 2)
+
     def create_custom_tech_ind(self, data_frame_non_nan, name, tech_params, data_frame_non_nan_early):
         return
 
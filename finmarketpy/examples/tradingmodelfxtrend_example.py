@@ -34,6 +34,11 @@ class TradingModelFXTrend_Example(TradingModel):
 
         ##### FILL IN WITH YOUR OWN PARAMETERS FOR display, dumping, TSF etc.
         self.market = Market(market_data_generator=MarketDataGenerator())
+
+        # to cache market data on disk (so later runs only fetch new dates), wrap the Market, eg.
+        # from finmarketpy.util.marketdatacache import MarketDataCache
+        # self.market = MarketDataCache(self.market, 'market_data_cache')
+
         self.DUMP_PATH = ''
         self.FINAL_STRATEGY = 'FX trend'
         self.SCALE_FACTOR = 1
@@ -0,0 +1,310 @@
+__author__ = 'saeedamen' # Saeed Amen
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+ArrayCalculations
+
+NumPy versions of the time series calculations used in backtesting (forward filling, shifting, P&L with transaction costs,
+cumulative indices). These work on raw arrays where the first axis is always time, so they can be applied to a single
+asset (1D), a basket of assets (2D) or a stack of baskets (3D, eg. parameters x time x assets after a transpose)
+without the overhead of building intermediate pandas DataFrames.
+
+"""
+
+import numpy
+
+class ArrayCalculations(object):
+
+    def ffill(self, array):
+        """
+        ffill - Forward fills NaN values along the first (time) axis
+
+        Parameters
+        ----------
+        array : numpy.ndarray
+            Array with time as first axis
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        array = numpy.asarray(array, dtype=float)
+
+        if array.shape[0] == 0: return array.copy()
+
+        mask = numpy.isnan(array)
+
+        # index of the last non-NaN observation at each point in time
+        shape = [array.shape[0]] + [1] * (array.ndim - 1)
+        idx = numpy.where(mask, 0, numpy.arange(array.shape[0]).reshape(shape))
+        numpy.maximum.accumulate(idx, axis=0, out=idx)
+
+        filled = numpy.take_along_axis(array, idx, axis=0)
+
+        return filled
+
+    def shift(self, array, periods=1):
+        """
+        shift - Shifts an array along the first (time) axis, filling the gap with NaN (like pandas.DataFrame.shift)
+
+        Parameters
+        ----------
+        array : numpy.ndarray
+            Array with time as first axis
+
+        periods : int
+            Number of periods to shift by
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        array = numpy.asarray(array, dtype=float)
+        shifted = numpy.empty_like(array)
+
+        if periods == 0:
+            shifted[:] = array
+        elif abs(periods) >= array.shape[0]:
+            shifted.fill(numpy.nan)
+        elif periods > 0:
+            shifted[:periods] = numpy.nan
+            shifted[periods:] = array[:-periods]
+        else:
+            shifted[periods:] = numpy.nan
+            shifted[:periods] = array[-periods:]
+
+        return shifted
+
+    def calculate_signal_tc(self, signal, tc, period_shift=1):
+        """
+        calculate_signal_tc - Calculates transaction costs incurred by changes in signal (|signal(t-1) - signal(t)| x tc)
+
+        Parameters
+        ----------
+        signal : numpy.ndarray
+            Signals with time as first axis
+
+        tc : float or numpy.ndarray
+            Transaction costs (must broadcast against signal)
+
+        period_shift : int
+            Lag between signal and the returns it earns
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        return numpy.abs(self.shift(signal, period_shift) - signal) * tc
+
+    def calculate_signal_returns_with_tc(self, signal, returns, tc, period_shift=1):
+        """
+        calculate_signal_returns_with_tc - Calculates returns of signals after transaction costs, equivalent to
+        Calculations.calculate_signal_returns_with_tc_matrix, but on NumPy arrays and for any tc which broadcasts
+
+        Parameters
+        ----------
+        signal : numpy.ndarray
+            Signals with time as first axis
+
+        returns : numpy.ndarray
+            Asset returns (must broadcast against signal)
+
+        tc : float or numpy.ndarray
+            Transaction costs (must broadcast against signal)
+
+        period_shift : int
+            Lag between signal and the returns it earns
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        signal_shift = self.shift(signal, period_shift)
+
+        pnl = signal_shift * returns
+        pnl -= numpy.abs(signal_shift - signal) * tc
+
+        return pnl
+
+    def calculate_returns(self, prices, period_shift=1):
+        """
+        calculate_returns - Calculates simple returns from prices along the first (time) axis
+
+        Parameters
+        ----------
+        prices : numpy.ndarray
+            Prices with time as first axis
+
+        period_shift : int
+            Number of periods to calculate returns over
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        return prices / self.shift(prices, period_shift) - 1
+
+    def combine_portfolio(self, pnl, portfolio_combination='mean', axis=-1):
+        """
+        combine_portfolio - Combines the P&L of individual assets into a portfolio, ignoring NaNs (like pandas sum/mean).
+        Where every asset is NaN, the portfolio is 0 for 'sum' and NaN for 'mean' (as in pandas).
+
+        Parameters
+        ----------
+        pnl : numpy.ndarray
+            P&L of individual assets
+
+        portfolio_combination : str
+            'sum' or 'mean'
+
+        axis : int
+            Axis of assets
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        valid = ~numpy.isnan(pnl)
+        count = valid.sum(axis=axis)
+
+        total = numpy.where(valid, pnl, 0).sum(axis=axis)
+
+        if portfolio_combination == 'sum':
+            port = total
+        else:
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                port = total / count
+
+            port = numpy.where(count == 0, numpy.nan, port)
+
+        return numpy.asarray(port, dtype=float)
+
+    def create_mult_index(self, returns):
+        """
+        create_mult_index - Creates a cumulative index (starting at 100) from returns, equivalent to
+        Calculations.create_mult_index. NaN returns are skipped, and the point before the first valid return is set to 100.
+
+        Parameters
+        ----------
+        returns : numpy.ndarray
+            Returns with time as first axis
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+
+        returns = numpy.asarray(returns, dtype=float)
+        nan_mask = numpy.isnan(returns)
+
+        index = 100.0 * numpy.cumprod(numpy.where(nan_mask, 1.0, 1.0 + returns), axis=0)
+        index[nan_mask] = numpy.nan
+
+        if returns.shape[0] == 0: return index
+
+        # start index one point before first valid return (otherwise we ignore the first return)
+        first = numpy.argmax(~nan_mask, axis=0)
+        first = numpy.maximum(first - 1, 0)
+
+        numpy.put_along_axis(index, numpy.expand_dims(first, 0), 100.0, axis=0)
+
+        return index
+
+    def calculate_trades(self, signal, returns, tc=0.0):
+        """
+        calculate_trades - Finds every trade in a set of signals and the compounded return of each trade, in a single
+        vectorised pass. A trade is entered when the signal changes side (long/short) at the close of a bar and held until
+        the close of the bar when it changes side again (or flattens), so resizing a position on the same side (eg. from
+        vol targeting) does not start a new trade. Trades still open on the last bar are included up to that bar. The
+        cost of entering a trade is charged on its entry bar, so it is moved from the return of that bar (which is
+        otherwise flat or the exit of the previous trade) into the trade.
+
+        Parameters
+        ----------
+        signal : numpy.ndarray
+            Signals (time x assets), NaN is treated as flat
+
+        returns : numpy.ndarray
+            Returns of the signals (time x assets), typically P&L from calculate_signal_returns_with_tc, where the
+            return on each bar is earned by the signal of the previous bar
+
+        tc : float or numpy.ndarray
+            Transaction costs used for the returns, which must broadcast against (time x assets)
+
+        Returns
+        -------
+        numpy.ndarray (asset), numpy.ndarray (entry row), numpy.ndarray (exit row), numpy.ndarray (side),
+        numpy.ndarray (compounded return)
+        """
+
+        signal = numpy.asarray(signal, dtype=float)
+        returns = numpy.asarray(returns, dtype=float)
+
+        if signal.ndim == 1: signal = signal[:, numpy.newaxis]
+        if returns.ndim == 1: returns = returns[:, numpy.newaxis]
+
+        rows = signal.shape[0]
+
+        side = numpy.sign(numpy.where(numpy.isnan(signal), 0, signal)).astype(numpy.int8)
+
+        # a new segment starts on the first row and wherever the side changes
+        start = numpy.ones(side.shape, dtype=bool)
+        start[1:] = side[1:] != side[:-1]
+
+        # ordered by asset, then time
+        asset, entry = numpy.nonzero(start.T)
+
+        # each segment is exited where the next segment in the same asset starts (or last bar if still open)
+        exit_row = numpy.empty_like(entry)
+        exit_row[:-1] = entry[1:]
+        exit_row[-1:] = rows - 1
+
+        last_in_asset = numpy.ones(len(asset), dtype=bool)
+        last_in_asset[:-1] = asset[1:] != asset[:-1]
+        exit_row[last_in_asset] = rows - 1
+
+        trade_side = side[entry, asset]
+
+        is_trade = trade_side != 0
+
+        asset, entry, exit_row, trade_side = asset[is_trade], entry[is_trade], exit_row[is_trade], trade_side[is_trade]
+
+        # cost of entering each trade (|signal| x tc on its entry bar, the rest of the cost on that bar is for closing
+        # the previous position), which is added back to the entry bar and charged to the trade instead (no cost is
+        # charged where there is no return, eg. on the first bar)
+        tc = numpy.broadcast_to(numpy.asarray(tc, dtype=float), signal.shape)
+
+        entry_tc = numpy.where(numpy.isnan(returns[entry, asset]), 0,
+                               numpy.abs(signal[entry, asset]) * numpy.nan_to_num(tc[entry, asset]))
+
+        returns = numpy.where(numpy.isnan(returns), 0, returns)
+
+        returns[entry, asset] = returns[entry, asset] + entry_tc
+
+        # compound returns over (entry, exit] with a cumulative sum of log returns for each asset
+        log_returns = numpy.log1p(returns)
+
+        cum_log_returns = numpy.zeros((rows + 1, returns.shape[1]))
+        numpy.cumsum(log_returns, axis=0, out=cum_log_returns[1:])
+
+        trade_returns = (1.0 - entry_tc) * numpy.exp(cum_log_returns[exit_row + 1, asset]
+                                                     - cum_log_returns[entry + 1, asset]) - 1.0
+
+        return asset, entry, exit_row, trade_side, trade_returns
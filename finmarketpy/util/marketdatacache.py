@@ -0,0 +1,207 @@
+__author__ = 'saeedamen' # Saeed Amen
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+MarketDataCache
+
+Wraps a Market (or any object with a fetch_market(md_request) method, such as a local stand-in for testing), caching the
+time series it returns on disk as columnar .npy files, keyed on the tickers, fields, frequency and data source of the
+MarketDataRequest. Later requests for the same time series only fetch the dates after the end of the cache (the last
+cached date is fetched again, in case it was incomplete) and the rest is read back through memory mapping, rather than
+downloading and parsing the whole history again. Useful in TradingModel.load_assets, which is called every time a
+strategy is constructed.
+
+"""
+
+import copy
+import hashlib
+import os
+
+import numpy
+import pandas
+
+from findatapy.util import LoggerManager
+
+class MarketDataCache(object):
+
+    # MarketDataRequest fields which identify a time series (dates are handled separately)
+    KEY_FIELDS = ['data_source', 'freq', 'freq_mult', 'category', 'cut', 'environment', 'tickers', 'vendor_tickers',
+                  'fields', 'vendor_fields']
+
+    def __init__(self, market, cache_path):
+        """
+        __init__ - Creates cache
+
+        Parameters
+        ----------
+        market : Market
+            Used to fetch data which isn't cached
+
+        cache_path : str
+            Folder to store the cache
+        """
+        self.logger = LoggerManager().getLogger(__name__)
+
+        self._market = market
+        self._cache_path = cache_path
+
+        if not(os.path.isdir(cache_path)):
+            os.makedirs(cache_path)
+
+    def get_key(self, md_request):
+        """
+        get_key - Gets the key of the time series for a MarketDataRequest
+
+        Parameters
+        ----------
+        md_request : MarketDataRequest
+            Request for market data
+
+        Returns
+        -------
+        str
+        """
+
+        key = [(x, getattr(md_request, x, None)) for x in self.KEY_FIELDS]
+
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def fetch_market(self, md_request):
+        """
+        fetch_market - Fetches market data, from the cache where possible, only fetching dates after the end of the
+        cache from the underlying Market (and adding them to the cache)
+
+        Parameters
+        ----------
+        md_request : MarketDataRequest
+            Request for market data
+
+        Returns
+        -------
+        pandas.DataFrame (read only, if it's read from the cache)
+        """
+
+        key = self.get_key(md_request)
+
+        start_date = pandas.Timestamp(md_request.start_date)
+        finish_date = pandas.Timestamp(md_request.finish_date)
+
+        cached_df, meta = self._read(key)
+
+        # request dates are compared in the timezone of the cached index (naive dates are taken to be in it)
+        if cached_df is not None:
+            tz = cached_df.index.tz
+
+            start_date, finish_date = self._localize(start_date, tz), self._localize(finish_date, tz)
+            meta['start_date'], meta['finish_date'] = \
+                self._localize(meta['start_date'], tz), self._localize(meta['finish_date'], tz)
+
+        # can only extend the cache forward in time
+        if cached_df is not None and start_date < meta['start_date']:
+            cached_df = None
+
+        if cached_df is None:
+            self.logger.info("Fetching all market data for " + str(getattr(md_request, 'tickers', '')))
+
+            data_frame = self._market.fetch_market(md_request)
+
+            if data_frame is None: return None
+
+            self._write(key, data_frame, start_date, finish_date)
+
+            return data_frame
+
+        if finish_date > meta['finish_date'] and len(cached_df.index) > 0:
+            tail_request = copy.copy(md_request)
+            tail_request.start_date = cached_df.index[-1].to_pydatetime()
+
+            self.logger.info("Fetching market data after " + str(tail_request.start_date) + " for "
+                             + str(getattr(md_request, 'tickers', '')))
+
+            tail_df = self._market.fetch_market(tail_request)
+
+            if tail_df is not None and len(tail_df.index) > 0:
+                tail_df = tail_df[cached_df.columns]
+
+                cached_df = pandas.concat([cached_df[cached_df.index < tail_df.index[0]], tail_df])
+
+            self._write(key, cached_df, meta['start_date'], finish_date)
+
+            # read back memory mapped (unless the cache couldn't be written)
+            written_df, written_meta = self._read(key)
+
+            if written_df is not None: cached_df = written_df
+
+        # slice by position, so the result is still memory mapped
+        start = cached_df.index.searchsorted(start_date, side='left')
+        finish = cached_df.index.searchsorted(finish_date, side='right')
+
+        return cached_df.iloc[start:finish]
+
+    def _localize(self, date, tz):
+        date = pandas.Timestamp(date)
+
+        if date.tzinfo is None:
+            return date if tz is None else date.tz_localize(tz)
+
+        return date.tz_convert(tz) if tz is not None else date.tz_convert('UTC').tz_localize(None)
+
+    def _get_path(self, key, suffix):
+        return os.path.join(self._cache_path, key + suffix)
+
+    def _write(self, key, data_frame, start_date, finish_date):
+        # only numeric data can be stored as columnar arrays
+        if data_frame.values.dtype == object:
+            self.logger.warning("Couldn't cache non numeric market data")
+            return
+
+        try:
+            values = numpy.asfortranarray(data_frame.values)       # each column is contiguous
+
+            # index values are in UTC (if the index has a timezone), so the timezone is kept separately
+            numpy.save(self._get_path(key, '_values.tmp.npy'), values)
+            numpy.save(self._get_path(key, '_index.tmp.npy'), data_frame.index.values)
+
+            pandas.to_pickle({'columns' : data_frame.columns, 'index_name' : data_frame.index.name,
+                              'index_tz' : getattr(data_frame.index, 'tz', None),
+                              'start_date' : start_date, 'finish_date' : finish_date}, self._get_path(key, '.tmp.meta'))
+
+            # remove the old meta before replacing the time series, and replace the meta last, so if we fail partway
+            # the time series isn't read back (rather than old meta describing new data)
+            if os.path.isfile(self._get_path(key, '.meta')): os.remove(self._get_path(key, '.meta'))
+
+            os.replace(self._get_path(key, '_values.tmp.npy'), self._get_path(key, '_values.npy'))
+            os.replace(self._get_path(key, '_index.tmp.npy'), self._get_path(key, '_index.npy'))
+            os.replace(self._get_path(key, '.tmp.meta'), self._get_path(key, '.meta'))
+        except Exception as e:
+            self.logger.warning("Couldn't write market data to cache " + str(e))
+
+    def _read(self, key):
+        meta_path = self._get_path(key, '.meta')
+
+        if not(os.path.isfile(meta_path)): return None, None
+
+        try:
+            meta = pandas.read_pickle(meta_path)
+
+            values = numpy.load(self._get_path(key, '_values.npy'), mmap_mode='r')
+            index = pandas.DatetimeIndex(numpy.load(self._get_path(key, '_index.npy')), name=meta['index_name'])
+
+            if meta.get('index_tz') is not None: index = index.tz_localize('UTC').tz_convert(meta['index_tz'])
+
+            return pandas.DataFrame(values, index=index, columns=meta['columns'], copy=False), meta
+        except Exception as e:
+            self.logger.warning("Couldn't read market data from cache " + str(e))
+
+        return None, None
@@ -0,0 +1,111 @@
+__author__ = 'saeedamen' # Saeed Amen
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+SharedFrame
+
+Holds the values of a numeric DataFrame in shared memory, so it can be handed to worker processes without pickling the
+underlying data (only the index, columns and the name of the memory block are pickled). Workers get a read only
+DataFrame backed directly by the shared block. If shared memory is not available (Python < 3.8) or the DataFrame is
+not numeric, the DataFrame itself is pickled instead.
+
+"""
+
+import numpy
+import pandas
+
+shared_memory = None
+
+try:
+    from multiprocessing import shared_memory
+except: pass
+
+class SharedFrame(object):
+
+    def __init__(self, data_frame):
+        self._data_frame = None
+        self._shm = None
+        self._name = None
+
+        if data_frame is None: return
+
+        self._index = data_frame.index
+        self._columns = data_frame.columns
+
+        values = data_frame.values
+
+        if shared_memory is None or values.dtype == object:
+            self._data_frame = data_frame
+            return
+
+        self._shape = values.shape
+        self._dtype = values.dtype.str
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        numpy.ndarray(self._shape, dtype=self._dtype, buffer=self._shm.buf)[:] = values
+
+        self._name = self._shm.name
+        self._owner = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+
+        # the memory block itself is never pickled, only its name
+        state['_shm'] = None
+        state['_owner'] = False
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def get_data_frame(self):
+        """
+        get_data_frame - Gets the DataFrame (in a worker process this is read only and backed by shared memory)
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        if self._name is None: return self._data_frame
+
+        if self._data_frame is None:
+            if self._shm is None:
+                # don't let the worker's resource tracker free a block it doesn't own (track only exists on Python 3.13+)
+                try:
+                    self._shm = shared_memory.SharedMemory(name=self._name, track=False)
+                except TypeError:
+                    self._shm = shared_memory.SharedMemory(name=self._name)
+
+            values = numpy.ndarray(self._shape, dtype=self._dtype, buffer=self._shm.buf)
+            values.flags.writeable = False
+
+            self._data_frame = pandas.DataFrame(values, index=self._index, columns=self._columns, copy=False)
+
+        return self._data_frame
+
+    def close(self):
+        """
+        close - Releases the shared memory (only the process which created it will free the block)
+        """
+
+        self._data_frame = None
+
+        if self._shm is not None:
+            self._shm.close()
+
+            if self._owner: self._shm.unlink()
+
+            self._shm = None
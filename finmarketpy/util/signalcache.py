@@ -0,0 +1,251 @@
+__author__ = 'saeedamen' # Saeed Amen
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+SignalCache
+
+Caches signals and technical indicators, keyed on a hash of the market data and parameters used to calculate them, so
+identical signals are not recalculated (eg. in sensitivity analysis where only transaction costs change). Keeps the most
+recently used results in memory and optionally also writes them to disk, as .npy files which are memory mapped when read
+back, so re-runs can reuse signals from earlier sessions. Cached results are returned as read only views, rather than
+copies, so results on disk stay memory mapped.
+
+"""
+
+import hashlib
+import os
+
+from collections import OrderedDict
+
+import numpy
+import pandas
+
+from findatapy.util import LoggerManager
+
+class SignalCache(object):
+
+    def __init__(self, max_items = 128, cache_path = None):
+        """
+        __init__ - Creates cache
+
+        Parameters
+        ----------
+        max_items : int
+            Maximum number of results to keep in memory (least recently used are dropped first)
+
+        cache_path : str
+            Folder for on disk cache (None for memory only)
+        """
+        self.logger = LoggerManager().getLogger(__name__)
+
+        self._max_items = max_items
+        self._cache_path = cache_path
+        self._cache = OrderedDict()
+
+        if cache_path is not None and not(os.path.isdir(cache_path)):
+            os.makedirs(cache_path)
+
+    def get_key(self, *args):
+        """
+        get_key - Gets a key from the content of the arguments (DataFrames, arrays, parameter objects such as
+        TechParams, dicts and scalars)
+
+        Returns
+        -------
+        str
+        """
+
+        h = hashlib.sha1()
+
+        for x in args:
+            self._update_hash(h, x)
+
+        return h.hexdigest()
+
+    def _update_hash(self, h, x, parents=None):
+        if parents is None: parents = set()
+
+        if isinstance(x, (pandas.DataFrame, pandas.Series)):
+            h.update(b'frame')
+            h.update(repr(list(x.columns) if isinstance(x, pandas.DataFrame) else x.name).encode('utf-8'))
+            h.update(repr(x.dtypes.tolist() if isinstance(x, pandas.DataFrame) else x.dtype).encode('utf-8'))
+            h.update(pandas.util.hash_pandas_object(x, index=True).values.tobytes())
+        elif isinstance(x, numpy.ndarray):
+            h.update(b'array')
+            h.update(repr((x.shape, x.dtype.str)).encode('utf-8'))
+            h.update(numpy.ascontiguousarray(x).tobytes())
+        elif isinstance(x, (dict, list, tuple)) or (hasattr(x, '__dict__') and not(callable(x))):
+            # objects which refer back to an object containing them (eg. a parent) are only hashed once
+            if id(x) in parents:
+                h.update(b'cycle')
+
+                return
+
+            parents.add(id(x))
+
+            try:
+                self._update_hash_container(h, x, parents)
+            finally:
+                parents.discard(id(x))
+        else:
+            h.update(repr(x).encode('utf-8'))
+
+    def _update_hash_container(self, h, x, parents):
+        if isinstance(x, dict):
+            h.update(b'dict')
+
+            for k in sorted(x.keys(), key=str):
+                self._update_hash(h, k, parents)
+                self._update_hash(h, x[k], parents)
+        elif isinstance(x, (list, tuple)):
+            h.update(b'list')
+
+            for y in x:
+                self._update_hash(h, y, parents)
+        else:
+            # parameter objects (eg. TechParams)
+            h.update(type(x).__name__.encode('utf-8'))
+            self._update_hash(h, vars(x), parents)
+
+    def get(self, key):
+        """
+        get - Gets cached results, as read only views of the cached values (copies, if they are not numeric DataFrames)
+
+        Parameters
+        ----------
+        key : str
+            Key of results
+
+        Returns
+        -------
+        list(pandas.DataFrame) (None if not cached)
+        """
+
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        else:
+            data_frame_list = self._read_disk(key)
+
+            if data_frame_list is None: return None
+
+            self._put_memory(key, data_frame_list)
+
+        return [self._get_view(x) for x in self._cache[key]]
+
+    def put(self, key, data_frame_list):
+        """
+        put - Caches results
+
+        Parameters
+        ----------
+        key : str
+            Key of results
+
+        data_frame_list : list(pandas.DataFrame)
+            Results to cache
+        """
+
+        data_frame_list = [self._get_read_only(x) for x in data_frame_list]
+
+        self._put_memory(key, data_frame_list)
+        self._write_disk(key, data_frame_list)
+
+    def _is_view_frame(self, x):
+        # DataFrames with one numeric dtype, which can be returned as views of their values
+        return isinstance(x, pandas.DataFrame) and len(set(x.dtypes)) == 1 and x.values.dtype != object
+
+    def _get_read_only(self, x):
+        if x is None: return None
+
+        if not(self._is_view_frame(x)): return x.copy()
+
+        values = x.values.copy()
+        values.flags.writeable = False
+
+        return pandas.DataFrame(values, index=x.index.copy(), columns=x.columns.copy(), copy=False)
+
+    def _get_view(self, x):
+        if x is None: return None
+
+        if not(self._is_view_frame(x)): return x.copy()
+
+        # new frame on the same values (so the index and columns can be changed, but not the values)
+        return pandas.DataFrame(x.values, index=x.index, columns=x.columns, copy=False)
+
+    def clear(self):
+        """
+        clear - Clears results in memory (results on disk are kept)
+        """
+        self._cache.clear()
+
+    def _put_memory(self, key, data_frame_list):
+        self._cache[key] = data_frame_list
+        self._cache.move_to_end(key)
+
+        while len(self._cache) > self._max_items:
+            self._cache.popitem(last=False)
+
+    def _get_disk_path(self, key, suffix):
+        return os.path.join(self._cache_path, key + suffix)
+
+    def _write_disk(self, key, data_frame_list):
+        if self._cache_path is None: return
+
+        # only numeric results can be memory mapped
+        for x in data_frame_list:
+            if x is not None and (not(isinstance(x, pandas.DataFrame)) or x.values.dtype == object):
+                return
+
+        try:
+            meta = []
+
+            for i in range(0, len(data_frame_list)):
+                x = data_frame_list[i]
+
+                if x is None:
+                    meta.append(None)
+                else:
+                    numpy.save(self._get_disk_path(key, '_' + str(i) + '.npy'), x.values)
+                    meta.append((x.index, x.columns))
+
+            # written last, so only complete results are ever read back
+            pandas.to_pickle(meta, self._get_disk_path(key, '.meta'))
+        except Exception as e:
+            self.logger.warning("Couldn't write signal to cache " + str(e))
+
+    def _read_disk(self, key):
+        if self._cache_path is None: return None
+
+        meta_path = self._get_disk_path(key, '.meta')
+
+        if not(os.path.isfile(meta_path)): return None
+
+        try:
+            meta = pandas.read_pickle(meta_path)
+
+            data_frame_list = []
+
+            for i in range(0, len(meta)):
+                if meta[i] is None:
+                    data_frame_list.append(None)
+                else:
+                    values = numpy.load(self._get_disk_path(key, '_' + str(i) + '.npy'), mmap_mode='r')
+
+                    data_frame_list.append(pandas.DataFrame(values, index=meta[i][0], columns=meta[i][1], copy=False))
+
+            return data_frame_list
+        except Exception as e:
+            self.logger.warning("Couldn't read signal from cache " + str(e))
+
+        return None
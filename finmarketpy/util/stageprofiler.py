@@ -0,0 +1,255 @@
+__author__ = 'saeedamen' # Saeed Amen
+
+#
+# Copyright 2016 Cuemacro
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# See the License for the specific language governing permissions and limitations under the License.
+#
+
+"""
+StageProfiler
+
+Opt-in instrumentation of the stages of a backtest (eg. load_assets, construct_signal, alignment, leverage, P&L, RetStats
+and charts), recording the wall time, CPU time, peak memory allocated above the start of the stage and the rows/columns of
+the data for each stage (and the basket key it was calculated for). Stages can be nested, in which case a stage's time
+and memory include those of the stages inside it, and nested stages take the key of the enclosing stage if they don't
+have their own. Records can be retrieved as a list of dicts or a DataFrame, or exported as JSON.
+
+Use by setting TradingModel.PROFILER (or BacktestRequest.profiler for a Backtest on its own) to a StageProfiler.
+
+"""
+
+import datetime
+import json
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+import pandas
+
+class StageProfiler(object):
+
+    def __init__(self, trace_memory = True):
+        """
+        __init__ - Creates profiler
+
+        Parameters
+        ----------
+        trace_memory : bool
+            Record peak memory of each stage (with tracemalloc, which slows down Python allocations while profiling)
+        """
+        self._trace_memory = trace_memory
+        self._records = []
+        self._open = []     # records of the stages we are currently in (innermost last)
+
+    @contextmanager
+    def stage(self, name, key = None):
+        """
+        stage - Context manager which records a stage
+
+        Parameters
+        ----------
+        name : str
+            Name of stage (eg. 'construct_signal')
+
+        key : str
+            Basket key (by default, the key of the enclosing stage)
+
+        Returns
+        -------
+        dict (record of the stage, whose shape can be set with set_shape)
+        """
+
+        if key is None and len(self._open) > 0: key = self._open[-1]['key']
+
+        record = {'stage' : name, 'key' : key, 'parent' : self._open[-1]['stage'] if len(self._open) > 0 else None,
+                  'start' : datetime.datetime.utcnow().isoformat(), 'wall_time' : None, 'cpu_time' : None,
+                  'memory_peak' : None, 'rows' : None, 'cols' : None}
+
+        started_tracing = False
+
+        if self._trace_memory:
+            if not(tracemalloc.is_tracing()):
+                tracemalloc.start()
+                started_tracing = True
+
+            current, peak = tracemalloc.get_traced_memory()
+
+            # the peak of the enclosing stages so far has to be kept before it is reset for this stage
+            for x in self._open: x['_peak'] = max(x['_peak'], peak)
+
+            self._reset_peak()
+
+            record['_start_memory'] = current
+            record['_peak'] = current
+
+        self._open.append(record)
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.perf_counter() - wall_start
+            record['cpu_time'] = time.process_time() - cpu_start
+
+            self._open.pop()
+
+            if self._trace_memory:
+                peak = max(record.pop('_peak'), tracemalloc.get_traced_memory()[1])
+
+                record['memory_peak'] = peak - record.pop('_start_memory')
+
+                for x in self._open: x['_peak'] = max(x['_peak'], peak)
+
+                if started_tracing: tracemalloc.stop()
+
+            self._records.append(record)
+
+    def _reset_peak(self):
+        # Python 3.9+ (otherwise peaks are since the start of tracing, so can be overstated)
+        if hasattr(tracemalloc, 'reset_peak'): tracemalloc.reset_peak()
+
+    def set_shape(self, record, data):
+        """
+        set_shape - Sets the rows and columns of the data of a stage
+
+        Parameters
+        ----------
+        record : dict
+            Record of stage (from stage)
+
+        data : pandas.DataFrame or numpy.ndarray
+            Data of the stage
+        """
+        set_stage_shape(record, data)
+
+    def add_records(self, records):
+        """
+        add_records - Adds records from another profiler (eg. in a worker process)
+
+        Parameters
+        ----------
+        records : list(dict)
+            Records of stages
+        """
+        self._records.extend(records)
+
+    def get_records(self):
+        """
+        get_records - Gets records of every stage (in the order they finished)
+
+        Returns
+        -------
+        list(dict)
+        """
+        return list(self._records)
+
+    def get_record_count(self):
+        return len(self._records)
+
+    def get_dataframe(self):
+        """
+        get_dataframe - Gets records of every stage as a DataFrame
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        return pandas.DataFrame(self._records, columns = ['stage', 'key', 'parent', 'start', 'wall_time', 'cpu_time',
+                                                          'memory_peak', 'rows', 'cols'])
+
+    def get_summary(self):
+        """
+        get_summary - Gets the total time and maximum peak memory of each stage (across every key)
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        grouped = self.get_dataframe().groupby('stage', sort = False)
+
+        summary = grouped.agg({'wall_time' : 'sum', 'cpu_time' : 'sum', 'memory_peak' : 'max'})
+        summary['calls'] = grouped.size()
+
+        return summary
+
+    def to_json(self, path = None):
+        """
+        to_json - Exports records of every stage as JSON
+
+        Parameters
+        ----------
+        path : str
+            File to write (None to only return JSON)
+
+        Returns
+        -------
+        str
+        """
+
+        js = json.dumps({'records' : self._records}, indent = 1)
+
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(js)
+
+        return js
+
+    def clear(self):
+        self._records = []
+
+@contextmanager
+def _no_stage():
+    yield {}
+
+def profile_stage(profiler, name, key = None):
+    """
+    profile_stage - Records a stage with a profiler, if there is one (otherwise does nothing)
+
+    Parameters
+    ----------
+    profiler : StageProfiler
+        Profiler (or None)
+
+    name : str
+        Name of stage
+
+    key : str
+        Basket key
+
+    Returns
+    -------
+    context manager
+    """
+
+    if profiler is None: return _no_stage()
+
+    return profiler.stage(name, key = key)
+
+def set_stage_shape(record, data):
+    """
+    set_stage_shape - Sets the rows and columns of the data of a stage (does nothing if there is no profiler)
+
+    Parameters
+    ----------
+    record : dict
+        Record of stage (from profile_stage)
+
+    data : pandas.DataFrame or numpy.ndarray
+        Data of the stage
+    """
+
+    if data is None or not(hasattr(data, 'shape')): return
+
+    record['rows'] = int(data.shape[0])
+    record['cols'] = int(data.shape[1]) if len(data.shape) > 1 else 1